@@ -126,10 +126,58 @@ REST_FRAMEWORK = {
         'rest_framework.permissions.IsAuthenticated',
     ],
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
+        'usermgmt.authentication.CachedTokenAuthentication',
     ]
 }
 
+# Local memory caches are per process. With several processes use a shared backend, e.g.
+# 'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': BASE_DIR/'cache'/'django'
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+# Cache alias and seconds for which authentication tokens are cached, see usermgmt/authentication.py
+TOKEN_CACHE = 'default'
+TOKEN_CACHE_TIMEOUT = 300
+
+# Cache for the download archives of shared folders, see transcriptmgmt/exportcache.py
+EXPORT_CACHE_ROOT = BASE_DIR/'cache'/'exports'
+EXPORT_CACHE_MAX_SIZE = 1073741824  # 1GB
+
+# Store audio files, transcripts and corrections content-addressed, so identical files share one blob on disk.
+# Unreferenced blobs are removed with "python manage.py collectblobs", see editmgmt/storages.py
+MEDIA_DEDUPLICATION = True
+
+# Write-behind of correction autosaves: a burst of saves is coalesced into one write of the correction file,
+# which happens CORRECTION_WRITE_BEHIND_DELAY seconds after the last save, see editmgmt/journal.py
+CORRECTION_WRITE_BEHIND = False
+CORRECTION_WRITE_BEHIND_DELAY = 5  # seconds
+CORRECTION_JOURNAL_ROOT = BASE_DIR/'cache'/'journal'
+# a flush that holds a correction longer than this is considered interrupted, its entry is written again
+CORRECTION_JOURNAL_CLAIM_TIMEOUT = 300  # seconds
+
+# Compute the error rates of corrections in a background thread after their writes, so the stats only read them.
+# False computes them during the writes, see editmgmt/metrics.py
+CORRECTION_METRICS_BACKGROUND = True
+
+# Format in which transcripts and corrections are stored: 'trjson' or the compact 'trbin', see transcriptmgmt/trbin.py
+TRANSCRIPT_STORAGE_FORMAT = 'trjson'
+
+# Memory budget of the per-process cache of parsed transcripts, see transcriptmgmt/contentcache.py. 0 disables it
+CONTENT_CACHE_MAX_SIZE = 67108864  # 64MB
+
+# Seconds for which the publisher status of a user is cached, see usermgmt/authcontext.py
+PUBLISHER_CACHE_TIMEOUT = 300
+
+# Background processing of uploaded archives, see transcriptmgmt/ingest.py
+INGESTION_WORKERS = 2
+INGESTION_POLL_INTERVAL = 2  # seconds
+INGESTION_STALE_TIMEOUT = 600  # seconds without progress after which a running job counts as failed
+INGESTION_CONVERSION_PROCESSES = 1  # size of the format conversion pool shared by the workers, 0: one process per cpu, 1: no pool
+INGESTION_CONVERSION_MIN_SIZE = 10485760  # 10MB, archives with less transcript data are converted without the pool
+
 DATA_UPLOAD_MAX_MEMORY_SIZE = 2147483648  # 2GB
 
 CORS_ALLOW_ALL_ORIGINS = True
@@ -0,0 +1,218 @@
+"""
+Word-level alignment of a correction with its original, and the word and character errors derived from it.
+
+The alignment is Myers' O((N+M)·D) diff, where D is the number of inserted and deleted words.
+To keep D small on long transcripts, the segments and words that occur exactly once in both texts are matched first
+(as in patience diff, O(N log N)), and Myers only aligns the gaps between these anchors.
+This is done for the segments first, then for the words of the changed segments.
+A gap that has no anchors and needs more than MAX_D edits counts as one replaced block.
+The character errors of a replaced block are the edits of a character diff, bounded by CHAR_MAX_D edits:
+beyond that, e.g. for a rewritten passage, they are the length of the longer side.
+
+The edit script consists of difflib style opcodes [tag, i1, i2, j1, j2] without the 'equal' ones:
+the words [i1:i2] of the original are replaced by the words [j1:j2] of the correction.
+In a replace opcode, min(i2-i1, j2-j1) words count as substitutions and the rest as deletions or insertions,
+so the error counts are those of the alignment, which can be slightly above the Levenshtein distance.
+"""
+
+import bisect
+from collections import Counter
+
+# upper bound of D of one alignment, the memory use grows with D²
+MAX_D = 2000
+# sequences with up to FAST_D edits are aligned by Myers without looking for anchors first
+FAST_D = 64
+# upper bound of D of the character diff of a replaced block
+CHAR_MAX_D = 64
+
+
+def _myers(a, b, max_d):
+    """
+    Returns the matching blocks (i, j, size) of the sequences a and b, or None if more than max_d edits are needed
+    """
+    n, m = len(a), len(b)
+    offset = max_d + 1
+    v = [0] * (2 * max_d + 3)
+    trace = []
+    for d in range(min(n + m, max_d) + 1):
+        # trace[d] holds the furthest x on the diagonals -d..d before round d
+        trace.append(v[offset - d:offset + d + 1])
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[offset + k - 1] < v[offset + k + 1]):
+                x = v[offset + k + 1]
+            else:
+                x = v[offset + k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[x] == b[y]:
+                x += 1
+                y += 1
+            v[offset + k] = x
+            if x >= n and y >= m:
+                return _backtrack(trace, n, m)
+    return None
+
+
+def _backtrack(trace, x, y):
+    blocks = []
+    for d in range(len(trace) - 1, 0, -1):
+        v = trace[d]
+        k = x - y
+        if k == -d or (k != d and v[k - 1 + d] < v[k + 1 + d]):
+            prev_k = k + 1  # an insertion
+            prev_x = v[prev_k + d]
+            start_x = prev_x
+        else:
+            prev_k = k - 1  # a deletion
+            prev_x = v[prev_k + d]
+            start_x = prev_x + 1
+        if x > start_x:
+            blocks.append((start_x, start_x - k, x - start_x))
+        x, y = prev_x, prev_x - prev_k
+    if x > 0:
+        blocks.append((0, 0, x))
+    blocks.reverse()
+    return blocks
+
+
+def diff(a, b, max_d=MAX_D):
+    """
+    Returns the opcodes turning the sequence a into b, or None if more than max_d edits are needed
+    """
+    n, m = len(a), len(b)
+    prefix = 0
+    while prefix < n and prefix < m and a[prefix] == b[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < n - prefix and suffix < m - prefix and a[n - 1 - suffix] == b[m - 1 - suffix]:
+        suffix += 1
+    blocks = _myers(a[prefix:n - suffix], b[prefix:m - suffix], max_d)
+    if blocks is None:
+        return None
+    opcodes = []
+    i = j = 0
+    for bi, bj, size in blocks + [(n - suffix - prefix, m - suffix - prefix, 0)]:
+        if i < bi or j < bj:
+            tag = 'replace' if i < bi and j < bj else 'delete' if i < bi else 'insert'
+            opcodes.append([tag, prefix + i, prefix + bi, prefix + j, prefix + bj])
+        i, j = bi + size, bj + size
+    return opcodes
+
+
+def _unique_anchors(a, b):
+    """
+    Returns the positions (i, j) of the items that occur once in a and once in b,
+    reduced to the longest sequence that is increasing in both i and j
+    """
+    count_a, count_b = Counter(a), Counter(b)
+    position_b = {item: j for j, item in enumerate(b) if count_b[item] == 1}
+    pairs = [(i, position_b[item]) for i, item in enumerate(a) if count_a[item] == 1 and item in position_b]
+    # longest increasing subsequence of the j, by patience sorting
+    tails, tail_indices, previous = [], [], [None] * len(pairs)
+    for index, (_, j) in enumerate(pairs):
+        pile = bisect.bisect_left(tails, j)
+        if pile:
+            previous[index] = tail_indices[pile - 1]
+        if pile == len(tails):
+            tails.append(j)
+            tail_indices.append(index)
+        else:
+            tails[pile] = j
+            tail_indices[pile] = index
+    anchors = []
+    index = tail_indices[-1] if tail_indices else None
+    while index is not None:
+        anchors.append(pairs[index])
+        index = previous[index]
+    anchors.reverse()
+    return anchors
+
+
+def anchored_diff(a, b):
+    """
+    Returns the opcodes turning the sequence a into b, aligning the gaps between unique common items with diff
+    """
+    opcodes = diff(a, b, FAST_D)
+    if opcodes is not None:
+        return opcodes
+    anchors = _unique_anchors(a, b)
+    if not anchors:
+        opcodes = diff(a, b)
+        return _replace(0, len(a), 0, len(b)) if opcodes is None else opcodes
+    opcodes = []
+    i = j = 0
+    for anchor_i, anchor_j in anchors + [(len(a), len(b))]:
+        if i < anchor_i or j < anchor_j:
+            opcodes.extend([tag, i + i1, i + i2, j + j1, j + j2]
+                           for tag, i1, i2, j1, j2 in anchored_diff(a[i:anchor_i], b[j:anchor_j]))
+        i, j = anchor_i + 1, anchor_j + 1
+    return opcodes
+
+
+def _replace(i1, i2, j1, j2):
+    if i1 == i2 and j1 == j2:
+        return []
+    tag = 'replace' if i1 < i2 and j1 < j2 else 'delete' if i1 < i2 else 'insert'
+    return [[tag, i1, i2, j1, j2]]
+
+
+def _words(segments):
+    return [[word['word'] for word in segment] for segment in segments]
+
+
+def align(original, correction):
+    """
+    Returns the opcodes turning the words of the original into the words of the correction, both lists of segments
+    """
+    table = {}
+    intern = lambda items: [table.setdefault(item, len(table)) for item in items]
+    a_segments, b_segments = _words(original), _words(correction)
+    a = intern(word for segment in a_segments for word in segment)
+    b = intern(word for segment in b_segments for word in segment)
+    segment_opcodes = anchored_diff(intern(map(tuple, a_segments)), intern(map(tuple, b_segments)))
+    a_starts, b_starts = [0], [0]
+    for segment in a_segments:
+        a_starts.append(a_starts[-1] + len(segment))
+    for segment in b_segments:
+        b_starts.append(b_starts[-1] + len(segment))
+    opcodes = []
+    for _, i1, i2, j1, j2 in segment_opcodes:
+        wi, wj = a_starts[i1], b_starts[j1]
+        region = anchored_diff(a[wi:a_starts[i2]], b[wj:b_starts[j2]])
+        opcodes.extend([tag, wi + ri1, wi + ri2, wj + rj1, wj + rj2] for tag, ri1, ri2, rj1, rj2 in region)
+    return opcodes
+
+
+def _char_errors(a, b):
+    # deleted and inserted words, or more edits than CHAR_MAX_D: the difference in length is a lower bound of D
+    if not a or not b or abs(len(a) - len(b)) > CHAR_MAX_D:
+        return max(len(a), len(b))
+    opcodes = diff(a, b, CHAR_MAX_D)
+    if opcodes is None:
+        return max(len(a), len(b))
+    return sum(max(i2 - i1, j2 - j1) for _, i1, i2, j1, j2 in opcodes)
+
+
+def compare(original, correction):
+    """
+    Aligns a correction with its original, both lists of segments.
+    Returns the edit script and the word and character error counts, the base of WER and CER.
+    """
+    opcodes = align(original, correction)
+    a = [word['word'] for segment in original for word in segment]
+    b = [word['word'] for segment in correction for word in segment]
+    result = {'ref_words': len(a), 'ref_chars': len(' '.join(a)),
+              'substitutions': 0, 'deletions': 0, 'insertions': 0, 'char_errors': 0, 'opcodes': opcodes}
+    for _, i1, i2, j1, j2 in opcodes:
+        substitutions = min(i2 - i1, j2 - j1)
+        result['substitutions'] += substitutions
+        result['deletions'] += i2 - i1 - substitutions
+        result['insertions'] += j2 - j1 - substitutions
+        result['char_errors'] += _char_errors(' '.join(a[i1:i2]), ' '.join(b[j1:j2]))
+    return result
+
+
+def error_rate(errors, total):
+    """
+    errors / total, None if there is nothing to compare with
+    """
+    return errors / total if total else None
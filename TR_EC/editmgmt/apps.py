@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class EditmgmtConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'editmgmt'
+
+    def ready(self):
+        from . import metrics, search
+        search.connect_signals()
+        metrics.connect_signals()
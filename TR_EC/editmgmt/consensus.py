@@ -0,0 +1,148 @@
+"""
+Consensus of the corrections of a transcript.
+
+Every correction is aligned with the original (the edit scripts of CorrectionMetrics, see alignment.py),
+which aligns the corrections with each other through the words of the original.
+Every word of the original is a slot, and so is every gap between two words of the original:
+    the vote of a correction for a word slot is the word it has in that place, or nothing if it deleted the word
+    the vote of a correction for a gap slot is the sequence of words it inserted there, usually none
+Every slot gets the candidate with the most votes, ties are decided in favor of the original.
+The agreement of a word of the consensus is the share of the corrections that voted for it.
+Only the slots changed by any correction are counted, so building the consensus takes O(N + edits).
+"""
+import io, json
+from collections import Counter
+from transcriptmgmt import trformats, zipstream
+from . import models
+
+
+def _changes(opcodes):
+    """
+    Returns {word slot: index of the replacing word or None if deleted} and {gap slot: [indices of inserted words]}
+    of the slots changed by an edit script
+    """
+    replaced, inserted = {}, {}
+    for _, i1, i2, j1, j2 in opcodes:
+        paired = min(i2 - i1, j2 - j1)
+        for k in range(paired):
+            replaced[i1 + k] = j1 + k
+        for i in range(i1 + paired, i2):
+            replaced[i] = None
+        if j1 + paired < j2:
+            inserted.setdefault(i2, []).extend(range(j1 + paired, j2))
+    return replaced, inserted
+
+
+# the vote for keeping the original in a slot
+UNCHANGED = object()
+
+
+def _vote(votes, total):
+    """
+    Returns the candidate of a slot with the most votes, the words of its first voter and its number of votes.
+    votes are the (candidate, words) of the corrections that changed the slot, the others vote for UNCHANGED,
+    which wins ties.
+    """
+    winner, words, count = UNCHANGED, None, total - len(votes)
+    if votes:
+        candidate, candidate_count = Counter(candidate for candidate, _ in votes).most_common(1)[0]
+        if candidate_count > count:
+            winner, count = candidate, candidate_count
+            words = next(voted for key, voted in votes if key == candidate)
+    return winner, words, count
+
+
+def build(original, corrections):
+    """
+    Builds the consensus of corrections, a list of (content, edit script) pairs of the corrections of original.
+    Returns the consensus as list of segments and the agreement of every word in the same structure.
+    The consensus keeps the segmentation of the original, inserted words go to the segment of the preceding word.
+    """
+    words, segment_of = [], []
+    for index, segment in enumerate(original):
+        words.extend(segment)
+        segment_of.extend([index] * len(segment))
+    total = len(corrections)
+    word_votes, gap_votes = {}, {}
+    for content, opcodes in corrections:
+        correction_words = [word for segment in content for word in segment]
+        replaced, inserted = _changes(opcodes)
+        for i, j in replaced.items():
+            # a deletion votes for no words
+            voted = [] if j is None else [correction_words[j]]
+            word_votes.setdefault(i, []).append((tuple(word['word'] for word in voted), voted))
+        for i, indices in inserted.items():
+            voted = [correction_words[j] for j in indices]
+            gap_votes.setdefault(i, []).append((tuple(word['word'] for word in voted), voted))
+
+    segments = [[] for _ in original] or [[]]
+    agreement = [[] for _ in segments]
+
+    def add(segment, word, votes):
+        segments[segment].append({'word': word['word'], 'start': word['start'], 'end': word['end']})
+        agreement[segment].append(votes / total if total else None)
+
+    for i in range(len(words) + 1):
+        if i in gap_votes:
+            winner, voted, count = _vote(gap_votes[i], total)
+            if winner is not UNCHANGED:
+                for word in voted:
+                    add(segment_of[i - 1] if i else 0, word, count)
+        if i == len(words):
+            break
+        winner, voted, count = _vote(word_votes.get(i, []), total)
+        for word in [words[i]] if winner is UNCHANGED else voted:
+            add(segment_of[i], word, count)
+    # segments whose words were all deleted are dropped
+    kept = [index for index, segment in enumerate(segments) if segment]
+    return [segments[index] for index in kept], [agreement[index] for index in kept]
+
+
+def mean_agreement(agreement):
+    values = [value for segment in agreement for value in segment if value is not None]
+    return sum(values) / len(values) if values else None
+
+
+def scripted_corrections(corrections):
+    """
+    Returns the corrections of the queryset with their up to date edit scripts, as (correction, edit script) pairs
+    """
+    models.CorrectionMetrics.update(corrections)
+    corrections = list(corrections.select_related('transcription', 'editor'))
+    metrics = models.CorrectionMetrics.objects.filter(correction__in=[correction.pk for correction in corrections]).in_bulk()
+    result = []
+    for correction in corrections:
+        script = metrics.get(correction.pk)
+        if script is None or script.version != models.CorrectionMetrics.version_of(correction):
+            # changed since the update
+            script = models.CorrectionMetrics.compute(correction)
+        result.append((correction, script.edit_script))
+    return result
+
+
+def for_transcription(transcription, scripted):
+    """
+    Returns the consensus of the (correction, edit script) pairs of transcription as dict with the usernames
+    of the editors, the consensus content, the agreement of every word and the mean agreement
+    """
+    content, agreement = build(transcription.get_content(), [(correction.get_content(), script) for correction, script in scripted])
+    return {'editors': [correction.editor.username for correction, _ in scripted],
+            'agreement': mean_agreement(agreement), 'content': content, 'word_agreement': agreement}
+
+
+def stream_zip(shared_folder, corrections, format='trjson'):
+    """
+    Generator that yields a zip archive with the consensus of every transcript of shared_folder in format
+    and its agreement, built from the queryset corrections
+    """
+    by_transcription = {}
+    for correction, script in scripted_corrections(corrections.filter(transcription__shared_folder=shared_folder)):
+        by_transcription.setdefault(correction.transcription_id, []).append((correction, script))
+    extension, _, _ = trformats.formats[format]
+    zs = zipstream.ZipStream()
+    for transcription in shared_folder.transcription.all():
+        info = for_transcription(transcription, by_transcription.get(transcription.id, []))
+        content = info.pop('content')
+        yield from zs.add_file(transcription.title + '/consensus.' + extension, io.BytesIO(trformats.dumps(content, format)))
+        yield from zs.add_file(transcription.title + '/agreement.json', io.BytesIO(json.dumps(info).encode('utf-8')))
+    yield from zs.finish()
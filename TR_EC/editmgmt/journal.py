@@ -0,0 +1,288 @@
+"""
+Write-behind journal for the autosaves of corrections, used if settings.CORRECTION_WRITE_BEHIND is set.
+
+A save only writes the content to the journal, one entry file per correction that every save replaces atomically.
+An entry is flushed to the correction file once it wasn't replaced for CORRECTION_WRITE_BEHIND_DELAY seconds,
+so a burst of autosaves results in a single write of the correction and a single database update.
+Reads of a correction take the content from its entry, see Correction.get_content.
+The entries are durable: entries left by a stopped or crashed process are still read, and are flushed by the next
+flusher that runs, or right away with "python manage.py flushcorrections" (e.g. when deploying).
+Several processes may flush the same journal: the flushes of a correction hold a lock file, so they write its
+contents in the order of the saves, and a claimed entry is only written again by another process once the claim
+is older than CORRECTION_JOURNAL_CLAIM_TIMEOUT, i.e. the flush that claimed it was interrupted.
+"""
+import contextlib, json, logging, os, tempfile, threading, time, uuid
+from django.conf import settings
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+PENDING = '.pending'
+FLUSHING = '.flushing-'  # an entry claimed by a flush, followed by a random suffix
+LOCK = '.lock'
+LOCK_POLL_INTERVAL = 0.05  # seconds
+_held = threading.local()  # ids of the corrections whose lock the thread holds
+# ids per call of the select function of flush_corrections, stays below the variable limit of sqlite
+SELECT_BATCH_SIZE = 500
+
+
+def enabled():
+    return settings.CORRECTION_WRITE_BEHIND
+
+
+def _root():
+    return str(settings.CORRECTION_JOURNAL_ROOT)
+
+
+def _pending_path(correction_id):
+    return os.path.join(_root(), f'{correction_id}{PENDING}')
+
+
+def _scan():
+    """
+    Returns {correction id: [pending entry or None, [claimed entries]]} for all entries in the journal
+    """
+    entries = {}
+    try:
+        filenames = os.listdir(_root())
+    except FileNotFoundError:
+        return entries
+    for filename in filenames:
+        if filename.endswith(PENDING):
+            correction_id, kind = filename[:-len(PENDING)], PENDING
+        elif FLUSHING in filename:
+            correction_id, kind = filename.split(FLUSHING)[0], FLUSHING
+        else:
+            continue  # temporary file of a running append
+        if not correction_id.isdigit():
+            continue
+        entry = entries.setdefault(int(correction_id), [None, []])
+        path = os.path.join(_root(), filename)
+        if kind == PENDING:
+            entry[0] = path
+        else:
+            entry[1].append(path)
+    return entries
+
+
+def _claimed_paths(correction_id):
+    return _scan().get(correction_id, (None, []))[1]
+
+
+def _stale(path, timeout=None):
+    # the modification time of a claimed entry is the time of its claim
+    if timeout is None:
+        timeout = settings.CORRECTION_JOURNAL_CLAIM_TIMEOUT
+    return _mtime(path) <= time.time() - timeout
+
+
+@contextlib.contextmanager
+def _locked(correction_id, timeout=None):
+    """
+    Holds the lock of a correction, which serializes its flushes across processes.
+    Locks older than CORRECTION_JOURNAL_CLAIM_TIMEOUT are left by crashed processes and are broken.
+    The thread holding the lock may take it again, e.g. a write computes the metrics, which flushes the correction.
+    """
+    held = _held.__dict__.setdefault('ids', set())
+    if correction_id in held:
+        yield
+        return
+    path = os.path.join(_root(), f'{correction_id}{LOCK}')
+    while True:
+        try:
+            os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            break
+        except FileExistsError:
+            if _stale(path, timeout):
+                _remove(path)
+            else:
+                time.sleep(LOCK_POLL_INTERVAL)
+    held.add(correction_id)
+    try:
+        yield
+    finally:
+        held.discard(correction_id)
+        _remove(path)
+
+
+def _read(path):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def append(correction_id, segments):
+    """
+    Stores segments as the pending content of a correction, replacing the previous pending content
+    """
+    root = _root()
+    os.makedirs(root, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=root, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(segments, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, _pending_path(correction_id))
+        tmp_path = None
+    finally:
+        if tmp_path is not None:
+            _remove(tmp_path)
+    flusher.start()
+
+
+def pending_content(correction_id):
+    """
+    Returns the content of a correction that isn't flushed yet, or None if the correction file is up to date
+    """
+    try:
+        return _read(_pending_path(correction_id))
+    except FileNotFoundError:
+        pass
+    # a flush might be writing the content right now
+    for path in sorted(_claimed_paths(correction_id), key=_mtime, reverse=True):
+        try:
+            return _read(path)
+        except FileNotFoundError:
+            continue
+    return None
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except FileNotFoundError:
+        return 0
+
+
+def _apply(correction_id, path):
+    # imported here, the models use this module
+    from .models import Correction
+    try:
+        segments = _read(path)
+    except FileNotFoundError:
+        # removed by a flush of newer content
+        return
+    correction = Correction.objects.select_related('transcription').filter(pk=correction_id).first()
+    if correction is not None:  # otherwise it was deleted in the meantime, the entry is dropped
+        correction.write_content(segments)
+
+
+def flush(correction_id):
+    """
+    Writes the pending content of a correction to its file now. Returns whether there was pending content.
+    """
+    pending = _pending_path(correction_id)
+    if not os.path.exists(pending):
+        return False
+    claimed = pending[:-len(PENDING)] + FLUSHING + uuid.uuid4().hex
+    with _locked(correction_id):
+        try:
+            # the rename claims the entry, so saves during the flush create a new entry
+            os.rename(pending, claimed)
+        except FileNotFoundError:
+            # flushed by another process in the meantime
+            return False
+        os.utime(claimed)
+        _apply(correction_id, claimed)
+        _remove(claimed)
+        # entries left by interrupted flushes are older than the one written now
+        for path in _claimed_paths(correction_id):
+            if _stale(path):
+                _remove(path)
+    return True
+
+
+def _recover(correction_id, timeout=None):
+    """
+    Writes the newest of the entries left by interrupted flushes of a correction again and removes them.
+    Returns whether there were such entries.
+    """
+    with _locked(correction_id, timeout):
+        stale = sorted((path for path in _claimed_paths(correction_id) if _stale(path, timeout)), key=_mtime)
+        if stale:
+            _apply(correction_id, stale[-1])
+        for path in stale:
+            _remove(path)
+    return bool(stale)
+
+
+def flush_corrections(select):
+    """
+    Flushes the pending entries of some corrections, e.g. the ones of a shared folder before its download.
+    select(ids) returns the ids to flush among some of the ids in the journal.
+    Returns the number of flushed corrections.
+    """
+    ids = list(_scan())
+    flushed = 0
+    for i in range(0, len(ids), SELECT_BATCH_SIZE):
+        for correction_id in select(ids[i:i + SELECT_BATCH_SIZE]):
+            flushed += flush(correction_id)
+    return flushed
+
+
+def flush_all(min_age=0, claim_timeout=None):
+    """
+    Flushes the entries that weren't replaced for min_age seconds, including the ones left by interrupted flushes.
+    claim_timeout overrides CORRECTION_JOURNAL_CLAIM_TIMEOUT, e.g. 0 if no other process is running.
+    Returns the number of flushed corrections and the number of entries that are still pending.
+    """
+    flushed, remaining = 0, 0
+    limit = time.time() - min_age
+    for correction_id, (pending, claimed) in _scan().items():
+        if pending is not None:
+            if _mtime(pending) > limit:
+                remaining += 1
+                continue
+            flushed += flush(correction_id)
+        elif claimed and all(_stale(path, claim_timeout) for path in claimed):
+            flushed += _recover(correction_id, claim_timeout)
+        elif claimed:
+            # claimed by a running flush, which might be in another process
+            remaining += 1
+    return flushed, remaining
+
+
+class Flusher:
+    """
+    Thread that flushes the journal entries after CORRECTION_WRITE_BEHIND_DELAY seconds.
+    It is started by append and stops once the journal is empty.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self.run, name='correction-journal', daemon=True)
+                self._thread.start()
+
+    def run(self):
+        delay = settings.CORRECTION_WRITE_BEHIND_DELAY
+        while True:
+            remaining = 1
+            while remaining:
+                time.sleep(max(delay / 2, 0.1))
+                try:
+                    _, remaining = flush_all(min_age=delay)
+                except Exception:
+                    logger.exception('Flushing the correction journal failed')
+                finally:
+                    connection.close()
+            with self._lock:
+                # an append since the last flush saw this thread alive and didn't start another one,
+                # appends after this check find _thread cleared and start a new thread
+                if not _scan():
+                    self._thread = None
+                    return
+
+
+flusher = Flusher()
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from editmgmt import storages
+
+
+class Command(BaseCommand):
+    help = 'Removes the blobs of the deduplicated media storage that are not referenced anymore'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--grace-period', type=int, default=3600, help='seconds for which new blobs are kept in any case')
+
+    def handle(self, *args, **kwargs):
+        removed, freed = storages.dedup_storage.collect_garbage(kwargs['grace_period'])
+        self.stdout.write(f"Removed {removed} blobs, freed {freed} bytes")
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from editmgmt import journal
+
+
+class Command(BaseCommand):
+    help = 'Writes the pending autosaves of the correction journal to the corrections'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--claim-timeout', type=float,
+                            help='seconds after which an interrupted flush is written again, 0 if no server is running')
+
+    def handle(self, *args, **kwargs):
+        flushed, _ = journal.flush_all(claim_timeout=kwargs['claim_timeout'])
+        self.stdout.write(f"Flushed {flushed} corrections")
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from transcriptmgmt import models as transcript_models
+from editmgmt import models, search
+
+
+class Command(BaseCommand):
+    help = 'Brings the search index of all transcripts and corrections up to date'
+
+    def handle(self, *args, **kwargs):
+        transcriptions = transcript_models.Transcription.objects.all()
+        for transcription in transcriptions.iterator():
+            search.index_transcription(transcription)
+        corrections = models.Correction.objects.select_related('transcription')
+        for correction in corrections.iterator():
+            search.index_correction(correction)
+        self.stdout.write(f"Indexed {transcriptions.count()} transcripts and {corrections.count()} corrections")
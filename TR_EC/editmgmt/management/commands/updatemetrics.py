@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from editmgmt import metrics, models
+
+
+class Command(BaseCommand):
+    help = 'Computes the missing and outdated error rates of all corrections'
+
+    def handle(self, *args, **kwargs):
+        computed = metrics.update(list(models.Correction.objects.values_list('pk', flat=True)))
+        self.stdout.write(f"Computed the metrics of {computed} corrections")
@@ -0,0 +1,91 @@
+"""
+Computation of the CorrectionMetrics outside of the requests.
+
+Aligning a long correction with its original takes too long for a request that is polled like the stats.
+When the content of a correction is written, or when an original is written, the corrections are
+queued and a thread computes their metrics once the write is committed. The stats only read the metrics,
+written corrections whose metrics are missing or outdated are reported as pending. Untouched corrections
+have no errors and are left out.
+Metrics that were still queued when a process stopped are computed by "python manage.py updatemetrics".
+With CORRECTION_METRICS_BACKGROUND = False the metrics are computed right away by the writes instead.
+"""
+import logging, threading
+from django.conf import settings
+from django.db import connection, transaction
+from transcriptmgmt import signals as transcript_signals
+from . import models
+
+logger = logging.getLogger(__name__)
+
+# corrections per query, stays below the variable limit of sqlite
+BATCH_SIZE = 500
+
+
+def update(correction_ids):
+    """
+    Computes the missing and outdated metrics of the written corrections, returns the number of computed metrics
+    """
+    computed = 0
+    for i in range(0, len(correction_ids), BATCH_SIZE):
+        corrections = models.Correction.objects.filter(pk__in=correction_ids[i:i + BATCH_SIZE]).exclude(trfile='')
+        computed += models.CorrectionMetrics.update(corrections)
+    return computed
+
+
+class Updater:
+    """
+    Thread that computes the metrics of the scheduled corrections.
+    It is started by schedule and stops once the queue is empty.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._queue = set()
+        self._thread = None
+
+    def schedule(self, correction_ids):
+        if not settings.CORRECTION_METRICS_BACKGROUND:
+            update(list(correction_ids))
+            return
+        # the thread has to see the written content
+        transaction.on_commit(lambda: self._enqueue(correction_ids))
+
+    def _enqueue(self, correction_ids):
+        with self._lock:
+            self._queue.update(correction_ids)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.run, name='correction-metrics', daemon=True)
+                self._thread.start()
+
+    def run(self):
+        while True:
+            with self._lock:
+                if not self._queue:
+                    self._thread = None
+                    return
+                correction_ids = list(self._queue)
+                self._queue.clear()
+            try:
+                update(correction_ids)
+            except Exception:
+                logger.exception('Computing the metrics of corrections failed')
+            finally:
+                connection.close()
+
+
+updater = Updater()
+
+
+def transcripts_written(sender, transcriptions, **kwargs):
+    # the metrics of the written corrections are outdated once their original changed, new transcripts have none
+    transcription_ids = [transcription.pk for transcription in transcriptions]
+    correction_ids = []
+    for i in range(0, len(transcription_ids), BATCH_SIZE):
+        correction_ids.extend(models.Correction.objects.filter(transcription__in=transcription_ids[i:i + BATCH_SIZE])
+                              .exclude(trfile='').values_list('pk', flat=True))
+    if correction_ids:
+        updater.schedule(correction_ids)
+
+
+def connect_signals():
+    transcript_signals.transcripts_written.connect(transcripts_written, dispatch_uid='editmgmt.metrics.transcripts_written')
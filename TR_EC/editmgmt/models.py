@@ -1,19 +1,23 @@
-from django.db import models, utils
+from django.db import models, utils, transaction
 from django.contrib import auth
 from django.conf import settings
-from django.db.models import constraints
-from transcriptmgmt import models as transcript_models
+from django.core.files.base import ContentFile
+from django.db.models import constraints, signals, Value
+from django.db.models.functions import Concat
+from django.dispatch import receiver
+from transcriptmgmt import models as transcript_models, trformats, utils as transcript_utils, contentcache
 from pathlib import Path
-import shutil, os, json
-from . import storages
+import hashlib, os, json
+from . import storages, journal, alignment
 
 
 def correction_upload_path(instance, filename):
     """
     Generates the upload path for a correction transcript
     """
-    sf_path = Path(instance.transcription.shared_folder.sharedfolder.get_path())
-    path = sf_path/instance.transcription.title/str(instance.editor.id)/"correction.json"
+    sf_path = Path(instance.transcription.shared_folder.get_path())
+    # keep the extension, it determines the storage format
+    path = sf_path/instance.transcription.title/str(instance.editor.id)/("correction" + os.path.splitext(filename)[1])
     return path
 
 
@@ -23,8 +27,10 @@ class Correction(models.Model):
     """
     editor = models.ForeignKey(auth.get_user_model(), on_delete=models.CASCADE, related_name='correction')
     transcription = models.ForeignKey(transcript_models.Transcription, on_delete=models.CASCADE, related_name='correction')
-    trfile = models.FileField(upload_to=correction_upload_path, storage=storages.OverwriteStorage())
+    # empty until the first write, until then the correction reads the original, see content_file
+    trfile = models.FileField(upload_to=correction_upload_path, storage=storages.correction_storage, blank=True)
     finished = models.BooleanField(default=False)
+    content_hash = models.CharField(max_length=64, blank=True, editable=False)  # sha256 of trfile, see write_content
 
     class Meta:
         ordering = ['transcription', 'editor']
@@ -32,17 +38,24 @@ class Correction(models.Model):
             models.UniqueConstraint(fields=['editor', 'transcription'], name='unique_correction')
         ]
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # needed to update the CorrectionStats when finished changes
+        instance._finished_in_db = instance.finished
+        return instance
+
     def save(self, *args, **kwargs):
-        if self._state.adding:
-            sf_path = Path(self.transcription.shared_folder.sharedfolder.get_path())
-            trfile_src_path = self.transcription.trfile.path
-            trfile_trg_dir_path = settings.MEDIA_ROOT/sf_path/self.transcription.title/str(self.editor.id)
-            # need to create the editor directory upon user creation for shutil.copy.
-            # exist_ok, because an editor could be added, removed and readded to a sf.
-            os.makedirs(trfile_trg_dir_path, exist_ok=True)
-            shutil.copy(trfile_src_path, trfile_trg_dir_path/"correction.json")
-            self.trfile.name = f"{sf_path}/{self.transcription.title}/{self.editor.id}/correction.json"
-        super().save()
+        # a new correction doesn't get a copy of the original, its own file is only written on the first update
+        adding = self._state.adding
+        finished_change = int(self.finished) - int(getattr(self, '_finished_in_db', False))
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if adding or finished_change:
+                CorrectionStats.add(self.transcription.shared_folder_id, self.editor_id, started=int(adding), finished=finished_change)
+        self._finished_in_db = self.finished
+        if self.trfile:
+            contentcache.content_cache.invalidate(self.trfile.name)
 
     #Used for permission checks
     def is_owner(self, user):
@@ -50,11 +63,215 @@ class Correction(models.Model):
 
     #Used for permission checks
     def is_editor(self, user):
-        return self.editor == user
+        return self.editor_id == user.id
+    
+    def is_untouched(self):
+        return not self.trfile
+
+    def content_file(self):
+        """
+        Returns the file holding the content of this correction, which is the original as long as it is untouched
+        """
+        return self.transcription.trfile if self.is_untouched() else self.trfile
     
+    def write_content(self, segments):
+        """
+        Stores segments as the content of this correction, in the storage format.
+        The file is replaced atomically, and nothing is written if the content didn't change.
+        Returns whether the content was written.
+        """
+        storage_format = settings.TRANSCRIPT_STORAGE_FORMAT
+        extension, _, _ = trformats.formats[storage_format]
+        content = trformats.dumps(segments, storage_format)
+        digest = hashlib.sha256(content).hexdigest()
+        if self.is_untouched():
+            # an untouched correction keeps reading the original as long as it is saved unchanged
+            original = self.transcription.trfile
+            if trformats.format_of(original.name) == storage_format:
+                with original.open('rb') as f:
+                    if hashlib.sha256(f.read()).hexdigest() == digest:
+                        return False
+        elif digest == self.content_hash and trformats.format_of(self.trfile.name) == storage_format:
+            return False
+        old_name = self.trfile.name
+        # the search index is updated from the difference, see search.update_correction
+        try:
+            previous = transcript_utils.load_content(self.trfile) if old_name else None
+        except (OSError, ValueError):
+            # the save replaces an unreadable file, the index of the correction is rebuilt
+            previous = False
+        name = self.trfile.field.generate_filename(self, "correction." + extension)
+        self.trfile.name = self.trfile.storage.replace(name, ContentFile(content))
+        self.content_hash = digest
+        self.save(update_fields=['trfile', 'content_hash'])
+        if old_name and old_name != self.trfile.name:
+            # the storage format changed since the last save
+            self.trfile.storage.delete(old_name)
+            contentcache.content_cache.invalidate(old_name)
+        # imported here, search and metrics use the models
+        from . import metrics, search
+        if previous is False:
+            search.index_correction(self, segments)
+        else:
+            search.update_correction(self, previous, segments)
+        metrics.updater.schedule([self.id])
+        return True
+
     def get_content(self):
-        return json.load(self.trfile)
+        if journal.enabled():
+            pending = journal.pending_content(self.id)
+            if pending is not None:
+                return pending
+        return transcript_utils.load_content(self.content_file())
+
+    def get_content_window(self, offset=0, limit=None):
+        if journal.enabled():
+            pending = journal.pending_content(self.id)
+            if pending is not None:
+                end = None if limit is None else offset + limit
+                return pending[offset:end], len(pending)
+        return transcript_utils.load_content_window(self.content_file(), offset, limit)
+
+    def stream_content(self, format):
+        """
+        Generator that yields the content of this correction converted to format (see trformats.formats)
+        """
+        fieldfile = self.content_file()
+        with fieldfile.open('rb') as f:
+            yield from trformats.export(f, trformats.format_of(fieldfile.name), format)
+
+
+@receiver(signals.post_delete, sender=Correction)
+def correction_deleted(sender, instance, **kwargs):
+    # also sent for bulk and cascading deletes, which don't call Correction.delete
+    # only existing stats are updated, in a cascade the shared folder or the editor might be deleted as well
+    CorrectionStats.objects.filter(shared_folder__transcription=instance.transcription_id, editor=instance.editor_id).update(
+        started=models.F('started') - 1, finished=models.F('finished') - int(instance.finished))
+    if instance.trfile:
+        contentcache.content_cache.invalidate(instance.trfile.name)
+
+
+class CorrectionStats(models.Model):
+    """
+    Number of started and finished corrections of an editor in a shared folder, read by the stats of a shared folder.
+    Maintained by Correction, can be recomputed with "python manage.py repaircounters".
+    """
+    shared_folder = models.ForeignKey(transcript_models.SharedFolder, on_delete=models.CASCADE, related_name='correction_stats')
+    editor = models.ForeignKey(auth.get_user_model(), on_delete=models.CASCADE, related_name='correction_stats')
+    started = models.IntegerField(default=0)
+    finished = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['shared_folder', 'editor'], name='unique_correction_stats')
+        ]
+
+    @classmethod
+    def add(cls, shared_folder_id, editor_id, started=0, finished=0):
+        # the first corrections of an editor in a shared folder may be created concurrently,
+        # so the row is inserted unless it exists instead of get_or_create, which raises IntegrityError then
+        cls.objects.bulk_create([cls(shared_folder_id=shared_folder_id, editor_id=editor_id)], ignore_conflicts=True)
+        cls.objects.filter(shared_folder_id=shared_folder_id, editor_id=editor_id).update(
+            started=models.F('started') + started, finished=models.F('finished') + finished)
+
 
+class CorrectionMetrics(models.Model):
+    """
+    Alignment of a correction with its original and the resulting error counts, see alignment.py.
+    Stored for the version of the correction it was computed for, and computed in the background after writes, see metrics.py.
+    """
+    correction = models.OneToOneField(Correction, on_delete=models.CASCADE, primary_key=True, related_name='metrics')
+    version = models.CharField(max_length=255)  # content_hash of the correction and name of the original
+    ref_words = models.IntegerField(default=0)
+    ref_chars = models.IntegerField(default=0)
+    substitutions = models.IntegerField(default=0)
+    deletions = models.IntegerField(default=0)
+    insertions = models.IntegerField(default=0)
+    char_errors = models.IntegerField(default=0)
+    edit_script = models.JSONField(default=list)  # opcodes [tag, i1, i2, j1, j2] on the words, see alignment.py
+
+    @staticmethod
+    def version_of(correction):
+        return f'{correction.content_hash}:{correction.transcription.trfile.name}'
+
+    @staticmethod
+    def current_version(prefix=''):
+        """
+        Expression of the version_of a correction in queries, prefix is the lookup of the correction, e.g. 'correction__'
+        """
+        return Concat(f'{prefix}content_hash', Value(':'), f'{prefix}transcription__trfile')
+
+    @classmethod
+    def outdated(cls, corrections):
+        """
+        Returns the corrections of the queryset corrections whose metrics are missing or outdated
+        """
+        return corrections.exclude(metrics__version=cls.current_version())
+
+    @classmethod
+    def compute(cls, correction):
+        if not correction.is_untouched() and not correction.content_hash:
+            # written before the content hash was stored
+            with correction.trfile.open('rb') as f:
+                correction.content_hash = hashlib.sha256(f.read()).hexdigest()
+            Correction.objects.filter(pk=correction.pk).update(content_hash=correction.content_hash)
+        result = alignment.compare(correction.transcription.get_content(), correction.get_content())
+        result['edit_script'] = result.pop('opcodes')
+        metrics, _ = cls.objects.update_or_create(correction=correction, defaults=dict(version=cls.version_of(correction), **result))
+        return metrics
+
+    @classmethod
+    def update(cls, corrections):
+        """
+        Recomputes the missing and outdated metrics of the queryset corrections, returns the number of computed metrics
+        """
+        if journal.enabled():
+            # the metrics are cached for the version in the file
+            journal.flush_corrections(lambda ids: corrections.filter(pk__in=ids).values_list('pk', flat=True))
+        computed = 0
+        for correction in cls.outdated(corrections).select_related('transcription'):
+            cls.compute(correction)
+            computed += 1
+        return computed
+
+    @classmethod
+    def get_for(cls, correction):
+        """
+        Returns the up to date metrics of correction
+        """
+        if journal.enabled() and journal.flush(correction.id):
+            correction.refresh_from_db()
+        metrics = cls.objects.filter(correction=correction).first()
+        if metrics is None or metrics.version != cls.version_of(correction):
+            metrics = cls.compute(correction)
+        return metrics
+
+    def get_errors(self):
+        return self.substitutions + self.deletions + self.insertions
+
+    def get_wer(self):
+        return alignment.error_rate(self.get_errors(), self.ref_words)
+
+    def get_cer(self):
+        return alignment.error_rate(self.char_errors, self.ref_chars)
+
+class SearchEntry(models.Model):
+    """
+    Inverted index of the words of transcripts and corrections, see search.py.
+    One entry per term and segment of a document, which is the original if correction is null.
+    """
+    term = models.CharField(max_length=100)
+    shared_folder = models.ForeignKey(transcript_models.SharedFolder, on_delete=models.CASCADE, related_name='+')
+    transcription = models.ForeignKey(transcript_models.Transcription, on_delete=models.CASCADE, related_name='+')
+    correction = models.ForeignKey(Correction, on_delete=models.CASCADE, null=True, related_name='+')
+    segment = models.IntegerField()
+    start = models.FloatField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['term', 'shared_folder']),
+            models.Index(fields=['transcription', 'correction']),
+        ]
 
 
 """
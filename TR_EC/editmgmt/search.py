@@ -0,0 +1,187 @@
+"""
+Full-text search over the words of transcripts and corrections.
+
+SearchEntry is an inverted index with one entry per term and segment of a document, an original or a correction.
+It is maintained incrementally: when a document is written, only the entries of the terms that were added to
+or removed from one of its segments are inserted or deleted. Originals are indexed when their files are written
+(signals.transcripts_written). Corrections are indexed by Correction.write_content, which compares the new content
+with the previous one, so an autosave doesn't read the entries of the correction.
+Untouched corrections have no entries, their content is found as the original.
+"python manage.py rebuildsearchindex" indexes existing documents.
+
+A search only reads the entries of the query terms in the folders of the user, so its cost depends on the
+number of matches and not on the size of the corpus. The segments containing all terms are checked for the phrase,
+a page of CANDIDATES_PER_HIT segments per requested hit at a time.
+"""
+import itertools, logging, re
+from django.db import transaction
+from django.db.models import Count, Q
+from transcriptmgmt import models as transcript_models, signals as transcript_signals, utils as transcript_utils
+from . import models
+
+logger = logging.getLogger(__name__)
+
+TERM = re.compile(r'\w+')
+MAX_TERM_LENGTH = 100
+# number of entries deleted per query, stays below the variable limit of sqlite
+DELETE_BATCH_SIZE = 500
+# segments checked for the phrase per requested hit and page
+CANDIDATES_PER_HIT = 5
+
+
+def terms_of(text):
+    return [term[:MAX_TERM_LENGTH] for term in TERM.findall(text.lower())]
+
+
+def _segment_entries(content):
+    """
+    Returns {segment: set of (term, start)} of content
+    """
+    entries = {}
+    for index, segment in enumerate(content):
+        if not segment:
+            continue
+        start = segment[0]['start']
+        entries[index] = {(term, start) for word in segment for term in terms_of(word['word'])}
+    return entries
+
+
+def _entries(content):
+    """
+    Returns the set of (term, segment, start) of content
+    """
+    return {(term, index, start) for index, terms in _segment_entries(content).items() for term, start in terms}
+
+
+def _update(document, content, **fields):
+    """
+    Brings the entries of a document, the queryset document, up to date with content.
+    fields are the values of new entries besides term, segment and start.
+    """
+    new = _entries(content) if content is not None else set()
+    with transaction.atomic():
+        existing = {}
+        removed = []
+        for pk, term, segment, start in document.values_list('pk', 'term', 'segment', 'start'):
+            key = (term, segment, start)
+            if key in new and key not in existing:
+                existing[key] = pk
+            else:
+                removed.append(pk)
+        for i in range(0, len(removed), DELETE_BATCH_SIZE):
+            models.SearchEntry.objects.filter(pk__in=removed[i:i + DELETE_BATCH_SIZE]).delete()
+        models.SearchEntry.objects.bulk_create([models.SearchEntry(term=term, segment=segment, start=start, **fields)
+                                                for term, segment, start in new if (term, segment, start) not in existing],
+                                               batch_size=500)
+
+
+def index_transcription(transcription):
+    content = transcript_utils.load_content(transcription.trfile, fill_cache=False)
+    _update(models.SearchEntry.objects.filter(transcription=transcription, correction=None), content,
+            shared_folder_id=transcription.shared_folder_id, transcription=transcription)
+
+
+def index_correction(correction, content=None):
+    """
+    Indexes correction, content is its current content if it is already at hand
+    """
+    if content is None and not correction.is_untouched():
+        content = correction.get_content()
+    _update(models.SearchEntry.objects.filter(correction=correction), content,
+            shared_folder_id=correction.transcription.shared_folder_id, transcription_id=correction.transcription_id, correction=correction)
+
+
+def update_correction(correction, previous, content):
+    """
+    Brings the entries of correction from its previous content (None if it was untouched) to content.
+    Only the entries of the changed segments are replaced, the existing entries aren't read.
+    """
+    old = _segment_entries(previous) if previous is not None else {}
+    new = _segment_entries(content)
+    changed = sorted(index for index in old.keys() | new.keys() if old.get(index) != new.get(index))
+    if not changed:
+        return
+    with transaction.atomic():
+        for i in range(0, len(changed), DELETE_BATCH_SIZE):
+            models.SearchEntry.objects.filter(correction=correction, segment__in=changed[i:i + DELETE_BATCH_SIZE]).delete()
+        models.SearchEntry.objects.bulk_create([models.SearchEntry(term=term, segment=index, start=start, correction=correction,
+                                                                   shared_folder_id=correction.transcription.shared_folder_id,
+                                                                   transcription_id=correction.transcription_id)
+                                                for index in changed for term, start in new.get(index, ())], batch_size=500)
+
+
+def transcripts_written(sender, transcriptions, **kwargs):
+    for transcription in transcriptions:
+        try:
+            index_transcription(transcription)
+        except Exception:
+            # the transcript is stored anyway, "python manage.py rebuildsearchindex" indexes it later
+            logger.exception('Indexing transcript %s failed', transcription.pk)
+
+
+def connect_signals():
+    transcript_signals.transcripts_written.connect(transcripts_written, dispatch_uid='editmgmt.search.transcripts_written')
+
+
+def _contains(segment, terms):
+    segment_terms = [(term, word) for word in segment for term in terms_of(word['word'])]
+    for i in range(len(segment_terms) - len(terms) + 1):
+        if all(segment_terms[i + k][0] == term for k, term in enumerate(terms)):
+            return segment_terms[i][1]
+    return None
+
+
+def _hits(candidates, terms, limit):
+    """
+    Returns up to limit hits among candidates, the segments containing all terms, that contain the phrase
+    """
+    transcriptions = transcript_models.Transcription.objects.in_bulk({candidate['transcription'] for candidate in candidates})
+    corrections = models.Correction.objects.select_related('transcription', 'editor') \
+        .in_bulk({candidate['correction'] for candidate in candidates if candidate['correction'] is not None})
+    hits = []
+    for candidate in candidates:
+        transcription = transcriptions[candidate['transcription']]
+        correction = corrections.get(candidate['correction'])
+        document = transcription if correction is None else correction
+        segments, _ = document.get_content_window(candidate['segment'], 1)
+        if not segments:
+            continue
+        segment = segments[0]
+        word = _contains(segment, terms)
+        if word is None:
+            continue
+        hits.append({'transcription': transcription.id, 'title': transcription.title, 'shared_folder': transcription.shared_folder_id,
+                     'correction': correction.id if correction else None, 'editor': correction.editor.username if correction else None,
+                     'segment': candidate['segment'], 'time': word['start'], 'start': segment[0]['start'], 'end': segment[-1]['end'],
+                     'text': ' '.join(word['word'] for word in segment)})
+        if len(hits) >= limit:
+            break
+    return hits
+
+
+def search(user, query, shared_folder_id=None, limit=20):
+    """
+    Returns up to limit segments containing the phrase query, in the documents visible to user:
+    all documents in the folders the user owns, and the originals and own corrections in the folders the user edits
+    """
+    terms = terms_of(query)
+    if not terms:
+        return []
+    # joined instead of listing the folder ids, which can exceed the variable limit of sqlite.
+    # The edited folders are a subquery, a join with the editors would repeat the entries of owned folders per editor.
+    edited = transcript_models.SharedFolder.objects.filter(editor=user).values('pk')
+    scope = Q(shared_folder__owner=user) | \
+        (Q(shared_folder__in=edited) & (Q(correction=None) | Q(correction__editor_id=user.id)))
+    entries = models.SearchEntry.objects.filter(scope, term__in=set(terms))
+    if shared_folder_id is not None:
+        entries = entries.filter(shared_folder=shared_folder_id)
+    candidates = entries.values('transcription', 'correction', 'segment').annotate(matched=Count('term', distinct=True)) \
+        .filter(matched=len(set(terms))).order_by('transcription', 'correction', 'segment')
+    # the candidates are checked page by page, until enough of them contain the phrase or all are checked
+    page_size = limit * CANDIDATES_PER_HIT
+    hits = []
+    for offset in itertools.count(0, page_size):
+        page = list(candidates[offset:offset + page_size])
+        hits.extend(_hits(page, terms, limit - len(hits)))
+        if len(hits) >= limit or len(page) < page_size:
+            return hits
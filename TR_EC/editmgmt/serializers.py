@@ -2,8 +2,8 @@ from django.core import exceptions
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.db.models import fields
 from rest_framework import serializers
-from . import models
-from transcriptmgmt import models as transcript_models
+from . import models, journal
+from transcriptmgmt import models as transcript_models, serializers as transcript_serializers, trformats
 import json
 
 
@@ -35,23 +35,54 @@ class CorrectionCreateSerializer(serializers.ModelSerializer):
 #         read_only_fields = ['editor', 'active_phrase']
 
 
-class CorrectionSerializer(serializers.ModelSerializer):
+class CorrectionSerializer(transcript_serializers.ContentWindowMixin, serializers.ModelSerializer):
 
-    content = serializers.JSONField(source='get_content', read_only=True)
+    content = serializers.SerializerMethodField()  # ?offset=&limit= select a window of segments
+    segment_count = serializers.SerializerMethodField()
     transcription_title = serializers.SerializerMethodField()  # read-only by default
     trfile_json = serializers.JSONField(binary=False, write_only=True)
 
     class Meta:
         model = models.Correction
-        fields = ['id', 'transcription_title', 'finished', 'content', 'trfile_json'] 
+        fields = ['id', 'transcription_title', 'finished', 'content', 'segment_count', 'trfile_json'] 
     
     def get_transcription_title(self, obj):
         return obj.transcription.title
+
+    def validate_trfile_json(self, value):
+        try:
+            trformats.check_segments(value)
+        except ValueError as e:
+            raise serializers.ValidationError(str(e))
+        return value
     
     def update(self, instance, validated_data):
-        # put the json in a file
-        validated_data['trfile'] = SimpleUploadedFile("correction.json", bytes(json.dumps(validated_data.pop('trfile_json')), encoding='utf-8'), content_type='text/json')
-        return super().update(instance, validated_data)
+        # e.g. a PATCH that only marks the correction as finished
+        segments = validated_data.pop('trfile_json', None)
+        if segments is not None:
+            if journal.enabled():
+                # coalesced with the following autosaves, see journal.py
+                journal.append(instance.id, segments)
+            else:
+                instance.write_content(segments)
+        # autosaves usually change nothing else, then the correction isn't saved again
+        if any(getattr(instance, attr) != value for attr, value in validated_data.items()):
+            instance = super().update(instance, validated_data)
+        return instance
+
+
+class CorrectionMetricsSerializer(serializers.ModelSerializer):
+    """
+    to be used by view: CorrectionDiffView
+    for: retrieval of the word error rate, character error rate and edit script of a correction
+    """
+    wer = serializers.FloatField(source='get_wer', read_only=True)
+    cer = serializers.FloatField(source='get_cer', read_only=True)
+
+    class Meta:
+        model = models.CorrectionMetrics
+        fields = ['correction', 'ref_words', 'substitutions', 'deletions', 'insertions', 'wer', 'ref_chars', 'char_errors', 'cer', 'edit_script']
+        read_only_fields = fields
 
 
 class CorrectionPKField(serializers.PrimaryKeyRelatedField):
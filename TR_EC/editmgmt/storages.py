@@ -1,6 +1,13 @@
+import hashlib, os, tempfile, time, uuid
+from django.conf import settings
 from django.core.files import storage
 
 
+def _remove_if_exists(path):
+    if path is not None and os.path.lexists(path):
+        os.remove(path)
+
+
 class OverwriteStorage(storage.default_storage.__class__):
     """
     This provides a file storage policy that overwrites files in the event of equal filenames
@@ -9,4 +16,233 @@ class OverwriteStorage(storage.default_storage.__class__):
     def get_available_name(self, name, max_length=None):
         if self.exists(name):
             self.delete(name)
-        return name
\ No newline at end of file
+        return name
+
+    def replace(self, name, content):
+        """
+        Atomically replaces the file name by content: it is written to a temporary file which is renamed over name,
+        so readers see either the old or the new file and there is no moment without a file.
+        """
+        try:
+            full_path = self.path(name)
+        except NotImplementedError:
+            # not a file system storage, no atomic rename available
+            return self.save(name, content)
+        directory = os.path.dirname(full_path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in content.chunks():
+                    f.write(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+                f.flush()
+                os.fsync(f.fileno())
+            if self.file_permissions_mode is not None:
+                os.chmod(tmp_path, self.file_permissions_mode)
+            os.replace(tmp_path, full_path)
+            tmp_path = None
+        finally:
+            _remove_if_exists(tmp_path)
+        return name
+
+
+class DedupStorage(storage.FileSystemStorage):
+    """
+    Content-addressed file system storage.
+    Every distinct content is stored once as a blob in BLOB_DIR, named by its sha256.
+    The names used by the FileFields are hard links to the blobs, so reading, path() and mmap work as before,
+    and the link count of a blob is its reference count: deleting a name releases one reference.
+    Blobs without references are removed by collect_garbage ("python manage.py collectblobs").
+    Where hard links are not supported, the content is copied, which works but doesn't deduplicate.
+    The modification time of a name is the one of its blob, so it changes when the name gets another content,
+    but not when other names are linked to the same blob. It is used as version by the ETags and the caches.
+    """
+    BLOB_DIR = '.blobs'
+    CHUNK_SIZE = 64 * 1024
+
+    def blob_root(self):
+        return os.path.join(self.location, self.BLOB_DIR)
+
+    def blob_path(self, digest):
+        return os.path.join(self.blob_root(), digest[:2], digest)
+
+    def _write_temp(self, content):
+        """
+        Writes content to a temporary file next to the blobs, returns its path and the sha256 of the content
+        """
+        tmp_dir = os.path.join(self.blob_root(), 'tmp')
+        os.makedirs(tmp_dir, exist_ok=True)
+        digest = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                if hasattr(content, 'temporary_file_path'):
+                    with open(content.temporary_file_path(), 'rb') as src:
+                        chunks = iter(lambda: src.read(self.CHUNK_SIZE), b'')
+                        self._copy(chunks, f, digest)
+                else:
+                    self._copy(content.chunks(self.CHUNK_SIZE), f, digest)
+                f.flush()
+                os.fsync(f.fileno())
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        return tmp_path, digest.hexdigest()
+
+    @staticmethod
+    def _copy(chunks, f, digest):
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            digest.update(chunk)
+            f.write(chunk)
+
+    def _link(self, blob, full_path):
+        try:
+            os.link(blob, full_path)
+        except (FileExistsError, FileNotFoundError):
+            raise
+        except OSError:
+            # no hard links on this file system
+            with open(blob, 'rb') as src, open(full_path, 'xb') as dst:
+                while True:
+                    chunk = src.read(self.CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    dst.write(chunk)
+            if self.file_permissions_mode is not None:
+                os.chmod(full_path, self.file_permissions_mode)
+
+    def _link_blob(self, tmp_path, digest, full_path):
+        """
+        Links the blob of digest to full_path. If the blob doesn't exist yet, tmp_path with the content becomes the blob.
+        Returns tmp_path, or None if it was used.
+        """
+        blob = self.blob_path(digest)
+        try:
+            self._link(blob, full_path)
+        except FileNotFoundError:
+            # a new content, or the blob was just collected as garbage
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            if self.file_permissions_mode is not None:
+                os.chmod(tmp_path, self.file_permissions_mode)
+            os.replace(tmp_path, blob)
+            tmp_path = None
+            self._link(blob, full_path)
+        # the inode is shared by all names of the blob, neither its modification time nor its mode are changed
+        return tmp_path
+
+    def _moves_back(self, digest, full_path):
+        """
+        Returns whether linking the blob of digest to the existing full_path would not give it a newer modification time
+        """
+        try:
+            blob = os.stat(self.blob_path(digest))
+            current = os.stat(full_path)
+        except FileNotFoundError:
+            return False
+        return blob.st_ino != current.st_ino and blob.st_mtime_ns <= current.st_mtime_ns
+
+    def _save(self, name, content):
+        tmp_path, digest = self._write_temp(content)
+        try:
+            while True:
+                name = self.get_available_name(name)
+                full_path = self.path(name)
+                os.makedirs(os.path.dirname(full_path), exist_ok=True)
+                try:
+                    tmp_path = self._link_blob(tmp_path, digest, full_path)
+                    break
+                except FileExistsError:
+                    # the name was taken in the meantime, get_available_name chooses another one
+                    continue
+        finally:
+            _remove_if_exists(tmp_path)
+        return str(name).replace('\\', '/')
+
+    def replace(self, name, content):
+        """
+        Atomically replaces the file name by content: the blob is linked to a temporary name, which is renamed over name.
+        If the blob is older than the file, e.g. a correction is saved with an earlier content again, name gets a copy
+        of its own instead, the modification time of a name mustn't go back.
+        """
+        tmp_path, digest = self._write_temp(content)
+        full_path = self.path(name)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        tmp_link = os.path.join(os.path.dirname(full_path), f'.tmp-{uuid.uuid4().hex}')
+        try:
+            if self._moves_back(digest, full_path):
+                if self.file_permissions_mode is not None:
+                    os.chmod(tmp_path, self.file_permissions_mode)
+                os.replace(tmp_path, tmp_link)
+                tmp_path = None
+            else:
+                tmp_path = self._link_blob(tmp_path, digest, tmp_link)
+            # if both names already are links of the same blob, rename does nothing and tmp_link is removed below
+            os.replace(tmp_link, full_path)
+        finally:
+            _remove_if_exists(tmp_path)
+            _remove_if_exists(tmp_link)
+        return name
+
+    def collect_garbage(self, grace_period=3600):
+        """
+        Removes the blobs that are not referenced by any name anymore.
+        Blobs modified within grace_period seconds are kept, they might be about to be linked by a running save.
+        Returns the number of removed blobs and their size in bytes.
+        """
+        removed, freed = 0, 0
+        root = self.blob_root()
+        if not os.path.isdir(root):
+            return removed, freed
+        limit = time.time() - grace_period
+        for directory, _, filenames in os.walk(root):
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                # temporary files of crashed saves have a link count of 1 as well
+                if stat.st_nlink == 1 and stat.st_mtime < limit:
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        continue
+                    removed += 1
+                    freed += stat.st_size
+        return removed, freed
+
+
+class DedupOverwriteStorage(DedupStorage):
+    """
+    DedupStorage with the overwrite policy of OverwriteStorage
+    """
+
+    def get_available_name(self, name, max_length=None):
+        if self.exists(name):
+            self.delete(name)
+        return name
+
+
+def media_storage():
+    """
+    Storage of audio files and transcripts, deduplicated if settings.MEDIA_DEDUPLICATION is set
+    """
+    if settings.MEDIA_DEDUPLICATION:
+        return dedup_storage
+    return storage.default_storage
+
+
+def correction_storage():
+    """
+    Storage of corrections, deduplicated if settings.MEDIA_DEDUPLICATION is set
+    """
+    if settings.MEDIA_DEDUPLICATION:
+        return dedup_overwrite_storage
+    return overwrite_storage
+
+
+dedup_storage = DedupStorage()
+dedup_overwrite_storage = DedupOverwriteStorage()
+overwrite_storage = OverwriteStorage()
@@ -1,3 +1,545 @@
-from django.test import TestCase
+import io, os, tempfile, threading, zipfile
+from unittest import mock
+from pathlib import Path
+from django.conf import settings
+from django.contrib.auth import models as auth_models
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+from transcriptmgmt import contentcache, models as transcript_models, trformats, utils
+from usermgmt.models import CustomUser
+from . import alignment, consensus, journal, metrics, models, search, storages
 
 # Create your tests here.
+
+
+def segments(text):
+    return [[{'word': word, 'start': 0, 'end': 0} for word in line.split()] for line in text.split('|')]
+
+
+class AlignmentTests(SimpleTestCase):
+
+    def apply(self, a, b, opcodes):
+        result, i = [], 0
+        for _, i1, i2, j1, j2 in opcodes:
+            result += a[i:i1] + b[j1:j2]
+            i = i2
+        return result + a[i:]
+
+    def test_error_counts(self):
+        result = alignment.compare(segments('the cat sat|on the mat'), segments('the cat sat down|on a mat'))
+        self.assertEqual((result['substitutions'], result['deletions'], result['insertions']), (1, 0, 1))
+        self.assertEqual(result['ref_words'], 6)
+        self.assertEqual(result['opcodes'], [['insert', 3, 3, 3, 4], ['replace', 4, 5, 5, 6]])
+
+    def test_unchanged(self):
+        result = alignment.compare(segments('a b|c'), segments('a b|c'))
+        self.assertEqual(result['opcodes'], [])
+        self.assertEqual(result['char_errors'], 0)
+
+    def test_long_transcript(self):
+        original = segments('|'.join(' '.join(f'w{i}_{j}' for j in range(10)) for i in range(3000)))
+        correction = [list(segment) for segment in original]
+        for segment in correction[::7]:
+            segment[3] = {'word': 'fixed'}
+        correction = [[word for segment in correction for word in segment]]  # segments merged as well
+        result = alignment.compare(original, correction)
+        self.assertEqual(result['substitutions'], len(original[::7]))
+        self.assertEqual(result['deletions'] + result['insertions'], 0)
+        a = [word['word'] for segment in original for word in segment]
+        b = [word['word'] for word in correction[0]]
+        self.assertEqual(self.apply(a, b, result['opcodes']), b)
+
+
+    def test_char_errors(self):
+        self.assertEqual(alignment.compare(segments('the cat'), segments('the cats'))['char_errors'], 1)
+        # a rewritten passage counts with the length of the longer side instead of a character diff
+        original = segments(' '.join(f'word{i}' for i in range(2000)))
+        rewritten = segments(' '.join(f'term{i}' for i in range(2000)))
+        with mock.patch.object(alignment, 'diff', wraps=alignment.diff) as diff:
+            result = alignment.compare(original, rewritten)
+        self.assertEqual(result['char_errors'], len(' '.join(word['word'] for word in rewritten[0])))
+        self.assertTrue(all(call.args[2] <= alignment.CHAR_MAX_D for call in diff.call_args_list if isinstance(call.args[0], str)))
+
+
+class ConsensusTests(SimpleTestCase):
+
+    def build(self, original, *corrections):
+        original = segments(original)
+        scripted = [(segments(text), alignment.compare(original, segments(text))['opcodes']) for text in corrections]
+        content, agreement = consensus.build(original, scripted)
+        return '|'.join(' '.join(word['word'] for word in segment) for segment in content), agreement
+
+    def test_majority(self):
+        text, agreement = self.build('a b c|d e', 'a B c|d e', 'a B c|d e x', 'a b|d e x', 'a B c|d e', 'a b c|d e')
+        self.assertEqual(text, 'a B c|d e')
+        self.assertEqual(agreement, [[1.0, 0.6, 0.8], [1.0, 1.0]])
+
+    def test_ties_keep_the_original(self):
+        text, _ = self.build('a b', 'a X', 'a b')
+        self.assertEqual(text, 'a b')
+
+    def test_deleted_segment(self):
+        text, _ = self.build('a|b|c', 'a|c', 'a|c')
+        self.assertEqual(text, 'a|c')
+
+
+class DedupStorageTests(SimpleTestCase):
+
+    def setUp(self):
+        self.storage = storages.DedupStorage(location=tempfile.mkdtemp())
+
+    def mtime(self, name):
+        return os.stat(self.storage.path(name)).st_mtime_ns
+
+    def age(self, name):
+        # an hour older, so a change of the modification time is visible
+        stat = os.stat(self.storage.path(name))
+        os.utime(self.storage.path(name), ns=(stat.st_atime_ns, stat.st_mtime_ns - 3600 * 10 ** 9))
+
+    def test_links_keep_modification_time(self):
+        self.storage.save('a', ContentFile(b'audio'))
+        self.age('a')
+        before = self.mtime('a')
+        self.storage.save('b', ContentFile(b'audio'))
+        self.storage.replace('c', ContentFile(b'audio'))
+        self.assertEqual(self.mtime('a'), before)
+        self.assertTrue(os.path.samefile(self.storage.path('a'), self.storage.path('c')))
+
+    def test_replace_doesnt_move_back(self):
+        self.storage.save('a', ContentFile(b'first'))
+        self.storage.replace('c', ContentFile(b'first'))
+        self.age('a')
+        self.storage.replace('c', ContentFile(b'second'))
+        before = self.mtime('c')
+        # the blob of the first content is older than c now, c gets a file of its own
+        self.storage.replace('c', ContentFile(b'first'))
+        self.assertGreater(self.mtime('c'), before)
+        self.assertFalse(os.path.samefile(self.storage.path('a'), self.storage.path('c')))
+        with self.storage.open('c') as f:
+            self.assertEqual(f.read(), b'first')
+
+
+class ContentTestCase(TestCase):
+    """
+    A publisher with a shared folder and two editors, the transcripts are added with add_transcripts
+    """
+
+    def setUp(self):
+        settings_override = override_settings(MEDIA_ROOT=Path(tempfile.mkdtemp()))
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.publisher = CustomUser.objects.create_user('publisher', password='x')
+        self.publisher.groups.add(auth_models.Group.objects.get_or_create(name='Publisher')[0])
+        self.editor = CustomUser.objects.create_user('editor', password='x')
+        self.other_editor = CustomUser.objects.create_user('other', password='x')
+        self.sf = transcript_models.Folder.objects.create(name='sf', owner=self.publisher).make_shared_folder()
+        self.sf.editor.add(self.editor, self.other_editor)
+
+    def client_of(self, user):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client
+
+    def add_transcripts(self, **texts):
+        """
+        Adds a transcript per keyword argument, title=text as in segments
+        """
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, 'w') as zfile:
+            for title, text in texts.items():
+                zfile.writestr(f'upload/{title}/audio.mp3', b'audio')
+                zfile.writestr(f'upload/{title}/transcript.json', trformats.dumps(segments(text), 'trjson'))
+        with zipfile.ZipFile(archive) as zfile:
+            utils.create_transcriptions_from_zipfile(self.sf.pk, zfile, 'trjson')
+        return {tr.title: tr for tr in self.sf.transcription.all()}
+
+
+class CounterTests(ContentTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.transcriptions = self.add_transcripts(a='hello world', b='good night')
+
+    def stats(self, editor):
+        stats = models.CorrectionStats.objects.filter(shared_folder=self.sf, editor=editor).first()
+        return (stats.started, stats.finished) if stats else None
+
+    def test_correction_counters(self):
+        correction = models.Correction.objects.create(editor=self.editor, transcription=self.transcriptions['a'])
+        models.Correction.objects.create(editor=self.editor, transcription=self.transcriptions['b'], finished=True)
+        self.assertEqual(self.stats(self.editor), (2, 1))
+        correction.finished = True
+        correction.save()
+        self.assertEqual(self.stats(self.editor), (2, 2))
+        correction.delete()
+        self.assertEqual(self.stats(self.editor), (1, 1))
+        self.assertIsNone(self.stats(self.other_editor))
+
+    def test_existing_row(self):
+        # e.g. inserted by a concurrent first correction, the insert of add is skipped without an IntegrityError
+        with transaction.atomic():
+            models.CorrectionStats.add(self.sf.id, self.editor.id, started=1)
+            models.CorrectionStats.add(self.sf.id, self.editor.id, started=1, finished=1)
+        self.assertEqual(self.stats(self.editor), (2, 1))
+
+    def test_transcript_count(self):
+        self.sf.refresh_from_db()
+        self.assertEqual(self.sf.transcript_count, 2)
+        self.transcriptions['a'].delete()
+        self.sf.refresh_from_db()
+        self.assertEqual(self.sf.transcript_count, 1)
+        self.sf.add_to_transcript_count(3)
+        self.sf.refresh_from_db()
+        self.assertEqual(self.sf.transcript_count, 4)
+
+    def test_repaircounters(self):
+        models.Correction.objects.create(editor=self.editor, transcription=self.transcriptions['a'], finished=True)
+        models.CorrectionStats.objects.filter(editor=self.editor).update(started=5, finished=0)
+        models.CorrectionStats.objects.create(shared_folder=self.sf, editor=self.other_editor, started=1)
+        transcript_models.SharedFolder.objects.filter(pk=self.sf.pk).update(transcript_count=7)
+        out = io.StringIO()
+        call_command('repaircounters', stdout=out)
+        self.assertEqual(out.getvalue().strip(), 'Repaired the transcript count of 1 shared folders and 2 correction stats')
+        self.assertEqual((self.stats(self.editor), self.stats(self.other_editor)), ((1, 1), None))
+        self.sf.refresh_from_db()
+        self.assertEqual(self.sf.transcript_count, 2)
+
+
+class CopyOnWriteTests(ContentTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.transcription = self.add_transcripts(a='hello world|again')['a']
+        self.correction = models.Correction.objects.create(editor=self.editor, transcription=self.transcription)
+
+    def test_untouched_reads_the_original(self):
+        self.assertTrue(self.correction.is_untouched())
+        self.assertEqual(self.correction.content_file().name, self.transcription.trfile.name)
+        self.assertEqual(self.correction.get_content(), segments('hello world|again'))
+        self.assertEqual(self.correction.get_content_window(1, 1), (segments('again'), 2))
+        # saved unchanged, it keeps reading the original
+        self.assertFalse(self.correction.write_content(segments('hello world|again')))
+        self.assertTrue(models.Correction.objects.get(pk=self.correction.pk).is_untouched())
+
+    def test_first_write_creates_the_file(self):
+        self.assertTrue(self.correction.write_content(segments('hello there|again')))
+        correction = models.Correction.objects.get(pk=self.correction.pk)
+        self.assertFalse(correction.is_untouched())
+        self.assertNotEqual(correction.content_file().name, self.transcription.trfile.name)
+        self.assertTrue(correction.trfile.storage.exists(correction.trfile.name))
+        self.assertEqual(correction.get_content(), segments('hello there|again'))
+        # the original and the untouched corrections of others are unchanged
+        other = models.Correction.objects.create(editor=self.other_editor, transcription=self.transcription)
+        self.assertEqual(self.transcription.get_content(), segments('hello world|again'))
+        self.assertEqual(other.get_content(), segments('hello world|again'))
+
+
+class ContentWindowTests(ContentTestCase):
+
+    def urls(self, title):
+        transcription = self.add_transcripts(**{title: 'one|two|three|four'})[title]
+        correction = models.Correction.objects.create(editor=self.editor, transcription=transcription)
+        written = models.Correction.objects.create(editor=self.other_editor, transcription=transcription)
+        written.write_content(segments('one|two|three|four|five'))
+        return [(self.publisher, f'/api/pub/transcripts/{transcription.id}/', 4),
+                (self.editor, f'/api/edt/corrections/{correction.id}/', 4),
+                (self.other_editor, f'/api/edt/corrections/{written.id}/', 5)]
+
+    def get(self, user, url, **params):
+        return self.client_of(user).get(url, params)
+
+    def window(self, user, url, **params):
+        response = self.get(user, url, **params)
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        return data['content'], data['segment_count']
+
+    def test_window(self):
+        for format in ('trjson', 'trbin'):
+            with override_settings(TRANSCRIPT_STORAGE_FORMAT=format):
+                for user, url, count in self.urls(format):
+                    with self.subTest(format=format, url=url):
+                        self.assertEqual(self.window(user, url), (segments('one|two|three|four|five')[:count], count))
+                        self.assertEqual(self.window(user, url, offset=1, limit=2), (segments('two|three'), count))
+                        self.assertEqual(self.window(user, url, offset=3, limit=10), (segments('four|five')[:count - 3], count))
+                        self.assertEqual(self.window(user, url, limit=0), ([], count))
+                        self.assertEqual(self.window(user, url, offset=count), ([], count))
+                        self.assertEqual(self.window(user, url, offset=100, limit=1), ([], count))
+
+    def test_invalid_params(self):
+        for user, url, _ in self.urls('a'):
+            for params in [{'offset': -1}, {'limit': -1}, {'offset': 'x'}, {'limit': '1.5'}]:
+                response = self.get(user, url, **params)
+                self.assertEqual(response.status_code, 400, params)
+                self.assertIn(list(params)[0], response.json())
+
+
+@override_settings(CONTENT_CACHE_MAX_SIZE=10 ** 6)
+class ContentCacheTests(ContentTestCase):
+
+    def setUp(self):
+        super().setUp()
+        contentcache.content_cache.clear()
+        self.addCleanup(contentcache.content_cache.clear)
+        self.transcription = self.add_transcripts(a='hello world')['a']
+
+    def keep_version(self, fieldfile, version):
+        # a rewrite within the resolution of the modification time
+        os.utime(fieldfile.storage.path(fieldfile.name), (version[1], version[1]))
+        self.assertEqual(contentcache.content_cache.version(fieldfile), version)
+
+    def test_write_content(self):
+        correction = models.Correction.objects.create(editor=self.editor, transcription=self.transcription)
+        correction.write_content(segments('hello there'))
+        self.assertEqual(correction.get_content(), segments('hello there'))
+        version = contentcache.content_cache.version(correction.trfile)
+        correction.write_content(segments('hello thorn'))
+        self.keep_version(correction.trfile, version)
+        self.assertEqual(correction.get_content(), segments('hello thorn'))
+        self.assertEqual(models.Correction.objects.get(pk=correction.pk).get_content(), segments('hello thorn'))
+
+    def test_replaced_transcript(self):
+        self.assertEqual(self.transcription.get_content(), segments('hello world'))
+        name, version = self.transcription.trfile.name, contentcache.content_cache.version(self.transcription.trfile)
+        self.transcription.delete()
+        self.transcription.trfile.storage.delete(name)
+        transcription = self.add_transcripts(a='hello wield')['a']
+        self.assertEqual(transcription.trfile.name, name)
+        self.keep_version(transcription.trfile, version)
+        self.assertEqual(transcription.get_content(), segments('hello wield'))
+
+
+@override_settings(TRANSCRIPT_STORAGE_FORMAT='trbin')
+class CorrectionUpdateTests(ContentTestCase):
+
+    def setUp(self):
+        super().setUp()
+        transcription = self.add_transcripts(a='hello world')['a']
+        self.correction = models.Correction.objects.create(editor=self.editor, transcription=transcription)
+        self.url = f'/api/edt/corrections/{self.correction.id}/'
+
+    def test_invalid_content(self):
+        client = self.client_of(self.editor)
+        for content in [{'word': 'x'}, [{'word': 'x'}], [[{'word': 'x', 'start': 0}]], [[{'word': 1, 'start': 0, 'end': 1}]],
+                        [[{'word': 'x', 'start': '0', 'end': 1}]], [[{'word': 'x', 'start': True, 'end': 1}]]]:
+            response = client.patch(self.url, {'trfile_json': content}, format='json')
+            self.assertEqual(response.status_code, 400, content)
+            self.assertIn('trfile_json', response.json())
+        self.assertTrue(models.Correction.objects.get(pk=self.correction.pk).is_untouched())
+
+    def test_valid_content(self):
+        response = self.client_of(self.editor).patch(self.url, {'trfile_json': segments('hello there|again')}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(models.Correction.objects.get(pk=self.correction.pk).get_content(), segments('hello there|again'))
+
+    def test_finished_only(self):
+        response = self.client_of(self.editor).patch(self.url, {'finished': True}, format='json')
+        self.assertEqual(response.status_code, 200)
+        correction = models.Correction.objects.get(pk=self.correction.pk)
+        self.assertTrue(correction.finished)
+        self.assertTrue(correction.is_untouched())
+
+
+class SearchTests(ContentTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.transcriptions = self.add_transcripts(a='the quick brown fox|jumps over the lazy dog', b='brown and quick')
+
+    def search(self, user, query, **params):
+        response = self.client_of(user).get('/api/search/', dict(params, q=query))
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_phrase(self):
+        hits = self.search(self.editor, 'Quick Brown')
+        self.assertEqual([(hit['title'], hit['segment'], hit['text']) for hit in hits], [('a', 0, 'the quick brown fox')])
+        self.assertEqual({hit['title'] for hit in self.search(self.editor, 'quick')}, {'a', 'b'})
+        self.assertEqual(self.search(self.editor, 'brown quick fox'), [])
+
+    def test_empty_query(self):
+        response = self.client_of(self.editor).get('/api/search/', {'q': ' ,.'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_incremental_update(self):
+        correction = models.Correction.objects.create(editor=self.editor, transcription=self.transcriptions['a'])
+        # differs from the original, which isn't written
+        correction.write_content(segments('the quick brown fox|jumps over a lazy dog'))
+        entries = models.SearchEntry.objects.filter(correction=correction)
+        before = dict(entries.values_list('term', 'pk'))
+        kept = set(entries.filter(segment=1).values_list('pk', flat=True))
+        with CaptureQueriesContext(connection) as context:
+            correction.write_content(segments('the quick red fox|jumps over a lazy dog'))
+        # only the changed segment is replaced, without reading the entries
+        entry_queries = [query['sql'] for query in context.captured_queries if 'editmgmt_searchentry' in query['sql']]
+        self.assertEqual([sql.split()[0] for sql in entry_queries], ['DELETE', 'INSERT'])
+        after = dict(entries.values_list('term', 'pk'))
+        self.assertNotIn('brown', after)
+        self.assertIn('red', after)
+        self.assertEqual(set(after), set(before) - {'brown'} | {'red'})
+        # the entries of the unchanged segment are kept
+        self.assertEqual(set(entries.filter(segment=1).values_list('pk', flat=True)), kept)
+        self.assertEqual([hit['correction'] for hit in self.search(self.editor, 'quick red')], [correction.id])
+
+    def test_scope(self):
+        correction = models.Correction.objects.create(editor=self.editor, transcription=self.transcriptions['b'])
+        correction.write_content(segments('brown and secret'))
+        outsider = CustomUser.objects.create_user('outsider', password='x')
+        self.assertEqual([hit['editor'] for hit in self.search(self.editor, 'secret')], ['editor'])
+        self.assertEqual([hit['editor'] for hit in self.search(self.publisher, 'secret')], ['editor'])
+        self.assertEqual(self.search(self.other_editor, 'secret'), [])
+        self.assertEqual(len(self.search(self.other_editor, 'brown')), 2)
+        self.assertEqual(self.search(outsider, 'brown'), [])
+        other_sf = transcript_models.Folder.objects.create(name='other', owner=self.publisher).make_shared_folder()
+        self.assertEqual(self.search(self.publisher, 'brown', folder=other_sf.id), [])
+        self.assertEqual(len(self.search(self.publisher, 'brown', folder=self.sf.id)), 3)
+
+    def test_candidates_beyond_the_first_page(self):
+        # the first candidate contains both terms, but not the phrase
+        self.add_transcripts(x='lazy dog dog lazy')
+        with mock.patch.object(search, 'CANDIDATES_PER_HIT', 1):
+            self.assertEqual([hit['title'] for hit in self.search(self.editor, 'dog lazy', limit=1)], ['x'])
+            self.assertEqual(self.search(self.editor, 'fox lazy', limit=1), [])
+
+
+class JournalTests(ContentTestCase):
+
+    def setUp(self):
+        super().setUp()
+        settings_override = override_settings(CORRECTION_WRITE_BEHIND=True, CORRECTION_WRITE_BEHIND_DELAY=0,
+                                              CORRECTION_JOURNAL_ROOT=Path(tempfile.mkdtemp()))
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        transcription = self.add_transcripts(a='hello world')['a']
+        self.correction = models.Correction.objects.create(editor=self.editor, transcription=transcription)
+
+    def test_flusher_rechecks_before_stopping(self):
+        flush_all = journal.flush_all
+        flushes = []
+
+        def flush_all_then_append(min_age=0):
+            result = flush_all(min_age)
+            if not flushes:
+                # an append right after the flush, which sees the flusher alive and doesn't start another one
+                journal.append(self.correction.id, segments('hello there'))
+            flushes.append(result)
+            return result
+
+        flusher = journal.Flusher()
+        # the flusher closes the connection of its thread, here it runs in the thread of the test
+        with mock.patch.object(journal, 'flush_all', flush_all_then_append), mock.patch.object(journal.flusher, 'start'), \
+                mock.patch.object(journal, 'connection'):
+            flusher.run()
+        self.assertEqual(flushes, [(0, 0), (1, 0)])
+        self.assertIsNone(journal.pending_content(self.correction.id))
+        self.assertEqual(models.Correction.objects.get(pk=self.correction.pk).get_content(), segments('hello there'))
+
+    def test_interleaved_flushes(self):
+        # the flushes of two processes, the first one is still writing when the second starts
+        writes, claimed, release = [], threading.Event(), threading.Event()
+
+        def apply(correction_id, path):
+            content = journal._read(path)
+            if not writes:
+                claimed.set()
+                release.wait(5)
+            writes.append(content)
+
+        first, second = segments('hello there'), segments('hello again')
+        with mock.patch.object(journal, '_apply', apply), mock.patch.object(journal.flusher, 'start'):
+            journal.append(self.correction.id, first)
+            thread = threading.Thread(target=journal.flush, args=(self.correction.id,))
+            thread.start()
+            self.assertTrue(claimed.wait(5))
+            # the running flush isn't taken over
+            self.assertEqual(journal.flush_all(), (0, 1))
+            journal.append(self.correction.id, second)
+            other = threading.Thread(target=journal.flush, args=(self.correction.id,))
+            other.start()
+            other.join(0.2)
+            self.assertEqual(writes, [])
+            release.set()
+            thread.join(5)
+            other.join(5)
+        self.assertEqual(writes, [first, second])
+        self.assertEqual(os.listdir(settings.CORRECTION_JOURNAL_ROOT), [])
+
+    def test_interrupted_flush(self):
+        with mock.patch.object(journal.flusher, 'start'):
+            journal.append(self.correction.id, segments('hello there'))
+        claimed = journal._pending_path(self.correction.id)[:-len(journal.PENDING)] + journal.FLUSHING + 'crashed'
+        os.rename(journal._pending_path(self.correction.id), claimed)
+        self.assertEqual(journal.flush_all(), (0, 1))
+        # older than the claim timeout
+        os.utime(claimed, (0, 0))
+        self.assertEqual(journal.flush_all(), (1, 0))
+        self.assertEqual(models.Correction.objects.get(pk=self.correction.pk).get_content(), segments('hello there'))
+        self.assertEqual(os.listdir(settings.CORRECTION_JOURNAL_ROOT), [])
+
+    def test_download_flushes_only_its_folder(self):
+        other_sf = transcript_models.Folder.objects.create(name='other', owner=self.publisher).make_shared_folder()
+        other_sf.editor.add(self.editor)
+        self.sf, sf = other_sf, self.sf
+        other = models.Correction.objects.create(editor=self.editor, transcription=self.add_transcripts(b='good night')['b'])
+        self.sf = sf
+        with mock.patch.object(journal.flusher, 'start'):
+            journal.append(self.correction.id, segments('hello there'))
+            journal.append(other.id, segments('good morning'))
+        response = self.client_of(self.publisher).get(f'/api/pub/sharedfolders/{self.sf.id}/download/')
+        self.assertEqual(response.status_code, 200)
+        b''.join(response.streaming_content)
+        self.assertIsNone(journal.pending_content(self.correction.id))
+        self.assertEqual(journal.pending_content(other.id), segments('good morning'))
+
+
+class MetricsTests(ContentTestCase):
+
+    def setUp(self):
+        super().setUp()
+        transcription = self.add_transcripts(a='hello world')['a']
+        self.correction = models.Correction.objects.create(editor=self.editor, transcription=transcription)
+        self.url = f'/api/pub/sharedfolders/{self.sf.id}/stats/'
+
+    def test_stats_only_read_metrics(self):
+        # without CORRECTION_METRICS_BACKGROUND the write computes them, here the updater is never started
+        self.correction.write_content(segments('hello there'))
+        with mock.patch.object(alignment, 'compare') as compare:
+            stats = self.client_of(self.publisher).get(self.url).json()
+        compare.assert_not_called()
+        self.assertEqual(stats['pending'], 1)
+        self.assertEqual([(user['name'], user['pending']) for user in stats['userstats']], [('editor', 1), ('other', 0)])
+        self.assertFalse(models.CorrectionMetrics.objects.exists())
+
+    @override_settings(CORRECTION_METRICS_BACKGROUND=False)
+    def test_untouched_corrections(self):
+        # e.g. created by opening a transcript, they have no errors
+        models.Correction.objects.create(editor=self.other_editor, transcription=self.correction.transcription)
+        stats = self.client_of(self.publisher).get(self.url).json()
+        self.assertEqual((stats['pending'], stats['wer']), (0, None))
+        self.assertFalse(models.CorrectionMetrics.objects.exists())
+
+    @override_settings(CORRECTION_METRICS_BACKGROUND=False)
+    def test_write_computes_metrics(self):
+        self.correction.write_content(segments('hello there'))
+        stats = self.client_of(self.publisher).get(self.url).json()
+        self.assertEqual(stats['pending'], 0)
+        self.assertEqual(stats['wer'], 0.5)
+        # the metrics of an older version are pending again
+        models.Correction.objects.filter(pk=self.correction.pk).update(content_hash='outdated')
+        self.assertEqual(self.client_of(self.publisher).get(self.url).json()['pending'], 1)
+
+    def test_updater(self):
+        self.correction.write_content(segments('hello there'))
+        updater = metrics.Updater()
+        with mock.patch.object(metrics.threading, 'Thread') as thread, self.captureOnCommitCallbacks(execute=True):
+            updater.schedule([self.correction.id])
+        thread.return_value.start.assert_called_once()
+        # the updater closes the connection of its thread, here it runs in the thread of the test
+        with mock.patch.object(metrics, 'connection'):
+            updater.run()
+        self.assertIsNone(updater._thread)
+        self.assertEqual(models.CorrectionMetrics.objects.get(correction=self.correction).get_wer(), 0.5)
@@ -6,5 +6,7 @@ urlpatterns = [
     path('edt/corrections/', views.CorrectionView.as_view(), name='corrections'),
     path('edt/corrections/<int:pk>/', views.CorrectionRetrieveUpdateView.as_view(), name='correction-update'),
     path('edt/corrections/<int:pk>/download/', views.CorrectionDownloadView.as_view(), name='correction-download'),
+    path('edt/corrections/<int:pk>/diff/', views.CorrectionDiffView.as_view(), name='correction-diff'),
+    path('search/', views.SearchView.as_view(), name='search'),
     # path('edt/edits/', views.EditView.as_view(), name='edits'),
 ]
\ No newline at end of file
@@ -1,9 +1,9 @@
 from django.core import exceptions
 from django import http
 from rest_framework import generics, status, response, exceptions as rf_exceptions, permissions as rf_permissions
-from . import serializers, models
+from . import serializers, models, journal, consensus, search
 from usermgmt import permissions
-from transcriptmgmt import models as transcript_models
+from transcriptmgmt import models as transcript_models, trformats, fileserving
 
 
 class CorrectionView(generics.ListCreateAPIView):
@@ -37,23 +37,131 @@ class CorrectionView(generics.ListCreateAPIView):
 
 class CorrectionRetrieveUpdateView(generics.RetrieveUpdateAPIView):
 
-    queryset = models.Correction.objects.all()
+    queryset = models.Correction.objects.select_related('transcription')
     serializer_class = serializers.CorrectionSerializer
     permission_classes = [rf_permissions.IsAuthenticated, permissions.IsEditor]
 
 
 class CorrectionDownloadView(generics.RetrieveAPIView):
 
-    queryset = models.Correction.objects.all()
+    queryset = models.Correction.objects.select_related('transcription')
     serializer_class = serializers.CorrectionCreateSerializer # Any serializer that identifies SharedFolders would be possible here
     permission_classes = [rf_permissions.IsAuthenticated, permissions.IsEditor | permissions.IsOwner]
 
     def get(self, request, *args, **kwargs):
         instance = self.get_object()
-        resp = http.FileResponse(instance.trfile.open('rb'))
+        tr_format = request.query_params.get('trformat', 'trjson')
+        if tr_format not in trformats.formats:
+            raise rf_exceptions.ValidationError("Invalid format")
+        if journal.enabled() and journal.flush(instance.id):
+            # the download is served from the file, which was just written
+            instance.refresh_from_db()
+        fieldfile = instance.content_file()
+        if tr_format == trformats.format_of(fieldfile.name):
+            return fileserving.serve_fieldfile(request, fieldfile)
+        # the conversion is deterministic, so the converted file can be revalidated like the stored one
+        etag, last_modified = fileserving.validators(fieldfile, variant=tr_format)
+        conditional, headers = fileserving.conditional_response(request, etag, last_modified)
+        if conditional is not None:
+            return conditional
+        extension, _, _ = trformats.formats[tr_format]
+        resp = http.StreamingHttpResponse(instance.stream_content(tr_format), content_type='text/plain; charset=utf-8')
+        resp['Content-Disposition'] = f'attachment; filename="correction.{extension}"'
+        for header, value in headers.items():
+            resp[header] = value
         return resp
 
 
+class CorrectionDiffView(generics.RetrieveAPIView):
+    """
+    url: api/edt/corrections/:id/diff/
+    use: word error rate, character error rate and word-level edit script of a correction compared to the original
+    """
+
+    queryset = models.Correction.objects.select_related('transcription')
+    serializer_class = serializers.CorrectionMetricsSerializer
+    permission_classes = [rf_permissions.IsAuthenticated, permissions.IsEditor | permissions.IsOwner]
+
+    def retrieve(self, request, *args, **kwargs):
+        metrics = models.CorrectionMetrics.get_for(self.get_object())
+        return response.Response(self.get_serializer(metrics).data)
+
+
+def consensus_corrections(request):
+    """
+    The corrections that take part in a consensus, ?finished=true restricts them to finished ones
+    """
+    corrections = models.Correction.objects.all()
+    if request.query_params.get('finished') == 'true':
+        corrections = corrections.filter(finished=True)
+    return corrections
+
+
+class TranscriptConsensusView(generics.RetrieveAPIView):
+    """
+    url: api/pub/transcripts/:id/consensus/?finished=true
+    use: merge the corrections of a transcript by voting, with the agreement of every word
+    """
+
+    queryset = transcript_models.Transcription.objects.all()
+    serializer_class = serializers.CorrectionCreateSerializer  # not used, the consensus is built by consensus.py
+    permission_classes = [rf_permissions.IsAuthenticated, permissions.IsPublisher, permissions.IsOwner]
+
+    def get(self, request, *args, **kwargs):
+        instance = self.get_object()
+        scripted = consensus.scripted_corrections(consensus_corrections(request).filter(transcription=instance))
+        return response.Response({'id': instance.id, 'title': instance.title, **consensus.for_transcription(instance, scripted)})
+
+
+class SharedFolderConsensusView(generics.RetrieveAPIView):
+    """
+    url: api/pub/sharedfolders/:id/consensus/?trformat=vtt&finished=true
+    use: download the consensus of the corrections of all transcripts of a sharedfolder as zip, trformat defaults to trjson
+    """
+
+    queryset = transcript_models.SharedFolder.objects.all()
+    serializer_class = serializers.CorrectionCreateSerializer  # not used, the archive is built by consensus.py
+    permission_classes = [rf_permissions.IsAuthenticated, permissions.IsPublisher, permissions.IsOwner]
+
+    def get(self, request, *args, **kwargs):
+        instance = self.get_object()
+        tr_format = request.query_params.get('trformat', 'trjson')
+        if tr_format not in trformats.formats:
+            raise rf_exceptions.ValidationError("Invalid format")
+        resp = http.StreamingHttpResponse(consensus.stream_zip(instance, consensus_corrections(request), tr_format), content_type='application/zip')
+        resp['Content-Disposition'] = 'attachment; filename="consensus.zip"'
+        return resp
+
+
+class SearchView(generics.GenericAPIView):
+    """
+    url: api/search/?q=phrase&folder=:sharedfolder_id&limit=20
+    use: find the segments of transcripts and corrections containing a phrase, in the folders the user owns or edits
+    """
+
+    permission_classes = [rf_permissions.IsAuthenticated]
+
+    def get_int_param(self, name, default, minimum, maximum):
+        value = self.request.query_params.get(name)
+        if value is None:
+            return default
+        try:
+            value = int(value)
+        except ValueError:
+            value = minimum - 1
+        if not minimum <= value <= maximum:
+            raise rf_exceptions.ValidationError({name: f'Has to be an integer between {minimum} and {maximum}'})
+        return value
+
+    def get(self, request, *args, **kwargs):
+        query = request.query_params.get('q', '')
+        if not search.terms_of(query):
+            raise rf_exceptions.ValidationError({'q': 'Has to contain at least one word'})
+        folder = self.get_int_param('folder', None, 0, 2**63 - 1)
+        limit = self.get_int_param('limit', 20, 1, 100)
+        return response.Response(search.search(request.user, query, folder, limit))
+
+
 # class EditView(generics.CreateAPIView):
 
 #     queryset = models.Edit.objects.all()
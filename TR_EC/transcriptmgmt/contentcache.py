@@ -0,0 +1,100 @@
+"""
+Process-level cache of parsed transcript content.
+
+Several editors open the same original and the publisher views read it again, so the parsed segments of
+transcripts and corrections are kept in a least recently used cache, bounded by settings.CONTENT_CACHE_MAX_SIZE.
+An entry is keyed by the storage name and only used while the size and modification time of the file are unchanged,
+so changes made by other processes are picked up too. Saving a correction and deleting a transcript or correction
+also invalidate the entry explicitly, since a rewrite within the resolution of the modification time, or a new file
+under the same name, could keep both unchanged.
+
+The cached content is shared between requests and must not be modified.
+"""
+import collections, sys, threading
+from django.conf import settings
+
+# rough size in memory of a parsed word: a dict with three keys, the word string and two floats
+WORD_SIZE = sys.getsizeof({'word': '', 'start': 0.0, 'end': 0.0}) + 2 * sys.getsizeof(0.0) + sys.getsizeof('')
+SEGMENT_SIZE = sys.getsizeof([])
+
+
+def estimate_size(content):
+    size = sys.getsizeof(content)
+    for segment in content:
+        size += SEGMENT_SIZE + 8 * len(segment)
+        for word in segment:
+            size += WORD_SIZE + len(word['word'])
+    return size
+
+
+class ContentCache:
+
+    def __init__(self, max_size=None):
+        self._max_size = max_size
+        self.entries = collections.OrderedDict()  # storage name -> (version, content, size)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    @property
+    def max_size(self):
+        return settings.CONTENT_CACHE_MAX_SIZE if self._max_size is None else self._max_size
+
+    @staticmethod
+    def version(fieldfile):
+        storage = fieldfile.storage
+        return storage.size(fieldfile.name), storage.get_modified_time(fieldfile.name).timestamp()
+
+    def get(self, fieldfile, version=None):
+        """
+        Returns the cached content of fieldfile, or None if it isn't cached or outdated
+        """
+        if version is None:
+            version = self.version(fieldfile)
+        with self.lock:
+            entry = self.entries.get(fieldfile.name)
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(fieldfile.name)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, fieldfile, content, version=None):
+        if version is None:
+            version = self.version(fieldfile)
+        size = estimate_size(content)
+        with self.lock:
+            self._remove(fieldfile.name)
+            if size > self.max_size:
+                return
+            self.entries[fieldfile.name] = (version, content, size)
+            self.size += size
+            while self.size > self.max_size:
+                _, (_, _, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+    def invalidate(self, name):
+        with self.lock:
+            self._remove(name)
+
+    def _remove(self, name):
+        entry = self.entries.pop(name, None)
+        if entry is not None:
+            self.size -= entry[2]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'size': self.size, 'max_size': self.max_size,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+content_cache = ContentCache()
@@ -0,0 +1,179 @@
+"""
+Persistent cache for the shared folder download archives.
+
+The cache lives in settings.EXPORT_CACHE_ROOT and has two parts:
+    entries/   one file per version of an archive member, holding its already deflated data
+    archives/  complete archives, one per shared folder, named after the versions they contain
+
+A version of a member is identified by its storage name, size, modification time and export format.
+If none of the members of a shared folder changed, the complete archive is streamed as is.
+Otherwise the archive is spliced together from the cached entries and only new versions are compressed.
+
+All files are written to a temporary file first and then renamed into place,
+so several processes can fill and read the cache at the same time.
+"""
+import hashlib, os, struct, tempfile
+from pathlib import Path
+from django.conf import settings
+from . import zipstream, trformats
+
+# crc, file_size of the uncompressed data. The deflated data follows directly after.
+ENTRY_HEADER = struct.Struct('<LQ')
+
+
+def cache_root():
+    return Path(settings.EXPORT_CACHE_ROOT)
+
+
+def entry_version(fieldfile, format):
+    """
+    Returns a key that changes whenever the content of the file changes, and the modification timestamp
+    """
+    storage = fieldfile.storage
+    mtime = storage.get_modified_time(fieldfile.name)
+    key = f'{fieldfile.name}\0{storage.size(fieldfile.name)}\0{mtime.timestamp()}\0{format}'
+    return hashlib.sha256(key.encode('utf-8')).hexdigest(), mtime.timestamp()
+
+
+def archive_name(folder_id, versions):
+    digest = hashlib.sha256()
+    for arcname, version in versions:
+        digest.update(arcname.encode('utf-8') + b'\0' + version.encode('ascii') + b'\0')
+    return f'{folder_id}-{digest.hexdigest()}.zip'
+
+
+def _replace(tmp_path, path):
+    try:
+        os.replace(tmp_path, path)
+    except OSError:
+        os.remove(tmp_path)
+        raise
+
+
+def open_entry(version, fieldfile, format):
+    """
+    Opens the cached deflated data of fieldfile converted to format. Creates it if it is missing.
+    """
+    path = cache_root()/'entries'/version
+    try:
+        f = open(path, 'rb')
+        os.utime(path)
+        return f
+    except FileNotFoundError:
+        pass
+    os.makedirs(path.parent, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as out:
+        entry = zipstream.ZipEntry('', None, 0)
+        out.write(ENTRY_HEADER.pack(0, 0))
+        with fieldfile.open('rb') as f:
+            stored_format = trformats.format_of(fieldfile.name)
+            source = f if format == stored_format else trformats.convert_stream(f, stored_format, format)
+            for compressed in zipstream.deflate(source, entry):
+                out.write(compressed)
+        out.seek(0)
+        out.write(ENTRY_HEADER.pack(entry.crc, entry.file_size))
+    # the file is opened before it is moved into place, so a concurrent eviction can't remove it under our feet
+    f = open(tmp_path, 'rb')
+    _replace(tmp_path, path)
+    return f
+
+
+def stream_archive(folder_id, members):
+    """
+    Generator that yields the zip archive containing members, a list of (name in zip, FieldFile, format) triples.
+    The content of the FieldFiles is converted from their storage format to format.
+    """
+    root = cache_root()
+    versions = []
+    for arcname, fieldfile, format in members:
+        version, timestamp = entry_version(fieldfile, format)
+        versions.append((arcname, version, timestamp, fieldfile, format))
+    name = archive_name(folder_id, [(arcname, version) for arcname, version, _, _, _ in versions])
+    path = root/'archives'/name
+
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        pass
+    else:
+        with f:
+            os.utime(path)
+            while True:
+                data = f.read(zipstream.CHUNK_SIZE)
+                if not data:
+                    return
+                yield data
+
+    os.makedirs(path.parent, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+    completed = False
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            zs = zipstream.ZipStream()
+            for arcname, version, timestamp, fieldfile, format in versions:
+                with open_entry(version, fieldfile, format) as entry_file:
+                    crc, file_size = ENTRY_HEADER.unpack(entry_file.read(ENTRY_HEADER.size))
+                    compress_size = os.fstat(entry_file.fileno()).st_size - ENTRY_HEADER.size
+                    for chunk in zs.add_raw(arcname, entry_file, crc, file_size, compress_size, timestamp):
+                        out.write(chunk)
+                        yield chunk
+            for chunk in zs.finish():
+                out.write(chunk)
+                yield chunk
+        _replace(tmp_path, path)
+        completed = True
+    finally:
+        if not completed and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    remove_outdated_archives(folder_id, keep=name)
+    evict()
+
+
+def remove_outdated_archives(folder_id, keep=None):
+    """
+    Removes the cached archives of a shared folder, except the one named keep
+    """
+    for path in (cache_root()/'archives').glob(f'{folder_id}-*.zip'):
+        if path.name != keep:
+            _remove(path)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except (FileNotFoundError, PermissionError):
+        # removed by another process or still opened on windows, the next eviction will retry
+        pass
+
+
+def evict(max_size=None):
+    """
+    Removes the least recently used cache files until the cache fits into max_size bytes
+    """
+    if max_size is None:
+        max_size = settings.EXPORT_CACHE_MAX_SIZE
+    files = []
+    total = 0
+    for sub in ('archives', 'entries'):
+        directory = cache_root()/sub
+        if not directory.exists():
+            continue
+        with os.scandir(directory) as it:
+            for dir_entry in it:
+                if dir_entry.name.endswith('.tmp'):
+                    continue
+                try:
+                    stat = dir_entry.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, dir_entry.path))
+                total += stat.st_size
+    if total <= max_size:
+        return
+    files.sort()
+    for _, size, path in files:
+        _remove(path)
+        total -= size
+        if total <= max_size:
+            break
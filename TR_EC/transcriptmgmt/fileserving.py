@@ -0,0 +1,168 @@
+"""
+Serving of stored files with support for conditional and range requests.
+
+serve_fieldfile answers
+    If-None-Match, If-Modified-Since, If-Match, If-Unmodified-Since with 304/412 (via django.utils.cache)
+    Range: bytes=... with 206, several ranges as multipart/byteranges, unsatisfiable ranges with 416
+so that audio players can seek without downloading the whole file again.
+"""
+import hashlib, mimetypes, os, re, uuid
+from django import http
+from django.utils import cache, http as http_utils
+
+CHUNK_SIZE = 64 * 1024
+
+# more ranges than this are answered with the full file, to avoid abuse with lots of tiny ranges
+MAX_RANGES = 50
+
+RANGE_RE = re.compile(r'^\s*(\d*)\s*-\s*(\d*)\s*$')
+
+
+def file_etag(name, size, mtime):
+    key = f'{name}\0{size}\0{mtime.timestamp()}'
+    return '"' + hashlib.sha1(key.encode('utf-8')).hexdigest() + '"'
+
+
+def parse_ranges(header, size):
+    """
+    Parses a Range header into a list of (first byte, last byte) pairs.
+    Returns None if the header is missing, malformed or should be ignored, [] if no range is satisfiable.
+    """
+    if not header:
+        return None
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes' or not spec:
+        return None
+    ranges = []
+    for part in spec.split(','):
+        match = RANGE_RE.match(part)
+        if match is None:
+            return None
+        first, last = match.groups()
+        if first == '' and last == '':
+            return None
+        if first == '':
+            # suffix range: the last n bytes
+            length = int(last)
+            if length == 0 or size == 0:
+                continue
+            ranges.append((max(size - length, 0), size - 1))
+            continue
+        first = int(first)
+        if last != '' and int(last) < first:
+            return None
+        if first >= size:
+            continue
+        last = min(int(last), size - 1) if last != '' else size - 1
+        ranges.append((first, last))
+    if len(ranges) > MAX_RANGES:
+        return None
+    return ranges
+
+
+def if_range_matches(request, etag, last_modified):
+    """
+    A Range header is only applied if If-Range is missing or still matches the file
+    """
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if not if_range:
+        return True
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        return if_range == etag
+    since = http_utils.parse_http_date_safe(if_range)
+    return since is not None and int(last_modified) == since
+
+
+def read_range(f, first, last):
+    f.seek(first)
+    remaining = last - first + 1
+    while remaining > 0:
+        data = f.read(min(CHUNK_SIZE, remaining))
+        if not data:
+            return
+        remaining -= len(data)
+        yield data
+
+
+def stream_ranges(fieldfile, ranges, boundary=None, content_type=None, size=None):
+    """
+    Yields the requested byte ranges of fieldfile, as multipart/byteranges body if a boundary is given
+    """
+    with fieldfile.open('rb') as f:
+        for first, last in ranges:
+            if boundary is not None:
+                yield (f'\r\n--{boundary}\r\nContent-Type: {content_type}\r\n'
+                       f'Content-Range: bytes {first}-{last}/{size}\r\n\r\n').encode('ascii')
+            yield from read_range(f, first, last)
+        if boundary is not None:
+            yield f'\r\n--{boundary}--\r\n'.encode('ascii')
+
+
+def validators(fieldfile, variant=''):
+    """
+    Returns the strong ETag and the Last-Modified timestamp of fieldfile.
+    variant distinguishes different representations of the same file, e.g. export formats.
+    """
+    storage = fieldfile.storage
+    mtime = storage.get_modified_time(fieldfile.name)
+    return file_etag(fieldfile.name + variant, storage.size(fieldfile.name), mtime), int(mtime.timestamp())
+
+
+def conditional_response(request, etag, last_modified):
+    """
+    Returns the 304/412 response for a conditional request, or None if the full response has to be sent.
+    Also returns the validator headers, which belong on every response for the file.
+    """
+    headers = {
+        'ETag': etag,
+        'Last-Modified': http_utils.http_date(last_modified),
+        # the files are only accessible for authenticated users, but browsers may revalidate them with the ETag
+        'Cache-Control': 'private, no-cache',
+    }
+    base = http.HttpResponse()
+    for header, value in headers.items():
+        base[header] = value
+    resp = cache.get_conditional_response(request, etag=etag, last_modified=last_modified, response=base)
+    return (None if resp is base else resp), headers
+
+
+def serve_fieldfile(request, fieldfile, as_attachment=False):
+    """
+    Returns a response for the file of a FileField that supports conditional and range requests
+    """
+    size = fieldfile.storage.size(fieldfile.name)
+    etag, last_modified = validators(fieldfile)
+    conditional, headers = conditional_response(request, etag, last_modified)
+    if conditional is not None:
+        return conditional
+    content_type = mimetypes.guess_type(fieldfile.name)[0] or 'application/octet-stream'
+    filename = os.path.basename(fieldfile.name)
+    headers['Accept-Ranges'] = 'bytes'
+    headers['Content-Disposition'] = f'{"attachment" if as_attachment else "inline"}; filename="{filename}"'
+
+    ranges = None
+    if request.method in ('GET', 'HEAD') and if_range_matches(request, etag, last_modified):
+        ranges = parse_ranges(request.META.get('HTTP_RANGE'), size)
+
+    if ranges == []:
+        resp = http.HttpResponse(status=416)
+        resp['Content-Range'] = f'bytes */{size}'
+        return resp
+
+    if ranges is None:
+        resp = http.StreamingHttpResponse(stream_ranges(fieldfile, [(0, size - 1)]) if size else [], content_type=content_type)
+        resp['Content-Length'] = str(size)
+    elif len(ranges) == 1:
+        first, last = ranges[0]
+        resp = http.StreamingHttpResponse(stream_ranges(fieldfile, ranges), status=206, content_type=content_type)
+        resp['Content-Range'] = f'bytes {first}-{last}/{size}'
+        resp['Content-Length'] = str(last - first + 1)
+    else:
+        boundary = uuid.uuid4().hex
+        resp = http.StreamingHttpResponse(stream_ranges(fieldfile, ranges, boundary, content_type, size), status=206,
+                                          content_type=f'multipart/byteranges; boundary={boundary}')
+    for header, value in headers.items():
+        resp[header] = value
+    if request.method == 'HEAD':
+        resp.streaming_content = []
+    return resp
@@ -0,0 +1,96 @@
+"""
+Background processing of uploaded transcript archives.
+
+PubTranscriptMultiUploadView only stores the archive and creates an IngestionJob.
+The jobs are picked up by the workers started with "python manage.py ingestworkers",
+the database table acts as the queue, so no message broker is needed.
+"""
+import logging, threading, traceback, zipfile
+from datetime import timedelta
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+from . import models, utils
+
+logger = logging.getLogger(__name__)
+
+
+def fail_stale_jobs():
+    """
+    Marks running jobs as failed, if their worker didn't report progress for INGESTION_STALE_TIMEOUT seconds
+    """
+    limit = timezone.now() - timedelta(seconds=settings.INGESTION_STALE_TIMEOUT)
+    return models.IngestionJob.objects.filter(status=models.IngestionJob.RUNNING, heartbeat__lt=limit).update(
+        status=models.IngestionJob.FAILED, error='The worker processing this job stopped responding', finished=timezone.now())
+
+
+def claim_next_job():
+    """
+    Returns the oldest pending job after marking it as running, or None if there is no pending job.
+    The status update only succeeds for one worker, so a job is never processed twice.
+    """
+    while True:
+        job = models.IngestionJob.objects.filter(status=models.IngestionJob.PENDING).order_by('created').first()
+        if job is None:
+            return None
+        now = timezone.now()
+        claimed = models.IngestionJob.objects.filter(pk=job.pk, status=models.IngestionJob.PENDING).update(
+            status=models.IngestionJob.RUNNING, started=now, heartbeat=now)
+        if claimed:
+            job.refresh_from_db()
+            return job
+
+
+def run_job(job):
+    try:
+        with job.zfile.open('rb') as f:
+            with zipfile.ZipFile(f, mode='r') as zfile:
+                utils.create_transcriptions_from_zipfile(job.shared_folder_id, zfile, job.format, progress=job)
+        job.status = models.IngestionJob.DONE
+    except Exception as e:
+        logger.error('Ingestion job %s failed\n%s', job.pk, traceback.format_exc())
+        job.status = models.IngestionJob.FAILED
+        job.error = f'{type(e).__name__}: {e}'
+    job.finished = timezone.now()
+    # the archive is not needed anymore
+    job.zfile.delete(save=False)
+    models.IngestionJob.objects.filter(pk=job.pk).update(status=job.status, error=job.error, finished=job.finished, zfile='')
+
+
+def work(stop_event=None, poll_interval=None, once=False):
+    """
+    Processes jobs until stop_event is set.
+    With once=True it returns as soon as there is no pending job left.
+    """
+    if stop_event is None:
+        stop_event = threading.Event()
+    if poll_interval is None:
+        poll_interval = settings.INGESTION_POLL_INTERVAL
+    while not stop_event.is_set():
+        fail_stale_jobs()
+        job = claim_next_job()
+        if job is not None:
+            run_job(job)
+            continue
+        if once:
+            return
+        stop_event.wait(poll_interval)
+
+
+def _work_in_thread(*args):
+    try:
+        work(*args)
+    finally:
+        connection.close()
+
+
+def start_workers(num_workers, stop_event, poll_interval=None, once=False):
+    """
+    Starts num_workers threads that process jobs, each of them uses its own database connection
+    """
+    threads = []
+    for i in range(num_workers):
+        thread = threading.Thread(target=_work_in_thread, name=f'ingestworker-{i}', args=(stop_event, poll_interval, once), daemon=True)
+        thread.start()
+        threads.append(thread)
+    return threads
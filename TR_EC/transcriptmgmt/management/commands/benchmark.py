@@ -0,0 +1,228 @@
+import json, math, platform, subprocess, time, uuid
+import django
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Count
+from django.test.utils import CaptureQueriesContext, override_settings
+from rest_framework.test import APIClient
+from transcriptmgmt import ingest, models, synthetic
+from editmgmt import models as edit_models
+
+PERCENTILES = (50, 90, 95, 99)
+
+
+def percentile(values, p):
+    """
+    Nearest-rank percentile of the sorted list values
+    """
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def read_bytes():
+    """
+    Bytes read by this process so far (rchar, which includes the reads of the database), None if unknown
+    """
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=settings.BASE_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = 'Measures the latency, database queries and bytes read of the main endpoints on a dataset of generatedata'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--prefix', default='synthetic', help='prefix of the users generated by generatedata')
+        parser.add_argument('--repeat', type=int, default=20, help='measured requests per endpoint')
+        parser.add_argument('--warmup', type=int, default=2, help='unmeasured requests per endpoint before')
+        parser.add_argument('--only', nargs='+', help='names of the endpoints to measure')
+        parser.add_argument('--upload-transcripts', type=int, default=5, help='transcripts per multiupload archive')
+        parser.add_argument('--json', help='file to write the results to as JSON, - for stdout')
+        parser.add_argument('--compare', help='JSON results of an earlier run, e.g. of another commit, to compare with')
+
+    def handle(self, *args, **kwargs):
+        if kwargs['repeat'] < 1:
+            raise CommandError('At least one measured request is needed')
+        self.setup(kwargs['prefix'], kwargs['upload_transcripts'])
+        cases = self.cases()
+        names = kwargs['only'] or list(cases)
+        unknown = set(names) - set(cases)
+        if unknown:
+            raise CommandError(f"Unknown endpoints {', '.join(sorted(unknown))}, choose from {', '.join(cases)}")
+
+        results = {}
+        # the test client uses the host testserver
+        with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']):
+            try:
+                for name in names:
+                    results[name] = self.measure(cases[name], kwargs['warmup'], kwargs['repeat'])
+            finally:
+                self.upload_folder.delete()
+        report = {
+            'commit': commit(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'settings': {name: getattr(settings, name, None) for name in
+                         ['TRANSCRIPT_STORAGE_FORMAT', 'MEDIA_DEDUPLICATION', 'CORRECTION_WRITE_BEHIND', 'CONTENT_CACHE_MAX_SIZE']},
+            'dataset': self.dataset,
+            'repeat': kwargs['repeat'],
+            'results': results,
+        }
+        if kwargs['json'] == '-':
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+        if kwargs['json']:
+            with open(kwargs['json'], 'w') as f:
+                json.dump(report, f, indent=2)
+        baseline = None
+        if kwargs['compare']:
+            with open(kwargs['compare']) as f:
+                baseline = json.load(f)['results']
+        self.print_table(results, baseline)
+
+    def setup(self, prefix, upload_transcripts):
+        """
+        Picks the users and objects of the dataset the requests are made with
+        """
+        User = get_user_model()
+        self.publisher = User.objects.filter(username=f'{prefix}-pub0').first()
+        if self.publisher is None:
+            raise CommandError(f'No dataset with the prefix {prefix}, create it with "python manage.py generatedata"')
+        self.shared_folder = models.SharedFolder.objects.filter(owner=self.publisher).order_by('-transcript_count', 'pk').first()
+        if self.shared_folder is None:
+            raise CommandError('The dataset has no shared folder')
+        self.editor = self.shared_folder.editor.annotate(n=Count('correction')).order_by('-n', 'pk').first()
+        if self.editor is None:
+            raise CommandError('The shared folder has no editors')
+        self.transcriptions = list(self.shared_folder.transcription.values_list('pk', flat=True))
+        self.corrections = list(edit_models.Correction.objects.filter(editor=self.editor, transcription__shared_folder=self.shared_folder)
+                                .values_list('pk', flat=True))
+        if not self.transcriptions or not self.corrections:
+            raise CommandError('The shared folder has no transcripts or corrections of its editors')
+        # the uploads go to a folder of their own, which is deleted afterwards
+        root = models.Folder.objects.filter(owner=self.publisher, parent=None).first()
+        self.upload_folder = models.Folder.objects.create(name=f'benchmark-{uuid.uuid4().hex[:8]}', owner=self.publisher, parent=root) \
+            .make_shared_folder()
+        generator = synthetic.Generator()
+        self.archive = generator.archive([f'upload{i}' for i in range(upload_transcripts)]).getvalue()
+        self.contents = [generator.segments(100, 8) for _ in range(2)]
+        self.dataset = {
+            'users': User.objects.filter(username__startswith=prefix + '-').count(),
+            'folders': models.Folder.objects.filter(owner__username__startswith=prefix + '-').count(),
+            'shared_folders': models.SharedFolder.objects.filter(owner__username__startswith=prefix + '-').count(),
+            'transcripts': models.Transcription.objects.filter(shared_folder__owner__username__startswith=prefix + '-').count(),
+            'corrections': edit_models.Correction.objects.filter(editor__username__startswith=prefix + '-').count(),
+        }
+        self.publisher_client = APIClient()
+        self.publisher_client.force_authenticate(self.publisher)
+        self.editor_client = APIClient()
+        self.editor_client.force_authenticate(self.editor)
+
+    def cases(self):
+        """
+        Returns {name: function making the i-th request of the endpoint}
+        """
+        pc, ec, sf = self.publisher_client, self.editor_client, self.shared_folder.pk
+
+        def nth(pks, i):
+            return pks[i % len(pks)]
+
+        def upload(i):
+            return pc.post('/api/pub/transcripts/multiupload/', {'shared_folder': self.upload_folder.pk, 'format': 'vtt',
+                                                                'zfile': SimpleUploadedFile('upload.zip', self.archive)}, format='multipart')
+
+        def ingestion(i):
+            upload(i)
+            ingest.work(once=True)
+
+        return {
+            'folder_listing': lambda i: pc.get('/api/folders/'),
+            'folder_tree': lambda i: pc.get('/api/pub/folders/tree/'),
+            'editor_listing': lambda i: pc.get(f'/api/sharedfolders/{sf}/'),
+            'transcript_listing': lambda i: ec.get(f'/api/edt/sharedfolders/{sf}/'),
+            'transcript_content': lambda i: pc.get(f'/api/pub/transcripts/{nth(self.transcriptions, i)}/'),
+            'correction_content': lambda i: ec.get(f'/api/edt/corrections/{nth(self.corrections, i)}/'),
+            # alternates between two contents, a save of unchanged content writes nothing
+            'correction_save': lambda i: ec.patch(f'/api/edt/corrections/{nth(self.corrections, i // 2)}/',
+                                                  {'trfile_json': self.contents[i % 2]}, format='json'),
+            'stats': lambda i: pc.get(f'/api/pub/sharedfolders/{sf}/stats/'),
+            'zip_download': lambda i: pc.get(f'/api/pub/sharedfolders/{sf}/download/'),
+            'multiupload': (upload, self.clear_uploads),
+            'ingestion': (ingestion, self.clear_uploads),
+        }
+
+    def clear_uploads(self):
+        self.upload_folder.transcription.all().delete()
+        # jobs that weren't processed still have their archive
+        for job in models.IngestionJob.objects.filter(shared_folder=self.upload_folder):
+            job.zfile.delete(save=False)
+            job.delete()
+
+    def measure(self, case, warmup, repeat):
+        request, cleanup = case if isinstance(case, tuple) else (case, None)
+        latencies, queries, response_bytes, read = [], [], [], []
+        # the bytes of reading /proc/self/io itself
+        start = read_bytes()
+        overhead = read_bytes() - start if start is not None else 0
+        for i in range(warmup + repeat):
+            before = read_bytes()
+            with CaptureQueriesContext(connection) as context:
+                start = time.perf_counter()
+                response = request(i)
+                size = 0
+                if response is not None:
+                    if response.status_code >= 400:
+                        raise CommandError(f'{response.status_code} {response.request["PATH_INFO"]}: {response.content[:200]}')
+                    # a streaming response is only produced while it is consumed, iterating also works for async bodies
+                    size = len(b''.join(response))
+                latency = time.perf_counter() - start
+            after = read_bytes()
+            if cleanup is not None:
+                cleanup()
+            if i < warmup:
+                continue
+            latencies.append(latency * 1000)
+            queries.append(len(context.captured_queries))
+            response_bytes.append(size)
+            if before is not None:
+                read.append(after - before - overhead)
+        latencies.sort()
+        return {
+            'latency_ms': dict({f'p{p}': round(percentile(latencies, p), 3) for p in PERCENTILES},
+                               min=round(latencies[0], 3), max=round(latencies[-1], 3), mean=round(sum(latencies) / repeat, 3)),
+            'queries': {'mean': sum(queries) / repeat, 'max': max(queries)},
+            'response_bytes': sum(response_bytes) // repeat,
+            'read_bytes': sum(read) // repeat if read else None,
+        }
+
+    def print_table(self, results, baseline):
+        header = f"{'endpoint':<20}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'queries':>9}{'response':>11}{'read':>11}"
+        if baseline is not None:
+            header += f"{'base p50':>10}{'change':>9}"
+        self.stdout.write(header)
+        for name, result in results.items():
+            latency = result['latency_ms']
+            line = (f"{name:<20}{latency['p50']:>10.2f}{latency['p90']:>10.2f}{latency['p99']:>10.2f}{result['queries']['mean']:>9.1f}"
+                    f"{result['response_bytes']:>11}{result['read_bytes'] if result['read_bytes'] is not None else '-':>11}")
+            if baseline is not None:
+                base = baseline.get(name, {}).get('latency_ms', {}).get('p50')
+                if base:
+                    line += f"{base:>10.2f}{(latency['p50'] - base) / base:>+9.0%}"
+                else:
+                    line += f"{'-':>10}{'-':>9}"
+            self.stdout.write(line)
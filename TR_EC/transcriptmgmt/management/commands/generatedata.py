@@ -0,0 +1,87 @@
+import zipfile
+from django.contrib.auth import get_user_model, hashers, models as auth_models
+from django.core.management.base import BaseCommand, CommandError
+from transcriptmgmt import models, synthetic, trformats, utils
+from editmgmt import models as edit_models
+
+# transcripts per generated archive, bounds the memory use
+ARCHIVE_SIZE = 50
+
+
+class Command(BaseCommand):
+    help = 'Generates a synthetic dataset of publishers, editors, folders, transcripts and corrections, e.g. for benchmarks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--prefix', default='synthetic', help='prefix of the generated usernames')
+        parser.add_argument('--publishers', type=int, default=2)
+        parser.add_argument('--editors', type=int, default=10)
+        parser.add_argument('--folders', type=int, default=2, help='subfolders per folder')
+        parser.add_argument('--depth', type=int, default=2, help='levels of folders below the root folder of a publisher, the last level are shared folders')
+        parser.add_argument('--editors-per-folder', type=int, default=3)
+        parser.add_argument('--transcripts', type=int, default=5, help='transcripts per shared folder')
+        parser.add_argument('--segments', type=int, default=100, help='segments per transcript')
+        parser.add_argument('--words', type=int, default=8, help='average number of words per segment')
+        parser.add_argument('--format', default='vtt', help='format in which the transcripts are uploaded')
+        parser.add_argument('--audio-size', type=int, default=65536, help='bytes per audio file')
+        parser.add_argument('--corrections', type=int, default=2, help='corrections per transcript, at most the editors of its folder')
+        parser.add_argument('--edit-rate', type=float, default=0.05, help='share of the words changed by a correction')
+        parser.add_argument('--password', default='synthetic', help='password of the generated users')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--clear', action='store_true', help='delete the users with the prefix and their data first')
+
+    def handle(self, *args, **kwargs):
+        prefix = kwargs['prefix']
+        if kwargs['format'] not in trformats.formats:
+            raise CommandError(f"Unknown format {kwargs['format']}")
+        if min(kwargs['publishers'], kwargs['folders'], kwargs['depth']) < 1:
+            raise CommandError('At least one publisher, folder and level of folders are needed')
+        users = get_user_model().objects.filter(username__startswith=prefix + '-')
+        if kwargs['clear']:
+            users.delete()
+        elif users.exists():
+            raise CommandError(f'Users with the prefix {prefix} exist already, use --clear to replace them')
+        generator = synthetic.Generator(kwargs['seed'])
+
+        password = hashers.make_password(kwargs['password'])
+        publishers = self.create_users([f'{prefix}-pub{i}' for i in range(kwargs['publishers'])], password)
+        editors = self.create_users([f'{prefix}-ed{i}' for i in range(kwargs['editors'])], password)
+        group, _ = auth_models.Group.objects.get_or_create(name='Publisher')
+        group.user_set.add(*publishers)
+
+        shared_folders = []
+        for publisher in publishers:
+            root = models.Folder.objects.create(name=prefix, owner=publisher)
+            self.create_folders(root, kwargs['folders'], kwargs['depth'], shared_folders)
+        transcripts = corrections = 0
+        for sf in shared_folders:
+            folder_editors = generator.random.sample(editors, min(kwargs['editors_per_folder'], len(editors)))
+            sf.editor.add(*folder_editors)
+            titles = [f'transcript{i:04d}' for i in range(kwargs['transcripts'])]
+            for i in range(0, len(titles), ARCHIVE_SIZE):
+                archive = generator.archive(titles[i:i + ARCHIVE_SIZE], kwargs['format'], kwargs['segments'], kwargs['words'], kwargs['audio_size'])
+                with zipfile.ZipFile(archive) as zfile:
+                    utils.create_transcriptions_from_zipfile(sf.pk, zfile, kwargs['format'])
+            for transcription in sf.transcription.all():
+                transcripts += 1
+                original = transcription.get_content()
+                for editor in generator.random.sample(folder_editors, min(kwargs['corrections'], len(folder_editors))):
+                    correction = edit_models.Correction(transcription=transcription, editor=editor, finished=generator.random.random() < 0.5)
+                    correction.save()
+                    correction.write_content(generator.correct(original, kwargs['edit_rate']))
+                    corrections += 1
+        self.stdout.write(f"Generated {len(publishers)} publishers, {len(editors)} editors, {len(shared_folders)} shared folders, "
+                          f"{transcripts} transcripts and {corrections} corrections")
+
+    def create_users(self, usernames, password):
+        User = get_user_model()
+        User.objects.bulk_create([User(username=username, password=password) for username in usernames])
+        # bulk_create doesn't set the primary keys on every database
+        return list(User.objects.filter(username__in=usernames).order_by('username'))
+
+    def create_folders(self, parent, count, depth, shared_folders):
+        for i in range(count):
+            folder = models.Folder.objects.create(name=f'folder{i}', owner=parent.owner, parent=parent)
+            if depth == 1:
+                shared_folders.append(folder.make_shared_folder())
+            else:
+                self.create_folders(folder, count, depth - 1, shared_folders)
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from transcriptmgmt import ingest
+import threading
+
+
+class Command(BaseCommand):
+    help = 'Runs the workers that create transcripts from uploaded archives'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=settings.INGESTION_WORKERS, help='number of worker threads')
+        parser.add_argument('--poll-interval', type=float, default=settings.INGESTION_POLL_INTERVAL, help='seconds to wait when the queue is empty')
+        parser.add_argument('--once', action='store_true', help='exit as soon as there are no pending jobs')
+
+    def handle(self, *args, **kwargs):
+        if kwargs['workers'] < 1:
+            raise CommandError('At least one worker is needed')
+        stop_event = threading.Event()
+        threads = ingest.start_workers(kwargs['workers'], stop_event, kwargs['poll_interval'], kwargs['once'])
+        self.stdout.write(f"Started {len(threads)} ingestion workers")
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(1)
+        except KeyboardInterrupt:
+            self.stdout.write("Stopping, running jobs are finished first")
+            stop_event.set()
+            for thread in threads:
+                thread.join()
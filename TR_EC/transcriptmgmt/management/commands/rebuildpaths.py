@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from transcriptmgmt import models
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the materialized paths of all folders, e.g. for folders created before paths were stored'
+
+    def handle(self, *args, **kwargs):
+        with transaction.atomic():
+            folders = {folder.pk: folder for folder in models.Folder.objects.select_related('owner')}
+            computed = {}
+
+            def compute(folder):
+                # iterative, so deep hierarchies don't hit the recursion limit
+                chain = []
+                while folder.pk not in computed:
+                    chain.append(folder)
+                    if folder.parent_id is None:
+                        break
+                    folder = folders[folder.parent_id]
+                for folder in reversed(chain):
+                    if folder.parent_id is None:
+                        computed[folder.pk] = (f'{folder.owner.username}/{folder.name}', '')
+                    else:
+                        parent_path, parent_ancestors = computed[folder.parent_id]
+                        computed[folder.pk] = (f'{parent_path}/{folder.name}', f'{parent_ancestors}{folder.parent_id}/')
+
+            changed = []
+            for folder in folders.values():
+                compute(folder)
+                if (folder.path, folder.ancestors) != computed[folder.pk]:
+                    folder.path, folder.ancestors = computed[folder.pk]
+                    changed.append(folder)
+            models.Folder.objects.bulk_update(changed, ['path', 'ancestors'], batch_size=500)
+        self.stdout.write(f"Rebuilt the paths of {len(changed)} folders")
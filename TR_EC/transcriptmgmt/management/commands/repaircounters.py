@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+from transcriptmgmt import models
+from editmgmt import models as edit_models
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the transcript counts of shared folders and the correction stats of editors'
+
+    def handle(self, *args, **kwargs):
+        with transaction.atomic():
+            transcript_counts = models.Transcription.objects.filter(shared_folder=OuterRef('pk')).order_by() \
+                .values('shared_folder').annotate(n=Count('pk')).values('n')
+            drifted = models.SharedFolder.objects.exclude(transcript_count=Coalesce(Subquery(transcript_counts), 0)).count()
+            models.SharedFolder.objects.update(transcript_count=Coalesce(Subquery(transcript_counts), 0))
+
+            actual = {}
+            counts = edit_models.Correction.objects.order_by().values('transcription__shared_folder', 'editor') \
+                .annotate(started=Count('pk'), finished=Count('pk', filter=Q(finished=True)))
+            for row in counts:
+                actual[(row['transcription__shared_folder'], row['editor'])] = (row['started'], row['finished'])
+            stored = {(stats.shared_folder_id, stats.editor_id): stats for stats in edit_models.CorrectionStats.objects.all()}
+
+            repaired = 0
+            for key, stats in stored.items():
+                if key not in actual:
+                    # all corrections were deleted, empty rows are not a drift
+                    repaired += bool(stats.started or stats.finished)
+                    stats.delete()
+                elif (stats.started, stats.finished) != actual[key]:
+                    stats.started, stats.finished = actual[key]
+                    stats.save()
+                    repaired += 1
+            missing = [edit_models.CorrectionStats(shared_folder_id=sf_id, editor_id=editor_id, started=started, finished=finished)
+                       for (sf_id, editor_id), (started, finished) in actual.items() if (sf_id, editor_id) not in stored]
+            edit_models.CorrectionStats.objects.bulk_create(missing)
+            repaired += len(missing)
+        self.stdout.write(f"Repaired the transcript count of {drifted} shared folders and {repaired} correction stats")
@@ -2,11 +2,15 @@ from django.db import models, transaction
 from django.core.files import base
 from django.core.files.storage import default_storage
 from django.contrib import auth
-from django.db.models import constraints
-from . import utils
-from usermgmt import models as user_models
+from django.utils import timezone
+from django.db.models import constraints, signals, Value
+from django.db.models.functions import Concat, Substr
+from django.dispatch import receiver
+from . import utils, contentcache, exportcache, trformats
+from usermgmt import models as user_models, authcontext
 #from editmgmt import models as edit_models
-import zipfile, re, json
+from editmgmt import storages, journal
+import zipfile, re, json, uuid, time
 from pathlib import Path
 #from google.cloud.storage import Blob
 
@@ -15,6 +19,10 @@ class Folder(models.Model):
     name = models.CharField(max_length=250)
     owner = models.ForeignKey(auth.get_user_model(), on_delete=models.CASCADE, related_name='folder')  
     parent = models.ForeignKey('self', on_delete=models.CASCADE, related_name='subfolder', blank=True, null=True)
+    # materialized paths, kept consistent by save on creation, rename and move
+    # path: owner username and folder names, e.g. "pub/a/b", ancestors: ids of the parents from the top, e.g. "1/5/"
+    path = models.TextField(editable=False, default='')
+    ancestors = models.CharField(max_length=1000, editable=False, default='', db_index=True)
 
     class Meta:
         ordering = ['owner', 'name']
@@ -31,7 +39,19 @@ class Folder(models.Model):
         return self.name
     
     def save(self, *args, **kwargs):
-        super().save(*args, **kwargs)
+        with transaction.atomic():
+            old = None
+            if not self._state.adding:
+                old = Folder.objects.filter(pk=self.pk).values_list('path', 'ancestors').first()
+            self.path, self.ancestors = self.compute_path()
+            super().save(*args, **kwargs)
+            if old is not None and old != (self.path, self.ancestors):
+                # renamed or moved, the subtree follows with one update
+                old_path, old_ancestors = old
+                self.get_subtree(old_ancestors + f'{self.pk}/').update(
+                    path=Concat(Value(self.path), Substr('path', len(old_path) + 1)),
+                    ancestors=Concat(Value(self.ancestors), Substr('ancestors', len(old_ancestors) + 1)),
+                )
         # TODO test, if this is actually not needed, then omit the save method
         # if self.is_shared_folder() and not isinstance(self, SharedFolder):
         #     sf = self.sharedfolder
@@ -40,7 +60,7 @@ class Folder(models.Model):
 
     #Used for permission checks
     def is_owner(self, user):
-        return self.owner == user
+        return self.owner_id == user.id
 
     def get_parent_name(self):
         if self.parent == None:
@@ -53,8 +73,28 @@ class Folder(models.Model):
         """
         return hasattr(self, 'sharedfolder')
     
+    def compute_path(self):
+        """
+        Returns path and ancestors of this folder, derived from its parent
+        """
+        if self.parent_id is None:
+            return f'{self.owner.username}/{self.name}', ''
+        parent = self.parent
+        return f'{parent.path}/{self.name}', f'{parent.ancestors}{parent.pk}/'
+
+    def get_subtree(self, prefix=None):
+        """
+        Returns a queryset of all folders below this folder, at any depth
+        """
+        if prefix is None:
+            prefix = f'{self.ancestors}{self.pk}/'
+        return Folder.objects.filter(ancestors__startswith=prefix)
+
+    def get_depth(self):
+        return self.ancestors.count('/')
+
     def get_path(self):
-        return utils.folder_relative_path(self)
+        return self.path
 
     def make_shared_folder(self):
         if self.is_shared_folder():
@@ -85,13 +125,18 @@ def log_upload_path(instance, filename):
 
 class SharedFolder(Folder):
     editor = models.ManyToManyField(auth.get_user_model(), related_name='sharedfolder', blank=True)
+    # maintained on creation and deletion of transcripts, can be recomputed with "python manage.py repaircounters"
+    transcript_count = models.IntegerField(default=0)
 
     def save(self, *args, **kwargs):
         super().save(*args, **kwargs)
 
+    def add_to_transcript_count(self, n):
+        SharedFolder.objects.filter(pk=self.pk).update(transcript_count=models.F('transcript_count') + n)
+
     #Used for permission checks
     def is_editor(self, user):
-        return self.editor.filter(id=user.id).exists()
+        return authcontext.get(user).can_edit_folder(self.id)
     
     def make_shared_folder(self):
         return self
@@ -101,16 +146,21 @@ class SharedFolder(Folder):
         return path + utils.NAME_ID_SPLITTER + str(self.id)
 
     def get_readable_path(self):
-        path = super().get_path()
-        return path
-
-    def create_zip_for_download(self):
-        zip_path = self.get_path()+'/download.zip'
-        with default_storage.open(zip_path, 'wb') as f:
-            with zipfile.ZipFile(f, 'w') as zf:
-                for transcript in self.transcription.all():
-                    transcript.write_to_zip(zf)
-        return zip_path
+        return self.path
+
+    def stream_zip_for_download(self, format='trjson'):
+        """
+        Generator that yields the download zip of this shared folder chunk by chunk.
+        The transcripts are exported in the given format (see trformats.formats).
+        Unchanged files are taken from the export cache, so only new versions are compressed.
+        """
+        if journal.enabled():
+            # the archive is built from the files, so pending autosaves of this folder have to be written first
+            journal.flush_corrections(lambda ids: self.transcription.filter(correction__in=ids).values_list('correction', flat=True))
+        entries = []
+        for transcript in self.transcription.prefetch_related('correction__editor'):
+            entries.extend(transcript.zip_entries(format))
+        return exportcache.stream_archive(self.id, entries)
                     
 
     
@@ -119,7 +169,7 @@ def tr_upload_path(instance, filename):
     """
     Generates the upload path for a transcript
     """
-    sf_path = Path(instance.shared_folder.sharedfolder.get_path())
+    sf_path = Path(instance.shared_folder.get_path())
     path = sf_path/instance.title/filename
     return path
 
@@ -128,8 +178,8 @@ class Transcription(models.Model):
     title = models.CharField(max_length=100)
     shared_folder = models.ForeignKey(SharedFolder, on_delete=models.CASCADE, related_name='transcription')
 
-    srcfile = models.FileField(upload_to=tr_upload_path)
-    trfile = models.FileField(upload_to=tr_upload_path)  # text + timestamps as json
+    srcfile = models.FileField(upload_to=tr_upload_path, storage=storages.media_storage)
+    trfile = models.FileField(upload_to=tr_upload_path, storage=storages.media_storage)  # text + timestamps in the storage format
 
     class Meta:
         ordering = ['shared_folder', 'title']
@@ -147,24 +197,35 @@ class Transcription(models.Model):
     
     #Used for permission checks
     def is_owner(self, user):
-        return self.shared_folder.is_owner(user)
+        return authcontext.get(user).owns_folder(self.shared_folder_id)
 
     #Used for permission checks
     def is_editor(self, user):
-        return self.shared_folder.is_editor(user)
+        return authcontext.get(user).can_edit_folder(self.shared_folder_id)
 
     def save(self, *args, **kwargs):
-        super().save(*args, **kwargs)
+        with transaction.atomic():
+            adding = self._state.adding
+            super().save(*args, **kwargs)
+            if adding:
+                SharedFolder(pk=self.shared_folder_id).add_to_transcript_count(1)
     
     def get_content(self):
-        return json.load(self.trfile)
+        return utils.load_content(self.trfile)
+
+    def get_content_window(self, offset=0, limit=None):
+        return utils.load_content_window(self.trfile, offset, limit)
     
-    def write_to_zip(self, file: zipfile.ZipFile):
-        with self.trfile.open('rb') as tr_file:
-            file.writestr(self.title+'/original.json', tr_file.read())
+    def zip_entries(self, format='trjson'):
+        """
+        Returns the files of this transcript that go into the download zip as (name in zip, FieldFile, format) triples
+        """
+        extension, _, _ = trformats.formats[format]
+        entries = [(self.title+'/original.'+extension, self.trfile, format)]
         for correction in self.correction.all():
-            with correction.trfile.open('rb') as tr_file:
-                file.writestr(self.title+'/correction_'+correction.editor.username+'.json', tr_file.read())
+            # untouched corrections share the file, and with it the export cache entry, of the original
+            entries.append((self.title+'/correction_'+correction.editor.username+'.'+extension, correction.content_file(), format))
+        return entries
 
     # def phrase_count(self):
     #     return self.phrases.count()
@@ -210,6 +271,144 @@ class Transcription(models.Model):
     #                     self.phrases.create(content=json_obj['content'], index=index+1, start=float(json_obj['start']), end=float(json_obj['end']))
 
 
+@receiver(signals.pre_save, sender=user_models.CustomUser)
+def user_renamed(sender, instance, **kwargs):
+    # the username is the first part of the path of every folder
+    update_fields = kwargs.get('update_fields')
+    if instance.pk is None or (update_fields is not None and 'username' not in update_fields):
+        # e.g. the update of last_login on every login
+        return
+    old_username = user_models.CustomUser.objects.filter(pk=instance.pk).values_list('username', flat=True).first()
+    if old_username is not None and old_username != instance.username:
+        Folder.objects.filter(owner=instance).update(path=Concat(Value(instance.username), Substr('path', len(old_username) + 1)))
+
+
+@receiver(signals.post_delete, sender=Transcription)
+def transcription_deleted(sender, instance, **kwargs):
+    # also sent for bulk and cascading deletes, which don't call Transcription.delete
+    SharedFolder(pk=instance.shared_folder_id).add_to_transcript_count(-1)
+    # a transcript replacing this one can get the same name, with a file of the same size and modification time
+    contentcache.content_cache.invalidate(instance.trfile.name)
+
+
+def ingestion_upload_path(instance, filename):
+    """
+    Generates the upload path for the archive of an ingestion job
+    """
+    return Path('ingestion')/f'{uuid.uuid4().hex}.zip'
+
+class IngestionJob(models.Model):
+    """
+    An uploaded zip archive whose transcripts are created in the background by the ingestion workers (see ingest.py)
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [(PENDING, 'Pending'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed')]
+
+    owner = models.ForeignKey(auth.get_user_model(), on_delete=models.CASCADE, related_name='ingestionjob')
+    shared_folder = models.ForeignKey(SharedFolder, on_delete=models.CASCADE, related_name='ingestionjob')
+    format = models.CharField(max_length=50)
+    zfile = models.FileField(upload_to=ingestion_upload_path)
+
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    error = models.TextField(blank=True)
+    total = models.IntegerField(default=0)
+    processed = models.IntegerField(default=0)
+    failed = models.IntegerField(default=0)
+
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(blank=True, null=True)
+    finished = models.DateTimeField(blank=True, null=True)
+    # updated regularly by the worker, used to detect jobs of crashed workers
+    heartbeat = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        ordering = ['created']
+        indexes = [
+            models.Index(fields=['status', 'created']),
+        ]
+
+    #Used for permission checks
+    def is_owner(self, user):
+        return self.owner_id == user.id
+
+    def get_throughput(self):
+        """
+        Returns the number of transcripts handled per second
+        """
+        if self.started is None:
+            return 0.0
+        end = self.finished if self.finished is not None else timezone.now()
+        elapsed = (end - self.started).total_seconds()
+        if elapsed <= 0:
+            return 0.0
+        return (self.processed + self.failed) / elapsed
+
+    # the following methods are the progress interface used by utils.create_transcriptions_from_zipfile
+    # results are buffered and written in batches, so large archives don't cost two queries per transcript
+
+    REPORT_BATCH_SIZE = 200
+    REPORT_INTERVAL = 1  # seconds
+
+    def set_total(self, total):
+        self.total = total
+        self._pending_items = []
+        self._last_flush = time.monotonic()
+        IngestionJob.objects.filter(pk=self.pk).update(total=total, heartbeat=timezone.now())
+
+    def report(self, title, duration, error=None, convert_duration=None):
+        """
+        Records the result of a single transcript of the archive
+        """
+        status = IngestionItem.FAILED if error else IngestionItem.DONE
+        self._pending_items.append(IngestionItem(job=self, title=title, status=status, error=error or '',
+                                                 duration=duration, convert_duration=convert_duration))
+        if len(self._pending_items) >= self.REPORT_BATCH_SIZE or time.monotonic() - self._last_flush >= self.REPORT_INTERVAL:
+            self.flush()
+
+    def keep_alive(self):
+        """
+        Updates the heartbeat while transcripts are processed but not reported yet, see ingest.fail_stale_jobs
+        """
+        if time.monotonic() - self._last_flush >= self.REPORT_INTERVAL:
+            self._last_flush = time.monotonic()
+            IngestionJob.objects.filter(pk=self.pk).update(heartbeat=timezone.now())
+
+    def flush(self):
+        items = self._pending_items
+        self._pending_items = []
+        self._last_flush = time.monotonic()
+        if not items:
+            return
+        IngestionItem.objects.bulk_create(items)
+        failed = len([item for item in items if item.status == IngestionItem.FAILED])
+        self.processed += len(items) - failed
+        self.failed += failed
+        IngestionJob.objects.filter(pk=self.pk).update(processed=models.F('processed') + len(items) - failed,
+                                                       failed=models.F('failed') + failed, heartbeat=timezone.now())
+
+
+class IngestionItem(models.Model):
+    """
+    The result of a single transcript of an IngestionJob
+    """
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [(DONE, 'Done'), (FAILED, 'Failed')]
+
+    job = models.ForeignKey(IngestionJob, on_delete=models.CASCADE, related_name='items')
+    title = models.CharField(max_length=100)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES)
+    error = models.TextField(blank=True)
+    duration = models.FloatField()  # seconds
+    convert_duration = models.FloatField(blank=True, null=True)  # seconds spent in the format conversion
+
+    class Meta:
+        ordering = ['job', 'id']
+
+
 
 # class Phrase(models.Model):
 #     transcription = models.ForeignKey(Transcription, on_delete=models.CASCADE, related_name='phrases')
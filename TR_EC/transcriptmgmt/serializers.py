@@ -1,8 +1,9 @@
-from django.db.models import fields
+from django.db.models import fields, Count, F, FilteredRelation, Q, Sum
+from django.db.models.functions import Coalesce
 from rest_framework import serializers
 from . import models, utils
 from usermgmt import models as user_models, serializers as user_serializers
-from editmgmt import models as edit_models
+from editmgmt import models as edit_models, alignment
 
 import django.core.files.uploadedfile as uploadedfile
 
@@ -57,6 +58,24 @@ class FolderBasicSerializer(serializers.ModelSerializer):
         fields = ['id', 'name', 'is_sharedfolder']
         read_only_fields = ['name']
 
+class FolderTreeSerializer(serializers.ModelSerializer):
+    """
+    to be used by view: PubFolderTreeView
+    for: one node of the folder tree, the folders have to be annotated with is_sharedfolder and transcript_count
+    """
+    is_sharedfolder = serializers.BooleanField(read_only=True)
+    transcript_count = serializers.IntegerField(read_only=True)  # None for folders that aren't shared folders
+
+    class Meta:
+        model = models.Folder
+        fields = ['id', 'name', 'parent', 'is_sharedfolder', 'transcript_count']
+        read_only_fields = fields
+
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        data['subfolder'] = []
+        return data
+
 class FolderDetailedSerializer(serializers.ModelSerializer):
     """
     to be used by view: PubFolderDetailView
@@ -80,19 +99,57 @@ class SharedFolderPKField(serializers.PrimaryKeyRelatedField):
         return queryset
 
 
-class TranscriptionFullSerializer(serializers.ModelSerializer):
+class ContentWindowMixin:
+    """
+    Provides the fields content and segment_count for serializers of objects with get_content_window.
+    The query params offset and limit select a window of segments, by default all segments are returned.
+    """
+
+    def get_window(self, obj):
+        windows = self.__dict__.setdefault('_windows', {})
+        if obj.pk not in windows:
+            offset, limit = self.get_window_params()
+            windows[obj.pk] = obj.get_content_window(offset, limit)
+        return windows[obj.pk]
+
+    def get_window_params(self):
+        request = self.context.get('request')
+        if request is None:
+            return 0, None
+        params = []
+        for name in ('offset', 'limit'):
+            value = request.query_params.get(name)
+            try:
+                value = int(value) if value is not None else None
+            except ValueError:
+                value = -1
+            if value is not None and value < 0:
+                raise serializers.ValidationError({name: 'Has to be a non-negative integer'})
+            params.append(value)
+        offset, limit = params
+        return offset or 0, limit
+
+    def get_content(self, obj):
+        return self.get_window(obj)[0]
+
+    def get_segment_count(self, obj):
+        return self.get_window(obj)[1]
+
+
+class TranscriptionFullSerializer(ContentWindowMixin, serializers.ModelSerializer):
     """
     to be used by view: PubTranscriptListView, PubTranscriptDetailedView, EditTranscriptDetailedView
     for: transcription creation and retrieval
     """
     #content = serializers.ListField(source='get_meta_content', read_only=True)
-    content = serializers.JSONField(source='get_content', read_only=True)
+    content = serializers.SerializerMethodField()  # ?offset=&limit= select a window of segments
+    segment_count = serializers.SerializerMethodField()
     shared_folder = SharedFolderPKField()
     format = serializers.CharField(write_only=True)
 
     class Meta:
         model = models.Transcription
-        fields = ['id', 'title', 'shared_folder', 'srcfile', 'trfile', 'content', 'format']
+        fields = ['id', 'title', 'shared_folder', 'srcfile', 'trfile', 'content', 'segment_count', 'format']
         extra_kwargs = {'srcfile': {'write_only': True}, 'trfile': {'write_only': True}}
     
     def validate(self, data):
@@ -122,23 +179,18 @@ class TranscriptionBasicSerializer(serializers.ModelSerializer):
 
 class EditTranscriptionInfoSerializer(serializers.ModelSerializer):
     """
+    Expects the transcripts to be annotated with editor_correction_id and editor_correction_finished
+    of the correction of request.user, see EditTranscriptListView
     """
-    correction = serializers.SerializerMethodField()
+    correction = serializers.IntegerField(source='editor_correction_id', read_only=True)
     finished = serializers.SerializerMethodField()
 
     class Meta:
         model = models.Transcription
         fields = ['id', 'title', 'correction', 'finished']
     
-    def get_correction(self, obj):
-        user = self.context['request'].user
-        correction = obj.get_correction_from(user)
-        return correction.id if correction is not None else correction
-    
     def get_finished(self, obj):
-        user = self.context['request'].user
-        correction = obj.get_correction_from(user)
-        return correction.finished if correction is not None else False
+        return bool(obj.editor_correction_finished)
 
 
 class EditSharedFolderTranscriptSerializer(serializers.ModelSerializer):
@@ -171,26 +223,111 @@ class SharedFolderEditorSerializer(serializers.ModelSerializer):
 
 
 class SharedFolderStatsSerializer(serializers.ModelSerializer):
-
+    """
+    to be used by view: PubSharedFolderStatsView
+    for: number of transcripts, started and finished corrections per editor, word and character error rates
+    of the corrections compared to the originals per editor and for the whole shared folder.
+    The error rates only read the CorrectionMetrics of the written corrections, the ones whose metrics aren't computed yet
+    (see editmgmt/metrics.py) are counted as pending. Untouched corrections are left out.
+    """
     numOfTexts = serializers.SerializerMethodField(read_only=True)
     userstats = serializers.SerializerMethodField(read_only=True)
+    wer = serializers.SerializerMethodField(read_only=True)
+    cer = serializers.SerializerMethodField(read_only=True)
+    pending = serializers.SerializerMethodField(read_only=True)
 
     class Meta:
         model = models.SharedFolder
-        fields = ['numOfTexts', 'userstats']
+        fields = ['numOfTexts', 'userstats', 'wer', 'cer', 'pending']
     
     def get_numOfTexts(self, obj):
-        return models.Transcription.objects.filter(shared_folder=obj).count()
+        return obj.transcript_count
+
+    def get_metric_totals(self, obj):
+        """
+        Returns {editor id: written corrections, the ones with up to date metrics and their summed error counts}
+        of the corrections in obj, computed in one query
+        """
+        if '_metric_totals' not in self.__dict__:
+            current = Q(metrics__version=edit_models.CorrectionMetrics.current_version())
+            total = lambda expression: Coalesce(Sum(expression, filter=current), 0)
+            totals = edit_models.Correction.objects.filter(transcription__shared_folder=obj).exclude(trfile='').order_by() \
+                .values('editor').annotate(
+                    written=Count('pk'), corrections=Count('metrics', filter=current), words=total('metrics__ref_words'),
+                    errors=total(F('metrics__substitutions') + F('metrics__deletions') + F('metrics__insertions')),
+                    chars=total('metrics__ref_chars'), char_errors=total('metrics__char_errors'))
+            self._metric_totals = {row.pop('editor'): row for row in totals}
+        return self._metric_totals
+
+    @staticmethod
+    def error_rates(totals):
+        return {"wer": alignment.error_rate(totals['errors'], totals['words']),
+                "cer": alignment.error_rate(totals['char_errors'], totals['chars'])}
 
     def get_userstats(self, obj):
-        res = []
-        transcriptions = models.Transcription.objects.filter(shared_folder=obj)
-        for editor in obj.editor.all():
-            res.append({
-                "name": editor.username,
-                "finished": edit_models.Correction.objects.filter(editor=editor, transcription__in=transcriptions, finished=True).count()
-            })
-        return res
+        # one query for all editors, the counts are maintained in CorrectionStats
+        editors = obj.editor.annotate(
+            folder_stats=FilteredRelation('correction_stats', condition=Q(correction_stats__shared_folder=obj)),
+        ).values_list('id', 'username', 'folder_stats__started', 'folder_stats__finished')
+        metric_totals = self.get_metric_totals(obj)
+        empty = {'written': 0, 'corrections': 0, 'words': 0, 'errors': 0, 'chars': 0, 'char_errors': 0}
+        userstats = []
+        self._pending = 0
+        for editor_id, username, started, finished in editors:
+            totals = metric_totals.get(editor_id, empty)
+            pending = totals['written'] - totals['corrections']
+            self._pending += pending
+            userstats.append({"name": username, "started": started or 0, "finished": finished or 0,
+                              "words": totals['words'], "errors": totals['errors'], "pending": pending, **self.error_rates(totals)})
+        return userstats
+
+    def get_folder_rates(self, obj):
+        totals = {key: sum(row[key] for row in self.get_metric_totals(obj).values()) for key in ('words', 'errors', 'chars', 'char_errors')}
+        return self.error_rates(totals)
+
+    def get_wer(self, obj):
+        return self.get_folder_rates(obj)['wer']
+
+    def get_cer(self, obj):
+        return self.get_folder_rates(obj)['cer']
+
+    def get_pending(self, obj):
+        # counted by get_userstats
+        if '_pending' not in self.__dict__:
+            self.get_userstats(obj)
+        return self._pending
+
+class IngestionItemSerializer(serializers.ModelSerializer):
+    """
+    to be used by: IngestionJobSerializer
+    """
+    class Meta:
+        model = models.IngestionItem
+        fields = ['title', 'status', 'error', 'duration', 'convert_duration']
+        read_only_fields = fields
+
+
+class IngestionJobSerializer(serializers.ModelSerializer):
+    """
+    to be used by view: PubIngestionJobView
+    for: retrieval of the progress of a multiupload.
+    The view is polled, so it only returns the counts and the first FAILED_ITEMS failed items, not every transcript.
+    """
+    FAILED_ITEMS = 100
+
+    failed_items = serializers.SerializerMethodField(read_only=True)
+    throughput = serializers.FloatField(source='get_throughput', read_only=True)  # transcripts per second
+
+    class Meta:
+        model = models.IngestionJob
+        fields = ['id', 'shared_folder', 'format', 'status', 'error', 'total', 'processed', 'failed',
+                  'created', 'started', 'finished', 'throughput', 'failed_items']
+        read_only_fields = fields
+
+    def get_failed_items(self, obj):
+        items = obj.items.filter(status=models.IngestionItem.FAILED)[:self.FAILED_ITEMS]
+        return IngestionItemSerializer(items, many=True).data
+
 
 class EditPublisherSerializer(serializers.ModelSerializer):
     """
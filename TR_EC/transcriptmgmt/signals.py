@@ -0,0 +1,4 @@
+from django.dispatch import Signal
+
+# sent with transcriptions, a list of Transcriptions, after their transcript files were written
+transcripts_written = Signal()
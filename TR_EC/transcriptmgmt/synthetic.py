@@ -0,0 +1,86 @@
+"""
+Synthetic transcripts for "python manage.py generatedata" and "python manage.py benchmark".
+
+The words are drawn from a generated vocabulary with a Zipf distribution, like the words of natural language,
+so the content compresses, deduplicates and aligns like real transcripts. Everything depends on the seed
+of the random generator, so the same options generate the same dataset.
+"""
+import io, itertools, random, zipfile
+from . import trformats
+
+SYLLABLES = ['ka', 'to', 're', 'mi', 'lo', 'sa', 'ne', 'di', 'pu', 'ga', 'be', 'vo', 'shi', 'an', 'er', 'in', 'ou', 'ta']
+VOCABULARY_SIZE = 5000
+
+
+class Generator:
+    """
+    Generates transcripts and corrections of them with a random.Random seeded with seed
+    """
+
+    def __init__(self, seed=0):
+        self.random = random.Random(seed)
+        vocabulary = set()
+        while len(vocabulary) < VOCABULARY_SIZE:
+            vocabulary.add(''.join(self.random.choices(SYLLABLES, k=self.random.randint(1, 4))))
+        self.vocabulary = sorted(vocabulary)
+        self.random.shuffle(self.vocabulary)
+        self.cum_weights = list(itertools.accumulate(1 / rank for rank in range(1, VOCABULARY_SIZE + 1)))
+
+    def words(self, count):
+        return self.random.choices(self.vocabulary, cum_weights=self.cum_weights, k=count)
+
+    def segments(self, count, words_per_segment):
+        """
+        Returns a transcript of count segments with about words_per_segment words each, in the trjson structure
+        """
+        segments = []
+        time = 0.0
+        for _ in range(count):
+            segment = []
+            for word in self.words(max(1, round(self.random.gauss(words_per_segment, words_per_segment / 4)))):
+                end = time + self.random.uniform(0.15, 0.6)
+                segment.append({'word': word, 'start': round(time, 2), 'end': round(end, 2)})
+                time = end
+            segments.append(segment)
+            # pause between segments
+            time += self.random.uniform(0.3, 1.5)
+        return segments
+
+    def correct(self, segments, edit_rate):
+        """
+        Returns a copy of segments in which about edit_rate of the words are substituted, deleted or followed by an insertion
+        """
+        corrected = []
+        for segment in segments:
+            words = []
+            for word in segment:
+                if self.random.random() >= edit_rate:
+                    words.append(dict(word))
+                    continue
+                kind = self.random.random()
+                if kind < 0.6:
+                    words.append(dict(word, word=self.words(1)[0]))
+                elif kind < 0.8:
+                    continue
+                else:
+                    words.extend([dict(word), dict(word, word=self.words(1)[0])])
+            if words:
+                corrected.append(words)
+        return corrected
+
+    def audio(self, size):
+        return self.random.randbytes(size) if hasattr(self.random, 'randbytes') else bytes(self.random.getrandbits(8) for _ in range(size))
+
+    def archive(self, titles, format='vtt', segments=100, words_per_segment=8, audio_size=65536):
+        """
+        Returns a zip archive as expected by the multiupload, with an audio file and a transcript in format per title
+        """
+        extension, _, _ = trformats.formats[format]
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w') as zfile:
+            for title in titles:
+                zfile.writestr(f'upload/{title}/audio.mp3', self.audio(audio_size))
+                zfile.writestr(f'upload/{title}/transcript.{extension}',
+                               trformats.dumps(self.segments(segments, words_per_segment), format))
+        buffer.seek(0)
+        return buffer
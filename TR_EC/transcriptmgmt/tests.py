@@ -1,3 +1,392 @@
-from django.test import TestCase
+import io, os, random, struct, tempfile, zipfile
+from pathlib import Path
+from unittest import mock, skipIf
+from django.contrib.auth import models as auth_models
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.db import IntegrityError, connection
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework.test import APIClient
+from usermgmt.models import CustomUser
+from editmgmt import storages
+from editmgmt.models import Correction
+from . import exportcache, fileserving, ingest, models, signals, synthetic, trbin, trformats, utils, zipstream
 
 # Create your tests here.
+
+
+class EditTranscriptListViewTests(TestCase):
+
+    def setUp(self):
+        self.publisher = CustomUser.objects.create_user('publisher', password='x')
+        self.editor = CustomUser.objects.create_user('editor', password='x')
+        self.other_editor = CustomUser.objects.create_user('other', password='x')
+        root = models.Folder.objects.create(name='root', owner=self.publisher)
+        self.sf = models.Folder.objects.create(name='sf', owner=self.publisher, parent=root).make_shared_folder()
+        self.sf.editor.add(self.editor, self.other_editor)
+        self.client = APIClient()
+        self.client.force_authenticate(self.editor)
+
+    def add_transcripts(self, start, stop):
+        transcripts = models.Transcription.objects.bulk_create(
+            [models.Transcription(title=f'text{i}', shared_folder=self.sf) for i in range(start, stop)])
+        # the listing reads no files, so the transcripts and untouched corrections are inserted without any
+        Correction.objects.bulk_create([Correction(editor=self.editor, transcription=tr, finished=i % 2 == 0)
+                                        for i, tr in enumerate(transcripts) if i % 3 != 0])
+        Correction.objects.bulk_create([Correction(editor=self.other_editor, transcription=tr, finished=True)
+                                        for tr in transcripts])
+
+    def get(self):
+        resp = self.client.get(reverse('sharedfolder-detail', args=[self.sf.id]))
+        self.assertEqual(resp.status_code, 200)
+        return resp.json()
+
+    def test_query_count_is_constant(self):
+        self.add_transcripts(0, 3)
+        with self.assertNumQueries(3):
+            self.get()
+        self.add_transcripts(3, 30)
+        with self.assertNumQueries(3):
+            data = self.get()
+        self.assertEqual(len(data['transcripts']), 30)
+
+    def test_only_own_corrections(self):
+        self.add_transcripts(0, 6)
+        own = {c.transcription_id: c for c in Correction.objects.filter(editor=self.editor)}
+        for transcript in self.get()['transcripts']:
+            correction = own.get(transcript['id'])
+            self.assertEqual(transcript['correction'], correction.id if correction else None)
+            self.assertEqual(transcript['finished'], correction.finished if correction else False)
+
+
+class FolderTreeTests(TestCase):
+
+    def setUp(self):
+        self.publisher = CustomUser.objects.create_user('publisher', password='x')
+        self.publisher.groups.add(auth_models.Group.objects.get_or_create(name='Publisher')[0])
+        self.root = models.Folder.objects.create(name='root', owner=self.publisher)
+        self.sub = models.Folder.objects.create(name='sub', owner=self.publisher, parent=self.root)
+        self.sf = models.Folder.objects.create(name='sf', owner=self.publisher, parent=self.sub).make_shared_folder()
+        models.Folder.objects.create(name='other', owner=CustomUser.objects.create_user('other', password='x'))
+        self.client = APIClient()
+        self.client.force_authenticate(self.publisher)
+
+    def get(self, **params):
+        return self.client.get(reverse('folder-tree'), params)
+
+    def names(self, nodes):
+        return [(node['name'], self.names(node['subfolder'])) for node in nodes]
+
+    def test_shape(self):
+        data = self.get().json()
+        self.assertEqual(self.names(data), [('root', [('sub', [('sf', [])])])])
+        sf = data[0]['subfolder'][0]['subfolder'][0]
+        self.assertEqual((sf['id'], sf['parent'], sf['is_sharedfolder'], sf['transcript_count']), (self.sf.id, self.sub.id, True, 0))
+        self.assertEqual((data[0]['is_sharedfolder'], data[0]['transcript_count']), (False, None))
+
+    def test_root_and_depth(self):
+        self.assertEqual(self.names(self.get(root=self.sub.id).json()), [('sf', [])])
+        self.assertEqual(self.names(self.get(depth=2).json()), [('root', [('sub', [])])])
+        self.assertEqual(self.names(self.get(root=self.root.id, depth=1).json()), [('sub', [])])
+        self.assertEqual(self.get(root=self.root.id + 1000).status_code, 404)
+        self.assertEqual(self.get(depth=0).status_code, 400)
+        self.assertEqual(self.get(root='x').status_code, 400)
+
+    def test_query_count_is_constant(self):
+        # the tree is read in one query, the publisher group of the user is only looked up by the first request
+        self.get()
+        with self.assertNumQueries(1):
+            self.get()
+        parent = self.root
+        for i in range(5):
+            parent = models.Folder.objects.create(name=f'level{i}', owner=self.publisher, parent=parent)
+            models.Folder.objects.create(name=f'sibling{i}', owner=self.publisher, parent=parent)
+        with self.assertNumQueries(1):
+            data = self.get(depth=7).json()
+        self.assertEqual([node['name'] for node in data[0]['subfolder']], ['level0', 'sub'])
+
+
+class UserRenamedTests(TestCase):
+
+    def setUp(self):
+        self.user = CustomUser.objects.create_user('publisher', password='x')
+        self.folder = models.Folder.objects.create(name='sub', owner=self.user,
+                                                   parent=models.Folder.objects.create(name='root', owner=self.user))
+
+    def test_rename_updates_paths(self):
+        self.user.username = 'renamed'
+        self.user.save()
+        self.folder.refresh_from_db()
+        self.assertEqual(self.folder.path, 'renamed/root/sub')
+
+    def test_other_fields_dont_read_username(self):
+        with CaptureQueriesContext(connection) as context:
+            self.user.save(update_fields=['last_login'])
+        self.assertFalse(any('"username"' in query['sql'] for query in context.captured_queries))
+
+
+class IngestionTests(TestCase):
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        settings_override = override_settings(MEDIA_ROOT=Path(media_root))
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.media_root = media_root
+        publisher = CustomUser.objects.create_user('publisher', password='x')
+        self.sf = models.Folder.objects.create(name='sf', owner=publisher).make_shared_folder()
+        archive = synthetic.Generator().archive(['a', 'b'], segments=3, audio_size=10)
+        self.job = models.IngestionJob.objects.create(owner=publisher, shared_folder=self.sf, format='vtt')
+        self.job.zfile.save('upload.zip', ContentFile(archive.getvalue()))
+
+    def stored_files(self):
+        # unreferenced blobs of the deduplicated storage are removed by collectblobs
+        return [name for directory, _, names in os.walk(self.media_root) for name in names
+                if not name.endswith('.zip') and storages.DedupStorage.BLOB_DIR not in directory]
+
+    def test_done_after_insert(self):
+        ingest.work(once=True)
+        self.job.refresh_from_db()
+        self.assertEqual((self.job.status, self.job.processed, self.job.failed), (models.IngestionJob.DONE, 2, 0))
+        self.assertEqual(self.sf.transcription.count(), 2)
+
+    def test_failed_insert_removes_files(self):
+        with mock.patch.object(models.Transcription.objects, 'bulk_create', side_effect=IntegrityError('unique_tr')):
+            ingest.work(once=True)
+        self.job.refresh_from_db()
+        self.assertEqual((self.job.status, self.job.processed, self.job.failed), (models.IngestionJob.FAILED, 0, 2))
+        self.assertEqual(set(self.job.items.values_list('status', flat=True)), {models.IngestionItem.FAILED})
+        self.assertFalse(self.sf.transcription.exists())
+        self.assertEqual(self.stored_files(), [])
+
+    def test_poll_returns_failed_items(self):
+        ingest.work(once=True)
+        self.job.items.create(title='c', status=models.IngestionItem.FAILED, error='ValueError: Invalid trjson', duration=0)
+        self.job.owner.groups.add(auth_models.Group.objects.get_or_create(name='Publisher')[0])
+        client = APIClient()
+        client.force_authenticate(self.job.owner)
+        data = client.get(reverse('ingestion-job', args=[self.job.id])).json()
+        self.assertEqual((data['status'], data['processed']), (models.IngestionJob.DONE, 2))
+        self.assertEqual([item['title'] for item in data['failed_items']], ['c'])
+
+    def test_title_batches(self):
+        with mock.patch.object(utils, 'TITLE_BATCH_SIZE', 1), mock.patch.object(signals.transcripts_written, 'send_robust') as send:
+            ingest.work(once=True)
+        self.assertEqual(sorted(tr.title for tr in send.call_args.kwargs['transcriptions']), ['a', 'b'])
+
+    def test_failing_receiver_doesnt_fail_the_job(self):
+        def fail(**kwargs):
+            raise ValueError('index')
+        signals.transcripts_written.connect(fail)
+        self.addCleanup(signals.transcripts_written.disconnect, fail)
+        with self.assertLogs(utils.logger, 'ERROR'):
+            ingest.work(once=True)
+        self.job.refresh_from_db()
+        self.assertEqual(self.job.status, models.IngestionJob.DONE)
+        self.assertEqual(self.sf.transcription.count(), 2)
+
+
+class TrformatsTests(SimpleTestCase):
+
+    def setUp(self):
+        rng = random.Random(0)
+        self.cues = []
+        time = 0.0
+        for i in range(50):
+            words = [rng.choice(['hello', 'world', 'tschüß', 'a', 'transcript']) for _ in range(rng.randint(1, 12))]
+            start = round(time, 2)
+            time += rng.uniform(0.5, 5)
+            self.cues.append((words, start, round(time, 2)))
+        self.segments = trformats.interpolate_batch(self.cues, use_numpy=False)
+
+    @staticmethod
+    def stream(content, size=7):
+        # reads at most size bytes at once, so chunk boundaries fall inside of the cues
+        return io.BufferedReader(trformats.ChunkReader(content[i:i + size] for i in range(0, len(content), size)), size)
+
+    def test_round_trip(self):
+        for format in trformats.formats:
+            with self.subTest(format=format), mock.patch.object(trformats, 'CHUNK_SIZE', 5):
+                content = trformats.dumps(self.segments, format)
+                _, reader, _ = trformats.formats[format]
+                self.assertEqual(list(reader(self.stream(content))), self.segments)
+                self.assertEqual(trformats.load(io.BytesIO(content), format), self.segments)
+
+    def test_convert(self):
+        vtt = trformats.dumps(self.segments, 'vtt')
+        self.assertEqual(trformats.convert(vtt, 'vtt', 'srt'), trformats.dumps(self.segments, 'srt'))
+        self.assertEqual(b''.join(trformats.export(io.BytesIO(vtt), 'vtt', 'trjson')), trformats.dumps(self.segments, 'trjson'))
+
+    @skipIf(trformats.np is None, 'numpy is not installed')
+    def test_interpolate_batch(self):
+        rng = random.Random(1)
+        cues = [([rng.choice(['a', 'bb', 'ccc', 'dddd', 'eeeee']) for _ in range(rng.randint(1, 20))],
+                 round(rng.uniform(0, 10000), rng.choice([0, 2, 3])), 0) for _ in range(20000)]
+        cues = [(words, start, start + round(rng.uniform(0.01, 30), rng.choice([1, 2, 3]))) for words, start, _ in cues]
+        self.assertEqual(trformats.interpolate_batch(cues), trformats.interpolate_batch(cues, use_numpy=False))
+
+    def test_trbin(self):
+        self.assertEqual(trbin.encode([]), trbin.encode(iter([])))
+        self.assertEqual(list(trbin.read_trbin(io.BytesIO(trbin.encode([])))), [])
+        # times with more decimals are stored as floats
+        precise = [[{'word': 'x', 'start': 0.125, 'end': 1 / 3}]]
+        self.assertEqual(list(trbin.read_trbin(io.BytesIO(trbin.encode(precise)))), precise)
+        with self.assertRaises(ValueError):
+            list(trbin.read_trbin(io.BytesIO(b'TRB0' + bytes(40))))
+
+    def test_load_window(self):
+        total = len(self.segments)
+        contents = {format: trformats.dumps(self.segments, format) for format in trformats.storage_formats}
+        for offset, limit in [(0, None), (0, 0), (0, 10), (10, 5), (total - 1, 5), (total, 1), (total + 5, 1), (3, None)]:
+            for format, content in contents.items():
+                with self.subTest(format=format, offset=offset, limit=limit):
+                    stop = None if limit is None else offset + limit
+                    self.assertEqual(trformats.load_window(io.BytesIO(content), format, offset, limit),
+                                     (self.segments[offset:stop], total))
+
+
+class StoredFile:
+    """
+    The parts of a FieldFile that fileserving and exportcache use
+    """
+
+    def __init__(self, storage, name):
+        self.storage, self.name = storage, name
+
+    def open(self, mode='rb'):
+        return self.storage.open(self.name, mode)
+
+
+class FileServingTests(SimpleTestCase):
+
+    def setUp(self):
+        storage = FileSystemStorage(location=tempfile.mkdtemp())
+        self.file = StoredFile(storage, storage.save('audio.mp3', ContentFile(bytes(range(100)))))
+        self.empty = StoredFile(storage, storage.save('empty.mp3', ContentFile(b'')))
+        self.factory = RequestFactory()
+
+    def get(self, file=None, **headers):
+        response = fileserving.serve_fieldfile(self.factory.get('/', **headers), file or self.file)
+        body = b''.join(response.streaming_content) if response.streaming else response.content
+        return response, body
+
+    def test_full_file(self):
+        response, body = self.get()
+        self.assertEqual((response.status_code, body, response['Accept-Ranges']), (200, bytes(range(100)), 'bytes'))
+
+    def test_single_range(self):
+        response, body = self.get(HTTP_RANGE='bytes=10-19')
+        self.assertEqual((response.status_code, body), (206, bytes(range(10, 20))))
+        self.assertEqual((response['Content-Range'], response['Content-Length']), ('bytes 10-19/100', '10'))
+
+    def test_suffix_range(self):
+        response, body = self.get(HTTP_RANGE='bytes=-5')
+        self.assertEqual((response.status_code, body, response['Content-Range']), (206, bytes(range(95, 100)), 'bytes 95-99/100'))
+        response, _ = self.get(self.empty, HTTP_RANGE='bytes=-5')
+        self.assertEqual((response.status_code, response['Content-Range']), (416, 'bytes */0'))
+
+    def test_multiple_ranges(self):
+        response, body = self.get(HTTP_RANGE='bytes=0-1,98-')
+        self.assertEqual(response.status_code, 206)
+        self.assertTrue(response['Content-Type'].startswith('multipart/byteranges; boundary='))
+        self.assertIn(b'Content-Range: bytes 0-1/100\r\n\r\n\x00\x01', body)
+        self.assertIn(b'Content-Range: bytes 98-99/100\r\n\r\nbc', body)
+
+    def test_unsatisfiable_range(self):
+        response, _ = self.get(HTTP_RANGE='bytes=100-')
+        self.assertEqual((response.status_code, response['Content-Range']), (416, 'bytes */100'))
+
+    def test_conditional(self):
+        response, _ = self.get()
+        response, body = self.get(HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual((response.status_code, body), (304, b''))
+        # a range of another version of the file is answered with the whole file
+        response, body = self.get(HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"outdated"')
+        self.assertEqual((response.status_code, len(body)), (200, 100))
+
+
+class ZipStreamTests(SimpleTestCase):
+
+    def archive(self, members):
+        return b''.join(chunk for member in members for chunk in member)
+
+    def test_opens_with_zipfile(self):
+        zs = zipstream.ZipStream(chunk_size=1000)
+        large = bytes(range(256)) * 100
+        entry = zipstream.ZipEntry('', None, 0)
+        raw = b''.join(zipstream.deflate(io.BytesIO(b'deflated before'), entry))
+        content = self.archive([zs.add_file('a/original.json', io.BytesIO(b'[]')), zs.add_file('a/audio.mp3', io.BytesIO(large)),
+                                zs.add_raw('b/korrektur-ä.json', io.BytesIO(raw), entry.crc, entry.file_size, entry.compress_size),
+                                zs.finish()])
+        with zipfile.ZipFile(io.BytesIO(content)) as zfile:
+            self.assertIsNone(zfile.testzip())
+            self.assertEqual(zfile.namelist(), ['a/original.json', 'a/audio.mp3', 'b/korrektur-ä.json'])
+            self.assertEqual(zfile.read('a/audio.mp3'), large)
+            self.assertEqual(zfile.read('b/korrektur-ä.json'), b'deflated before')
+
+    def test_zip64_member_count(self):
+        zs = zipstream.ZipStream()
+        entry = zipstream.ZipEntry('', None, 0)
+        raw = b''.join(zipstream.deflate(io.BytesIO(b''), entry))
+        count = zipstream.ZIP_FILECOUNT_LIMIT + 1
+        content = self.archive([zs.add_raw(f'{i}.json', io.BytesIO(raw), entry.crc, 0, len(raw)) for i in range(count)] + [zs.finish()])
+        with zipfile.ZipFile(io.BytesIO(content)) as zfile:
+            self.assertEqual(len(zfile.infolist()), count)
+
+    def test_zip64_sizes(self):
+        # members beyond 4GB, written without the data
+        entry = zipstream.ZipEntry('large.mp3', zipstream.dos_date_time(0), zipstream.FLAG_UTF8)
+        entry.file_size, entry.compress_size, entry.offset = 5 * 2 ** 30, 2 ** 32, 6 * 2 ** 30
+        header = zipstream.ZipStream()._central_header(entry)
+        fields = zipstream.CENTRAL_HEADER.unpack_from(header)
+        self.assertEqual(fields[1], zipstream.VERSION_ZIP64)
+        self.assertEqual((fields[8], fields[9], fields[16]), (zipstream.ZIP64_LIMIT,) * 3)
+        extra = header[zipstream.CENTRAL_HEADER.size + len(entry.arcname):]
+        self.assertEqual(zipstream.ZIP64_EXTRA.unpack_from(extra), (1, 24))
+        self.assertEqual(struct.unpack_from('<3Q', extra, zipstream.ZIP64_EXTRA.size), (5 * 2 ** 30, 2 ** 32, 6 * 2 ** 30))
+        # the data descriptor of a streamed member has no room for them
+        with self.assertRaises(ValueError):
+            list(zipstream.ZipStream().add_raw('large.mp3', io.BytesIO(b''), 0, zipstream.ZIP64_LIMIT, 10))
+
+
+class ExportCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        self.storage = FileSystemStorage(location=tempfile.mkdtemp())
+        self.file = StoredFile(self.storage, self.storage.save('original.json', ContentFile(b'[]')))
+
+    def test_entry_version(self):
+        version, mtime = exportcache.entry_version(self.file, 'vtt')
+        self.assertEqual(exportcache.entry_version(self.file, 'vtt'), (version, mtime))
+        self.assertNotEqual(exportcache.entry_version(self.file, 'srt')[0], version)
+        path = self.storage.path(self.file.name)
+        os.utime(path, (mtime - 10, mtime - 10))
+        self.assertNotEqual(exportcache.entry_version(self.file, 'vtt')[0], version)
+        with open(path, 'wb') as f:
+            f.write(b'[[]]')
+        os.utime(path, (mtime, mtime))
+        self.assertNotEqual(exportcache.entry_version(self.file, 'vtt')[0], version)
+
+
+class SyntheticTests(SimpleTestCase):
+
+    def test_deterministic(self):
+        self.assertEqual(synthetic.Generator(1).segments(5, 8), synthetic.Generator(1).segments(5, 8))
+        self.assertNotEqual(synthetic.Generator(1).segments(5, 8), synthetic.Generator(2).segments(5, 8))
+
+    def test_vtt_round_trip(self):
+        segments = synthetic.Generator().segments(20, 8)
+        loaded = trformats.load(io.BytesIO(trformats.dumps(segments, 'vtt')), 'vtt')
+        self.assertEqual([[word['word'] for word in segment] for segment in loaded],
+                         [[word['word'] for word in segment] for segment in segments])
+
+    def test_correct(self):
+        generator = synthetic.Generator()
+        segments = generator.segments(200, 10)
+        self.assertEqual(generator.correct(segments, 0), segments)
+        corrected = [word['word'] for segment in generator.correct(segments, 0.1) for word in segment]
+        original = [word['word'] for segment in segments for word in segment]
+        changed = sum(a != b for a, b in zip(original, corrected))
+        self.assertTrue(0 < changed < len(original))
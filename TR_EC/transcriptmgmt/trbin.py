@@ -0,0 +1,177 @@
+"""
+trbin: compact columnar storage format for transcripts.
+
+Instead of one json object per word, the words are stored in columns:
+    header
+    segment index   uint32[segments + 1]   index of the first word of every segment
+    word ids        uint32[words]          index into the string table
+    starts, ends    int32[words] in hundredths of a second, or float64[words] if a time has more than 2 decimals
+    string offsets  uint32[strings + 1]
+    strings         utf-8, every distinct word is stored once
+All numbers are little endian and every section starts at a multiple of 8 bytes.
+
+TrbinReader memory-maps a file, so opening is cheap and only the segments that are accessed get decoded.
+This module must not import django, see trformats.
+"""
+import array, io, mmap, struct, sys
+
+MAGIC = b'TRB1'
+HEADER = struct.Struct('<4sB3xIIIQ4x')  # magic, time encoding, segments, words, strings, size of the strings section
+
+TIME_CENTISECONDS = 0
+TIME_FLOAT64 = 1
+
+
+def _pad(n):
+    return (8 - n % 8) % 8
+
+
+def encode(segments):
+    """
+    Returns the trbin representation of segments as bytes
+    """
+    segment_index = array.array('I', [0])
+    word_ids = array.array('I')
+    starts, ends = [], []
+    strings = {}
+    for segment in segments:
+        for word in segment:
+            word_ids.append(strings.setdefault(word['word'], len(strings)))
+            starts.append(word['start'])
+            ends.append(word['end'])
+        segment_index.append(len(word_ids))
+
+    # hundredths of a second are enough for everything interpolate produces
+    time_encoding = TIME_CENTISECONDS
+    for t in starts + ends:
+        if round(t, 2) != t or abs(t) >= 20000000:
+            time_encoding = TIME_FLOAT64
+            break
+    if time_encoding == TIME_CENTISECONDS:
+        start_column = array.array('i', [int(round(t * 100)) for t in starts])
+        end_column = array.array('i', [int(round(t * 100)) for t in ends])
+    else:
+        start_column = array.array('d', starts)
+        end_column = array.array('d', ends)
+
+    encoded_strings = [string.encode('utf-8') for string in strings]
+    string_offsets = array.array('I', [0])
+    for string in encoded_strings:
+        string_offsets.append(string_offsets[-1] + len(string))
+    string_data = b''.join(encoded_strings)
+
+    out = io.BytesIO()
+    out.write(HEADER.pack(MAGIC, time_encoding, len(segment_index) - 1, len(word_ids), len(strings), len(string_data)))
+    for section in (segment_index, word_ids, start_column, end_column, string_offsets):
+        if sys.byteorder != 'little':
+            section.byteswap()
+        data = section.tobytes()
+        out.write(data + b'\0' * _pad(len(data)))
+    out.write(string_data)
+    return out.getvalue()
+
+
+def write_trbin(segments):
+    """
+    Writer for trformats.formats. The columns need the whole transcript, so everything is produced in one chunk.
+    """
+    yield encode(segments)
+
+
+def read_trbin(stream):
+    """
+    Reader for trformats.formats
+    """
+    reader = TrbinReader(stream)
+    try:
+        yield from reader.segments()
+    finally:
+        reader.close()
+
+
+class TrbinReader:
+    """
+    Read access to a trbin file object. The file is memory-mapped if possible, otherwise read into memory.
+    """
+
+    def __init__(self, fileobj):
+        self.mmap = None
+        try:
+            self.mmap = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+            self.buffer = memoryview(self.mmap)
+        except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+            self.buffer = memoryview(fileobj.read())
+        if len(self.buffer) < HEADER.size:
+            raise ValueError('Invalid trbin file')
+        magic, self.time_encoding, self.segment_count, self.word_count, self.string_count, strings_size = \
+            HEADER.unpack_from(self.buffer)
+        if magic != MAGIC:
+            raise ValueError('Invalid trbin file')
+        time_typecode, time_size = ('i', 4) if self.time_encoding == TIME_CENTISECONDS else ('d', 8)
+
+        offset = HEADER.size
+        self.segment_index, offset = self._section(offset, 'I', 4, self.segment_count + 1)
+        self.word_ids, offset = self._section(offset, 'I', 4, self.word_count)
+        self.starts, offset = self._section(offset, time_typecode, time_size, self.word_count)
+        self.ends, offset = self._section(offset, time_typecode, time_size, self.word_count)
+        self.string_offsets, offset = self._section(offset, 'I', 4, self.string_count + 1)
+        self.strings = self.buffer[offset:offset + strings_size]
+        self._decoded = {}
+
+    def _section(self, offset, typecode, itemsize, count):
+        size = itemsize * count
+        if offset + size > len(self.buffer):
+            raise ValueError('Invalid trbin file')
+        view = self.buffer[offset:offset + size]
+        if sys.byteorder == 'little':
+            column = view.cast(typecode)
+        else:
+            column = array.array(typecode)
+            column.frombytes(view)
+            column.byteswap()
+        return column, offset + size + _pad(size)
+
+    def __len__(self):
+        return self.segment_count
+
+    def _string(self, string_id):
+        string = self._decoded.get(string_id)
+        if string is None:
+            string = bytes(self.strings[self.string_offsets[string_id]:self.string_offsets[string_id + 1]]).decode('utf-8')
+            self._decoded[string_id] = string
+        return string
+
+    def _time(self, column, i):
+        if self.time_encoding == TIME_CENTISECONDS:
+            return column[i] / 100
+        return column[i]
+
+    def segment(self, index):
+        first, last = self.segment_index[index], self.segment_index[index + 1]
+        return [{"word": self._string(self.word_ids[i]), "start": self._time(self.starts, i), "end": self._time(self.ends, i)}
+                for i in range(first, last)]
+
+    def segments(self, start=0, stop=None):
+        """
+        Yields the segments with index start <= index < stop. Only those are decoded.
+        """
+        if stop is None or stop > self.segment_count:
+            stop = self.segment_count
+        for index in range(max(start, 0), stop):
+            yield self.segment(index)
+
+    def close(self):
+        # the casted views have to be released before the mmap can be closed
+        for name in ('segment_index', 'word_ids', 'starts', 'ends', 'string_offsets', 'strings'):
+            column = getattr(self, name, None)
+            if isinstance(column, memoryview):
+                column.release()
+        self.buffer.release()
+        if self.mmap is not None:
+            self.mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -1,4 +1,23 @@
-import json
+"""
+Import and export of transcript formats.
+
+Every format has a reader and a writer:
+    reader(stream) takes a binary file object and yields segments
+    writer(segments) takes an iterable of segments and yields str chunks (bytes for binary formats)
+A segment is a list of words: [{"word": "hello", "start": 0.0, "end": 0.5}, ...]
+Both sides work incrementally, so the memory use doesn't depend on the length of the transcript.
+
+This module must not import django, it is used in the worker processes of the conversion pool.
+"""
+import io, json, math, os, re, time
+from . import trbin
+
+try:
+    import numpy as np
+except ImportError:  # numpy is optional, interpolate_batch falls back to interpolate
+    np = None
+
+CHUNK_SIZE = 64 * 1024
 
 def interpolate(wordList, start, end):
 	numOfChars = len(''.join(wordList))
@@ -15,42 +34,443 @@ def interpolate(wordList, start, end):
 		currChar += wordLength
 	return p
 
-def vtt_to_trjson(content: str):
-    
-    def formatted_time_to_float(time: str):
-        h, m, s = time.split(':')
-        return float(s) + 60*float(m) + 3600*float(h)
-    
-    lines = content.splitlines()
-    trjson = []
-    start: float
-    end: float
-    text = ''
+
+# number of cues that are interpolated at once by the readers
+BATCH_SIZE = 1000
+
+
+def round2(values):
+    """
+    Rounds a numpy array to 2 decimals exactly like the builtin round does.
+    np.round scales by 100 first, which can round differently when the scaled value is (almost) exactly x.5,
+    those few values are rounded again with the builtin round.
+    """
+    rounded = np.round(values, 2)
+    scaled = values * 100
+    halfway = np.nonzero(np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6)[0]
+    for i in halfway:
+        rounded[i] = round(float(values[i]), 2)
+    return rounded
+
+
+def interpolate_batch(cues, use_numpy=True):
+    """
+    Same as [interpolate(*cue) for cue in cues] for cues of (wordList, start, end),
+    but computes the times of all words at once with cumulative sums over the word lengths.
+    """
+    if np is None or not use_numpy or not cues:
+        return [interpolate(*cue) for cue in cues]
+    words = [word for cue in cues for word in cue[0]]
+    counts = np.fromiter((len(cue[0]) for cue in cues), dtype=np.int64, count=len(cues))
+    lengths = np.fromiter(map(len, words), dtype=np.int64, count=len(words))
+    starts = np.fromiter((cue[1] for cue in cues), dtype=np.float64, count=len(cues))
+    ends = np.fromiter((cue[2] for cue in cues), dtype=np.float64, count=len(cues))
+
+    # chars[i] is the number of chars before word i, counted over all cues
+    chars = np.concatenate(([0], np.cumsum(lengths)))
+    first = np.concatenate(([0], np.cumsum(counts)))
+    cue_chars = chars[first]
+    # per word: chars before the word within its cue, chars in its cue, start and duration of its cue
+    curr_char = chars[:-1] - np.repeat(cue_chars[:-1], counts)
+    num_of_chars = np.repeat(cue_chars[1:] - cue_chars[:-1], counts)
+    start = np.repeat(starts, counts)
+    duration = np.repeat(ends - starts, counts)
+    # same operations in the same order as in interpolate, so the floats are identical
+    word_starts = round2(start + (duration * (curr_char / num_of_chars))).tolist()
+    word_ends = round2(start + (duration * ((curr_char + lengths) / num_of_chars))).tolist()
+
+    segments = []
+    offsets = first.tolist()
+    for a, b in zip(offsets, offsets[1:]):
+        segments.append([{"word": word, "start": word_start, "end": word_end}
+                         for word, word_start, word_end in zip(words[a:b], word_starts[a:b], word_ends[a:b])])
+    return segments
+
+
+def interpolated(cues):
+    """
+    Yields the segments for an iterable of (wordList, start, end) cues, interpolating them in batches
+    """
+    batch = []
+    for cue in cues:
+        batch.append(cue)
+        if len(batch) >= BATCH_SIZE:
+            yield from interpolate_batch(batch)
+            batch = []
+    yield from interpolate_batch(batch)
+
+
+def formatted_time_to_float(time: str):
+    """
+    '01:02:03.450', '02:03.450' (vtt) and '01:02:03,450' (srt) -> seconds
+    """
+    parts = time.strip().replace(',', '.').split(':')
+    seconds = 0.0
+    for part in parts:
+        seconds = 60*seconds + float(part)
+    return seconds
+
+
+def float_to_formatted_time(seconds: float, decimal_marker='.'):
+    """
+    seconds -> '01:02:03.450'
+    """
+    millis = int(round(seconds * 1000))
+    h, millis = divmod(millis, 3600000)
+    m, millis = divmod(millis, 60000)
+    s, millis = divmod(millis, 1000)
+    return f'{h:02d}:{m:02d}:{s:02d}{decimal_marker}{millis:03d}'
+
+
+def text_lines(stream):
+    """
+    Iterates over the lines of a utf-8 encoded binary stream without the line endings
+    """
+    for line in io.TextIOWrapper(stream, encoding='utf-8-sig', newline=None):
+        yield line.rstrip('\n')
+
+
+# trjson
+
+def read_trjson(stream):
+    """
+    Parses a trjson list segment by segment, so only one segment has to be held in memory
+    """
+    decoder = json.JSONDecoder()
+    reader = io.TextIOWrapper(stream, encoding='utf-8-sig')
+    state = {'buf': '', 'pos': 0, 'eof': False}
+
+    def fill():
+        data = reader.read(CHUNK_SIZE)
+        if not data:
+            state['eof'] = True
+        state['buf'] = state['buf'][state['pos']:] + data
+        state['pos'] = 0
+
+    def next_char():
+        # skips whitespace and returns the next character, '' at the end of the stream
+        while True:
+            buf, pos = state['buf'], state['pos']
+            while pos < len(buf) and buf[pos] in ' \t\r\n':
+                pos += 1
+            state['pos'] = pos
+            if pos < len(buf):
+                return buf[pos]
+            if state['eof']:
+                return ''
+            fill()
+
+    if next_char() != '[':
+        raise ValueError('trjson has to be a list of segments')
+    state['pos'] += 1
+    if next_char() == ']':
+        return
+    while True:
+        next_char()
+        try:
+            segment, end = decoder.raw_decode(state['buf'], state['pos'])
+        except json.JSONDecodeError:
+            if state['eof']:
+                raise
+            # the segment is not completely in the buffer yet
+            fill()
+            continue
+        if not isinstance(segment, list):
+            raise ValueError('trjson segments have to be lists of words')
+        state['pos'] = end
+        yield segment
+        c = next_char()
+        if c == ',':
+            state['pos'] += 1
+        elif c == ']':
+            return
+        else:
+            raise ValueError('Invalid trjson')
+
+
+def write_trjson(segments):
+    """
+    Produces the same output as json.dumps(list(segments))
+    """
+    yield '['
+    first = True
+    for segment in segments:
+        if not first:
+            yield ', '
+        first = False
+        yield json.dumps(segment)
+    yield ']'
+
+
+# vtt and srt
+
+TAG_RE = re.compile(r'<[^>]*>')
+
+
+def cue_blocks(lines):
+    """
+    Groups lines into blocks that are separated by empty lines
+    """
+    block = []
     for line in lines:
-        if 'WEBVTT' in line or line.startswith('NOTE '):
+        if line.strip() == '':
+            if block:
+                yield block
+                block = []
+        else:
+            block.append(line)
+    if block:
+        yield block
+
+
+def parse_cue(block):
+    """
+    Converts a vtt or srt cue (identifier line, timing line, text lines) to (wordList, start, end).
+    Returns None for blocks that are no cues, e.g. the vtt header or NOTE blocks.
+    """
+    for i, line in enumerate(block):
+        if '-->' in line:
+            break
+    else:
+        return None
+    start_str, end_str = line.split('-->')
+    # vtt cue settings may follow the end time
+    end_str = end_str.split()[0]
+    start = formatted_time_to_float(start_str)
+    end = formatted_time_to_float(end_str)
+    words = []
+    for text in block[i+1:]:
+        text = text.strip()
+        if text.startswith('-'):
+            text = text[1:]
+        words.extend(TAG_RE.sub('', text).split())
+    if not words:
+        return None
+    return words, start, end
+
+
+def vtt_cues(stream):
+    for block in cue_blocks(text_lines(stream)):
+        if block[0].startswith(('WEBVTT', 'NOTE', 'STYLE', 'REGION')):
             continue
-        if line.startswith('-'):
-            line = line[1:]
-        line = line.strip()
-        if ' --> ' in line:
-            start_str, end_str = line.split(' --> ')
-            start = formatted_time_to_float(start_str)
-            end = formatted_time_to_float(end_str)
-        elif line != '':
-            text += line
-        else:  # line is empty
-            if text != '':
-                trjson.append(interpolate(text.split(), start, end))
-                text = ''
-    if text != '':
-        trjson.append(interpolate(text.split(), start, end))
-    return trjson
+        cue = parse_cue(block)
+        if cue is not None:
+            yield cue
 
-def trjson_to_vtt(content) -> str:
-    pass
 
-# format entry: format name -> (file extension, to trjson function, from trjson function)
+def read_vtt(stream):
+    return interpolated(vtt_cues(stream))
+
+
+def write_vtt(segments):
+    yield 'WEBVTT\n'
+    for segment in segments:
+        if not segment:
+            continue
+        start = float_to_formatted_time(segment[0]['start'])
+        end = float_to_formatted_time(segment[-1]['end'])
+        text = ' '.join(word['word'] for word in segment)
+        yield f'\n{start} --> {end}\n{text}\n'
+
+
+def srt_cues(stream):
+    for block in cue_blocks(text_lines(stream)):
+        cue = parse_cue(block)
+        if cue is not None:
+            yield cue
+
+
+def read_srt(stream):
+    return interpolated(srt_cues(stream))
+
+
+def write_srt(segments):
+    index = 0
+    for segment in segments:
+        if not segment:
+            continue
+        index += 1
+        start = float_to_formatted_time(segment[0]['start'], ',')
+        end = float_to_formatted_time(segment[-1]['end'], ',')
+        text = ' '.join(word['word'] for word in segment)
+        yield f'{index}\n{start} --> {end}\n{text}\n\n'
+
+
+# stm (segment time mark, used by asr scoring tools)
+# line format: <file> <channel> <speaker> <start> <end> [<label>] text
+
+def stm_cues(stream):
+    for line in text_lines(stream):
+        if line.startswith(';;') or line.strip() == '':
+            continue
+        fields = line.split(None, 5)
+        if len(fields) < 5:
+            raise ValueError(f'Invalid stm line: {line}')
+        text = fields[5] if len(fields) == 6 else ''
+        if text.startswith('<'):
+            text = text[text.find('>')+1:]
+        words = text.split()
+        if words:
+            yield words, float(fields[3]), float(fields[4])
+
+
+def read_stm(stream):
+    return interpolated(stm_cues(stream))
+
+
+def write_stm(segments, name='transcript'):
+    for segment in segments:
+        if not segment:
+            continue
+        text = ' '.join(word['word'] for word in segment)
+        yield f"{name} 1 unknown {segment[0]['start']:.2f} {segment[-1]['end']:.2f} {text}\n"
+
+
+# format entry: format name -> (file extension, reader, writer)
 formats = {
-    "trjson": ('json', json.loads, json.dumps),
-    "vtt": ('vtt', vtt_to_trjson, trjson_to_vtt),
-}
\ No newline at end of file
+    "trjson": ('json', read_trjson, write_trjson),
+    "vtt": ('vtt', read_vtt, write_vtt),
+    "srt": ('srt', read_srt, write_srt),
+    "stm": ('stm', read_stm, write_stm),
+    "trbin": ('trbin', trbin.read_trbin, trbin.write_trbin),
+}
+
+# formats in which transcripts and corrections can be stored, see settings.TRANSCRIPT_STORAGE_FORMAT
+storage_formats = ['trjson', 'trbin']
+
+
+def format_of(name: str):
+    """
+    Returns the storage format of a stored transcript file, based on its extension
+    """
+    extension = os.path.splitext(name)[1][1:]
+    for format in storage_formats:
+        if formats[format][0] == extension:
+            return format
+    return 'trjson'
+
+
+def load(stream, format: str):
+    """
+    Returns the whole content of stream as list of segments
+    """
+    if format == 'trjson':
+        # json.load is faster than the incremental reader, if everything is needed anyway
+        return json.load(stream)
+    _, reader, _ = formats[format]
+    return list(reader(stream))
+
+
+def load_window(stream, format: str, offset=0, limit=None):
+    """
+    Returns the segments offset <= index < offset+limit of stream and the total number of segments.
+    trbin only decodes the requested segments, the other formats have to be read completely.
+    """
+    stop = None if limit is None else offset + limit
+    if format == 'trbin':
+        with trbin.TrbinReader(stream) as reader:
+            return list(reader.segments(offset, stop)), len(reader)
+    _, reader, _ = formats[format]
+    window = []
+    total = 0
+    for segment in reader(stream):
+        if total >= offset and (stop is None or total < stop):
+            window.append(segment)
+        total += 1
+    return window, total
+
+
+def check_segments(segments):
+    """
+    Raises ValueError if segments, e.g. sent by a client, doesn't have the structure of a transcript
+    """
+    if not isinstance(segments, list):
+        raise ValueError('Has to be a list of segments')
+    for i, segment in enumerate(segments):
+        if not isinstance(segment, list):
+            raise ValueError(f'Segment {i} has to be a list of words')
+        for j, word in enumerate(segment):
+            if not isinstance(word, dict) or not isinstance(word.get('word'), str):
+                raise ValueError(f'Word {j} of segment {i} has to be an object with a string "word"')
+            for key in ('start', 'end'):
+                # bool is a subclass of int
+                if isinstance(word.get(key), bool) or not isinstance(word.get(key), (int, float)) or not math.isfinite(word[key]):
+                    raise ValueError(f'Word {j} of segment {i} has to have a number "{key}"')
+
+
+def dumps(segments, format: str) -> bytes:
+    """
+    Returns segments in format as bytes
+    """
+    _, _, writer = formats[format]
+    return b''.join(chunk if isinstance(chunk, bytes) else chunk.encode('utf-8') for chunk in writer(segments))
+
+
+def vtt_to_trjson(content: str):
+    return list(read_vtt(io.BytesIO(content.encode('utf-8'))))
+
+
+def trjson_to_vtt(content) -> str:
+    return ''.join(write_vtt(content))
+
+
+class ChunkReader(io.RawIOBase):
+    """
+    Binary file object that reads from an iterator of str or bytes chunks
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.pending = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.pending:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return 0
+            self.pending = memoryview(chunk if isinstance(chunk, bytes) else chunk.encode('utf-8'))
+        n = min(len(b), len(self.pending))
+        b[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        return n
+
+
+def convert_stream(stream, from_format: str, to_format: str = 'trjson'):
+    """
+    Returns a binary file object with the content of stream converted from from_format to to_format
+    """
+    _, reader, _ = formats[from_format]
+    _, _, writer = formats[to_format]
+    return io.BufferedReader(ChunkReader(writer(reader(stream))), CHUNK_SIZE)
+
+
+def export(stream, from_format: str, to_format: str):
+    """
+    Yields the content of stream converted from from_format to to_format in chunks of bytes
+    """
+    converted = convert_stream(stream, from_format, to_format)
+    while True:
+        data = converted.read(CHUNK_SIZE)
+        if not data:
+            return
+        yield data
+
+
+def convert(content: bytes, format: str, to_format: str = 'trjson') -> bytes:
+    """
+    Converts the content of a transcript file in the given format to to_format
+    """
+    return convert_stream(io.BytesIO(content), format, to_format).read()
+
+
+def convert_timed(content: bytes, format: str, to_format: str = 'trjson'):
+    """
+    Same as convert, but also returns the time the conversion took in seconds.
+    Runs in the worker processes of the conversion pool.
+    """
+    start = time.perf_counter()
+    converted = convert(content, format, to_format)
+    return converted, time.perf_counter() - start
@@ -1,4 +1,5 @@
 from django.urls import path
+from editmgmt import views as edit_views
 from . import views
 
 urlpatterns = [
@@ -9,6 +10,8 @@ urlpatterns = [
 
     path('pub/folders/delete/', views.multi_delete_folders, name='folder-delete'),
 
+    path('pub/folders/tree/', views.PubFolderTreeView.as_view(), name='folder-tree'),
+
     path('publishers/', views.EditPublisherListView.as_view(), name='publishers'),
 
     path('publishers/<int:pk>/', views.EditPublisherDetailedView.as_view(), name='publisher-detail'),
@@ -19,16 +22,22 @@ urlpatterns = [
 
     path('pub/transcripts/multiupload/', views.PubTranscriptMultiUploadView.as_view()), 
 
+    path('pub/transcripts/multiupload/<int:pk>/', views.PubIngestionJobView.as_view(), name='ingestion-job'),
+
     path('edt/sharedfolders/<int:pk>/', views.EditTranscriptListView.as_view(), name='sharedfolder-detail'),
 
     path('sharedfolders/<int:pk>/', views.PubSharedFolderEditorView.as_view(), name='sharedfolder-editors'),
 
     path('pub/sharedfolders/<int:pk>/download/', views.PubSharedFolderDownloadView.as_view(), name='sharedfolder-download'),
 
+    path('pub/sharedfolders/<int:pk>/consensus/', edit_views.SharedFolderConsensusView.as_view(), name='sharedfolder-consensus'),
+
     path('pub/sharedfolders/<int:pk>/stats/', views.PubSharedFolderStatsView.as_view()),
 
     path('pub/transcripts/<int:pk>/', views.PubTranscriptDetailedView.as_view(), name='pub-transcript-detail'),
 
+    path('pub/transcripts/<int:pk>/consensus/', edit_views.TranscriptConsensusView.as_view(), name='transcript-consensus'),
+
     path('pub/transcripts/delete/', views.multi_delete_transcriptions, name='transcript-multi-delete'),
 
     path('edt/transcripts/<int:pk>/', views.EditTranscriptDetailedView.as_view(), name='edt-transcript-detail'),
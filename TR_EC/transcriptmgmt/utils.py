@@ -1,11 +1,18 @@
-import os, json
+import atexit, os, json, logging, time, collections, multiprocessing, shutil, tempfile, threading
+from concurrent import futures
 from django.conf import settings
-from django.core.files.base import ContentFile
+from django.core.files.base import ContentFile, File
+from django.core.files.storage import default_storage
+from django.db import transaction
 import zipfile
 from pathlib import Path
-from . import models, trformats
+from . import models, trformats, contentcache, signals
+
+logger = logging.getLogger(__name__)
 
 NAME_ID_SPLITTER = '__'
+# titles per query, stays below the variable limit of sqlite
+TITLE_BATCH_SIZE = 500
 
 
 def folder_relative_path(folder):
@@ -20,67 +27,243 @@ def folder_relative_path(folder):
     return media_path
 
 
-def create_transcriptions_from_zipfile(sharedfolder: int, zfile: zipfile.ZipFile, format: str):
+SRC_EXTENSIONS = ('wav', 'mp3', 'mp4')
+
+
+def index_zipfile(zfile: zipfile.ZipFile, extension: str):
+    """
+    Groups the members of zfile by transcript in a single pass.
+    Expected layout: "myzipfolder/mytitle/myaudio.mp3" and "myzipfolder/mytitle/mytranscript.<extension>"
+    Returns a dict: title -> {'src': ZipInfo or None, 'tr': ZipInfo or None}
+    """
+    index = {}
+    for zinfo in zfile.infolist():
+        # help: "a/b/".split('/') == ['a', 'b', ''], "a/b/c.mp3".split('/') == ['a', 'b', 'c.mp3']
+        parts = zinfo.filename.split('/')
+        if len(parts) != 3 or parts[1] == '':
+            continue
+        _, tr_title, filename = parts
+        entry = index.setdefault(tr_title, {'src': None, 'tr': None})
+        if filename == '':  # directory
+            continue
+        if entry['src'] is None and filename.endswith(SRC_EXTENSIONS):
+            entry['src'] = zinfo
+        elif entry['tr'] is None and filename.endswith(extension):
+            entry['tr'] = zinfo
+    return index
+
+
+def conversion_processes():
+    """
+    Returns settings.INGESTION_CONVERSION_PROCESSES, where 0 means one process per cpu
+    """
+    return settings.INGESTION_CONVERSION_PROCESSES or os.cpu_count() or 1
 
-    def zinfo_endswith(zinfo: zipfile.ZipInfo, *formats):
-        for format in formats:
-            if zinfo.filename.endswith(format):
-                return True
-        return False
-    
-    extension, _, _ = trformats.formats[format]
 
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def conversion_pool(processes):
+    """
+    Returns the process pool for the format conversion, or None if the conversion should run in the calling thread.
+    The pool is created on first use and shared by all ingestion workers of the process.
+    """
+    global _pool
+    if processes <= 1:
+        return None
+    with _pool_lock:
+        # a pool whose process died can't be used anymore
+        if _pool is None or getattr(_pool, '_broken', False):
+            # spawn instead of fork, because the ingestion workers are threads
+            _pool = futures.ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('spawn'))
+            atexit.register(_pool.shutdown, cancel_futures=True)
+        return _pool
+
+
+def create_transcriptions_from_zipfile(sharedfolder: int, zfile: zipfile.ZipFile, format: str, progress=None):
+    """
+    Creates a Transcription for every directory in zfile.
+    The format conversion of large archives runs in a process pool (see conversion_pool), all file and db writes happen in this thread.
+    The files are written first, then all Transcriptions are inserted in one transaction.
+    If the insert fails, the written files are deleted again.
+    progress is optional and gets informed about each transcript via progress.set_total(number of transcripts),
+    progress.report(title, duration, error, convert_duration) and progress.flush(), and about the work in between
+    via progress.keep_alive(). Transcripts are only reported done once they are inserted.
+    If progress is given, a failing transcript doesn't abort the whole archive.
+    """
+    extension, _, _ = trformats.formats[format]
+    storage_format = settings.TRANSCRIPT_STORAGE_FORMAT
     sf = models.SharedFolder.objects.get(pk=sharedfolder)
     sf_path = Path(sf.get_path())
-    zinfo_list = zfile.infolist()
-    for zinfo in zinfo_list:
-        # zinfo.filename example: "myzipfolder/mytitle/myaudio.mp3"
-
-        # if it is a file and not a directory, skip
-        # This is essentially only a safety check, bc file zipinfos
-        # are later dynamically removed from zinfo_list
-        if not zinfo.filename.endswith('/'):
-            continue
-        # help: "a/b/".split('/') == ['a', 'b', '']
-        _, tr_title, _ = zinfo.filename.split('/')
-        # find zipinfo objects of src and tr file
-        zinfo_src = list(filter(lambda x: tr_title in x.filename and zinfo_endswith(x, 'wav', 'mp3', 'mp4'), zinfo_list))[0]
-        zinfo_tr = list(filter(lambda x: tr_title in x.filename and zinfo_endswith(x, extension), zinfo_list))[0]
-        # removing the file zipinfos from zinfo_list dynamically,
-        # so that the for loop effectively only loops over folder zipinfos.
-        zinfo_list.remove(zinfo_src)
-        zinfo_list.remove(zinfo_tr)
-        # change zipinfo filenames from 'a/b/c.mp3' to 'c.mp3'
-        # This is need to extract them to a custom location.
-        zinfo_src.filename = os.path.basename(zinfo_src.filename)
-        zinfo_tr.filename = os.path.basename(zinfo_tr.filename)
-
-        path_base = sf_path/tr_title
-        
-        # actual extraction
-        os.makedirs(settings.MEDIA_ROOT/path_base, exist_ok=True)
-        zfile.extract(zinfo_src, settings.MEDIA_ROOT/path_base)
-        zfile.extract(zinfo_tr, settings.MEDIA_ROOT/path_base)
-        # create Transcription object
-        new_transcription = models.Transcription(title=tr_title, shared_folder=sf)
-        # assign files
-        new_transcription.srcfile.name = str(path_base/zinfo_src.filename)
-        new_transcription.trfile.name = str(path_base/zinfo_tr.filename)
-        # save
-        new_transcription.save()
-        # convert from format to trjson
-        convert_tr_from_format(new_transcription, format)
+    index = index_zipfile(zfile, extension)
+    existing = set()
+    for titles in batches(list(index), TITLE_BATCH_SIZE):
+        existing.update(sf.transcription.filter(title__in=titles).values_list('title', flat=True))
+    if progress is not None:
+        progress.set_total(len(index))
+
+    new_transcriptions = []
+    # (title, duration, convert_duration) of the transcripts whose files are written
+    written = []
+
+    def fail(tr_title, start, e):
+        if progress is None:
+            raise e
+        progress.report(tr_title, time.perf_counter() - start, error=f'{type(e).__name__}: {e}')
+
+    def finish(tr_title, entry, start, conversion):
+        # conversion is either a future of the pool or the unconverted content
+        try:
+            if isinstance(conversion, futures.Future):
+                converted, convert_duration = conversion.result()
+            else:
+                converted, convert_duration = trformats.convert_timed(conversion, format, storage_format)
+            new_transcriptions.append(create_transcription_files(sf, sf_path/tr_title, zfile, entry['src'], converted, storage_format))
+        except Exception as e:
+            fail(tr_title, start, e)
+            return
+        written.append((tr_title, time.perf_counter() - start, convert_duration))
+        if progress is not None:
+            progress.keep_alive()
+
+    processes = conversion_processes()
+    # the pool only pays off for archives with a lot to convert
+    transcripts_size = sum(entry['tr'].file_size for entry in index.values() if entry['tr'] is not None)
+    pool = conversion_pool(processes) if transcripts_size >= settings.INGESTION_CONVERSION_MIN_SIZE else None
+    # limits the number of transcripts held in memory while they wait for their conversion
+    max_pending = 2 * processes if pool is not None else 1
+    pending = collections.deque()
+    try:
+        try:
+            for tr_title, entry in index.items():
+                start = time.perf_counter()
+                try:
+                    if tr_title in existing:
+                        raise ValueError('A Transcription with this title in this folder already exists')
+                    if entry['src'] is None:
+                        raise ValueError('No audio file found')
+                    if entry['tr'] is None:
+                        raise ValueError(f'No .{extension} file found')
+                    content = zfile.read(entry['tr'])
+                except Exception as e:
+                    fail(tr_title, start, e)
+                    continue
+                conversion = pool.submit(trformats.convert_timed, content, format, storage_format) if pool is not None else content
+                pending.append((tr_title, entry, start, conversion))
+                while len(pending) >= max_pending:
+                    finish(*pending.popleft())
+            while pending:
+                finish(*pending.popleft())
+        finally:
+            # the pool is shared, only the conversions of this archive are cancelled
+            for *_, conversion in pending:
+                if isinstance(conversion, futures.Future):
+                    conversion.cancel()
+
+        with transaction.atomic():
+            # bulk_create doesn't call Transcription.save, which maintains the counter
+            models.Transcription.objects.bulk_create(new_transcriptions, batch_size=500)
+            sf.add_to_transcript_count(len(new_transcriptions))
+    except Exception as e:
+        # e.g. a concurrent upload inserted one of the titles, none of the transcripts exist
+        for transcription in new_transcriptions:
+            transcription.srcfile.delete(save=False)
+            transcription.trfile.delete(save=False)
+        if progress is not None:
+            for tr_title, duration, _ in written:
+                progress.report(tr_title, duration, error=f'{type(e).__name__}: {e}')
+            progress.flush()
+        raise
+    if progress is not None:
+        for tr_title, duration, convert_duration in written:
+            progress.report(tr_title, duration, convert_duration=convert_duration)
+        progress.flush()
+    # bulk_create doesn't set the primary keys on every database
+    transcriptions = []
+    for titles in batches([tr.title for tr in new_transcriptions], TITLE_BATCH_SIZE):
+        transcriptions.extend(sf.transcription.filter(title__in=titles))
+    send_transcripts_written(transcriptions)
+
+
+def batches(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def send_transcripts_written(transcriptions):
+    """
+    Sends signals.transcripts_written. The transcripts are stored at this point,
+    so failing receivers (e.g. the search indexing) are logged instead of failing the upload.
+    """
+    for receiver, result in signals.transcripts_written.send_robust(sender=models.Transcription, transcriptions=transcriptions):
+        if isinstance(result, Exception):
+            logger.error('%s failed for %s transcripts', receiver, len(transcriptions), exc_info=result)
+
+
+def create_transcription_files(sf, path_base: Path, zfile: zipfile.ZipFile, zinfo_src, content: bytes, storage_format: str):
+    """
+    Writes the audio file and the already converted transcript file of a transcript to the storage.
+    Returns the unsaved Transcription object.
+    """
+    new_transcription = models.Transcription(title=path_base.name, shared_folder=sf)
+    with zfile.open(zinfo_src) as f:
+        new_transcription.srcfile.name = new_transcription.srcfile.storage.save(str(path_base/os.path.basename(zinfo_src.filename)), File(f))
+    extension, _, _ = trformats.formats[storage_format]
+    new_transcription.trfile.name = new_transcription.trfile.storage.save(str(path_base/f'transcription.{extension}'), ContentFile(content))
+    return new_transcription
+
+
+def load_content(fieldfile, fill_cache=True):
+    """
+    Returns the content of a stored transcript or correction file as trjson, whatever its storage format is.
+    The parsed content comes from the content cache if possible and must not be modified.
+    fill_cache=False keeps a content that is read only once (e.g. for indexing) from evicting others.
+    """
+    version = contentcache.content_cache.version(fieldfile)
+    content = contentcache.content_cache.get(fieldfile, version)
+    if content is None:
+        with fieldfile.open('rb') as f:
+            content = trformats.load(f, trformats.format_of(fieldfile.name))
+        if fill_cache:
+            contentcache.content_cache.put(fieldfile, content, version)
+    return content
+
+
+def load_content_window(fieldfile, offset=0, limit=None):
+    """
+    Returns a window of segments of a stored transcript or correction file and the total number of segments
+    """
+    format = trformats.format_of(fieldfile.name)
+    if format == 'trbin':
+        # trbin decodes only the window, which is cheaper than filling the cache
+        content = contentcache.content_cache.get(fieldfile)
+        if content is None:
+            with fieldfile.open('rb') as f:
+                return trformats.load_window(f, format, offset, limit)
+    else:
+        content = load_content(fieldfile)
+    stop = None if limit is None else offset + limit
+    return content[offset:stop], len(content)
 
 
 def convert_tr_from_format(obj, format: str):
-    _, to_trjson, _ = trformats.formats[format]
-    content = ''
-    with obj.trfile.open() as f:
-        content = f.read().decode()
-    content_trjson = to_trjson(content)
-    # TODO delete the old file
-    obj.trfile = ContentFile(json.dumps(content_trjson), name='transcription.json')
-    obj.save()
+    """
+    Replaces the trfile of obj, which is in the given format, by its version in the storage format.
+    The conversion is streamed through a spooled temporary file.
+    """
+    storage_format = settings.TRANSCRIPT_STORAGE_FORMAT
+    extension, _, _ = trformats.formats[storage_format]
+    old_name = obj.trfile.name
+    with obj.trfile.open('rb') as f:
+        with tempfile.SpooledTemporaryFile(max_size=trformats.CHUNK_SIZE) as tmp:
+            shutil.copyfileobj(trformats.convert_stream(f, format, storage_format), tmp, trformats.CHUNK_SIZE)
+            tmp.seek(0)
+            obj.trfile = File(tmp, name=f'transcription.{extension}')
+            obj.save()
+    if obj.trfile.name != old_name:
+        obj.trfile.storage.delete(old_name)
+    send_transcripts_written([obj])
 
 
 #Deprecated, since absolute paths aren't used anymore
@@ -1,17 +1,17 @@
-from zipfile import ZipFile
+from zipfile import ZipFile, is_zipfile
 from django.http.response import HttpResponse, JsonResponse
 from django.views import generic
 from rest_framework import generics, response, status, views, exceptions, decorators, permissions as rf_permissions
 from django import http
-from django.db.models import Q
+from django.db.models import BooleanField, ExpressionWrapper, F, FilteredRelation, Prefetch, Q, Value
+from django.db.models.functions import Length, Replace
 from django.core.files.storage import default_storage
 
 import editmgmt
-from . import models, serializers, trformats
+from . import models, serializers, trformats, fileserving
 from usermgmt import models as user_models, permissions
 from editmgmt import models as edit_models
 from pathlib import Path
-from .utils import create_transcriptions_from_zipfile
 
 
 @decorators.api_view(['POST'])
@@ -62,11 +62,76 @@ class PubFolderDetailedView(generics.RetrieveDestroyAPIView):
     url: api/folders/:id/
     use: retrieve a Folder with its subfolders, Folder deletion
     """
-    queryset = models.Folder.objects.all()
+    # is_shared_folder of the folder and its subfolders is answered by the joined sharedfolder
+    queryset = models.Folder.objects.select_related('sharedfolder').prefetch_related(
+        Prefetch('subfolder', queryset=models.Folder.objects.select_related('sharedfolder')))
     serializer_class = serializers.FolderDetailedSerializer
     permission_classes = [rf_permissions.IsAuthenticated, permissions.IsPublisher, permissions.IsOwner]
 
 
+class PubFolderTreeView(generics.GenericAPIView):
+    """
+    url: api/pub/folders/tree/?root=:id&depth=:n
+    use: retrieve the whole folder tree of request.user in one request.
+    Without root, all top level folders with their subfolders are returned, with root only the subtree below root.
+    depth limits the number of returned levels.
+    """
+    serializer_class = serializers.FolderTreeSerializer
+    permission_classes = [rf_permissions.IsAuthenticated, permissions.IsPublisher]
+
+    def get_params(self):
+        params = {}
+        for name, minimum in (('root', 0), ('depth', 1)):
+            value = self.request.query_params.get(name)
+            if value is None:
+                params[name] = None
+                continue
+            try:
+                params[name] = int(value)
+            except ValueError:
+                raise exceptions.ValidationError({name: 'Has to be an integer'})
+            if params[name] < minimum:
+                raise exceptions.ValidationError({name: f'Has to be at least {minimum}'})
+        return params['root'], params['depth']
+
+    def get_folders(self):
+        """
+        Returns the annotated folders of the tree and the level of its top level folders
+        """
+        # the subtree is found by the materialized ancestors, so the tree is one query regardless of its depth
+        root_id, depth = self.get_params()
+        folders = models.Folder.objects.filter(owner=self.request.user)
+        top_level = 0
+        if root_id is not None:
+            root = folders.filter(pk=root_id).first()
+            if root is None:
+                raise exceptions.NotFound('Folder not found')
+            folders = root.get_subtree()
+            top_level = root.get_depth() + 1
+        folders = folders.annotate(
+            level=Length('ancestors') - Length(Replace('ancestors', Value('/'), Value(''))),
+            is_sharedfolder=ExpressionWrapper(Q(sharedfolder__isnull=False), output_field=BooleanField()),
+            transcript_count=F('sharedfolder__transcript_count'),
+        )
+        if depth is not None:
+            folders = folders.filter(level__lt=top_level + depth)
+        return folders.order_by('level', 'name'), top_level
+
+    def get(self, request, *args, **kwargs):
+        folders, top_level = self.get_folders()
+        folders = list(folders)
+        nodes = {}
+        tree = []
+        for folder, data in zip(folders, self.get_serializer(folders, many=True).data):
+            nodes[folder.id] = data
+            # parents have a lower level, so they are always added before their subfolders
+            if folder.level == top_level:
+                tree.append(data)
+            else:
+                nodes[folder.parent_id]['subfolder'].append(data)
+        return response.Response(tree)
+
+
 class PubSharedFolderEditorView(generics.RetrieveUpdateAPIView):
     """
     url: api/sharedfolders/:id/
@@ -114,6 +179,7 @@ class PubTranscriptListView(generics.ListCreateAPIView):
 class PubTranscriptMultiUploadView(views.APIView):
     """
     url: api/pub/transcripts/multiupload/
+    use: upload a zip archive of transcripts, which is processed in the background
     """
     
     permission_classes = [rf_permissions.IsAuthenticated, permissions.IsPublisher]
@@ -125,11 +191,26 @@ class PubTranscriptMultiUploadView(views.APIView):
         tr_format = request.data['format']
         if not models.Folder.objects.filter(pk=folder_id, owner=request.user).exists():
             raise exceptions.NotFound("Invalid Folder id")
+        if tr_format not in trformats.formats:
+            raise exceptions.ValidationError("Invalid format")
+        if not is_zipfile(request.FILES['zfile']):
+            raise exceptions.ValidationError("The uploaded file is not a zip archive")
         folder = models.Folder.objects.get(pk=folder_id)
         sharedfolder = folder.make_shared_folder()
-        zfile = ZipFile(request.FILES['zfile'], mode='r')
-        create_transcriptions_from_zipfile(sharedfolder, zfile, tr_format)
-        return JsonResponse({"detail": "Tasks uploaded."}, status=status.HTTP_201_CREATED)
+        # the archive is processed by the ingestion workers, see ingest.py
+        job = models.IngestionJob(owner=request.user, shared_folder=sharedfolder, format=tr_format)
+        job.zfile.save('upload.zip', request.FILES['zfile'])
+        return JsonResponse({"detail": "Tasks uploaded.", "job": job.id}, status=status.HTTP_202_ACCEPTED)
+
+
+class PubIngestionJobView(generics.RetrieveAPIView):
+    """
+    url: api/pub/transcripts/multiupload/:id/
+    use: poll the progress of a multiupload
+    """
+    queryset = models.IngestionJob.objects.all()
+    serializer_class = serializers.IngestionJobSerializer
+    permission_classes = [rf_permissions.IsAuthenticated, permissions.IsPublisher, permissions.IsOwner]
 
 
 
@@ -142,6 +223,17 @@ class EditTranscriptListView(generics.RetrieveAPIView):
     serializer_class = serializers.EditSharedFolderTranscriptSerializer
     permission_classes = [rf_permissions.IsAuthenticated, permissions.IsEditor]
 
+    def get_queryset(self):
+        # the correction of request.user is joined to every transcript, see EditTranscriptionInfoSerializer
+        user = self.request.user
+        transcripts = models.Transcription.objects.annotate(
+            editor_correction=FilteredRelation('correction', condition=Q(correction__editor=user)),
+        ).annotate(
+            editor_correction_id=F('editor_correction__id'),
+            editor_correction_finished=F('editor_correction__finished'),
+        ).order_by('title')
+        return models.SharedFolder.objects.prefetch_related(Prefetch('transcription', queryset=transcripts))
+
 
 class PubTranscriptDetailedView(generics.RetrieveDestroyAPIView):
     """
@@ -171,7 +263,10 @@ class EditTranscriptDetailedView(generics.RetrieveAPIView):
 
     def get_object(self):
         obj = super().get_object()
-        edit_models.Correction.objects.get_or_create(editor=self.request.user, transcription=obj)
+        correction, _ = edit_models.Correction.objects.get_or_create(editor=self.request.user, transcription=obj)
+        # what EditTranscriptListView annotates, see EditTranscriptionInfoSerializer
+        obj.editor_correction_id = correction.id
+        obj.editor_correction_finished = correction.finished
         return obj
 
 
@@ -211,6 +306,10 @@ class EditPublisherDetailedView(generics.RetrieveAPIView):
 
 
 class PubSharedFolderStatsView(generics.RetrieveAPIView):
+    """
+    url: api/pub/sharedfolders/:id/stats/
+    use: correction progress and error rates of the editors of a sharedfolder
+    """
 
     queryset = models.SharedFolder.objects.all()
     serializer_class = serializers.SharedFolderStatsSerializer
@@ -218,6 +317,10 @@ class PubSharedFolderStatsView(generics.RetrieveAPIView):
 
 
 class PubSharedFolderDownloadView(generics.RetrieveAPIView):
+    """
+    url: api/pub/sharedfolders/:id/download/?trformat=vtt
+    use: download all transcripts and corrections of a sharedfolder as zip, trformat defaults to trjson
+    """
 
     queryset = models.SharedFolder.objects.all()
     serializer_class = serializers.EditSharedFolderTranscriptSerializer #Any serializer that identifies SharedFolders would be possible here
@@ -225,18 +328,23 @@ class PubSharedFolderDownloadView(generics.RetrieveAPIView):
 
     def get(self, request, *args, **kwargs):
         instance = self.get_object()
-        zip_path = instance.create_zip_for_download()
-        resp = http.FileResponse(default_storage.open(zip_path, 'rb'), as_attachment=True, filename='download.zip')
+        tr_format = request.query_params.get('trformat', 'trjson')
+        if tr_format not in trformats.formats:
+            raise exceptions.ValidationError("Invalid format")
+        resp = http.StreamingHttpResponse(instance.stream_zip_for_download(tr_format), content_type='application/zip')
+        resp['Content-Disposition'] = 'attachment; filename="download.zip"'
         return resp
 
 
 class EditTranscriptDownloadView(generics.RetrieveAPIView):
-
+    """
+    url: api/transcripts/:id/download/
+    use: stream the source audio, supports range requests for seeking and conditional requests for revalidation
+    """
     queryset = models.Transcription.objects.all()
     serializer_class = serializers.TranscriptionBasicSerializer #Any serializer that identifies Transcripts would be possible here
     permission_classes = [rf_permissions.IsAuthenticated, permissions.IsEditor | permissions.IsOwner]
 
     def get(self, request, *args, **kwargs):
         instance = self.get_object()
-        resp = http.FileResponse(instance.srcfile.open('rb'))
-        return resp
\ No newline at end of file
+        return fileserving.serve_fieldfile(request, instance.srcfile)
\ No newline at end of file
@@ -0,0 +1,181 @@
+"""
+A minimal ZIP writer that produces its output as a stream of byte chunks.
+
+Unlike zipfile.ZipFile, nothing has to be written to a (seekable) file first:
+every member is compressed while it is read and each compressed chunk is handed
+out right away. Sizes and checksums of streamed members are stored in a data
+descriptor after the member data, so memory use only depends on the chunk size.
+"""
+import struct, time, zlib
+
+CHUNK_SIZE = 64 * 1024
+
+ZIP_DEFLATED = 8
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP_FILECOUNT_LIMIT = 0xFFFF
+
+# general purpose flags: bit 3 -> sizes and crc are in the data descriptor, bit 11 -> utf-8 filenames
+FLAG_DATA_DESCRIPTOR = 0x08
+FLAG_UTF8 = 0x800
+
+VERSION_DEFAULT = 20
+VERSION_ZIP64 = 45
+
+LOCAL_HEADER = struct.Struct('<4sHHHHHLLLHH')
+DATA_DESCRIPTOR = struct.Struct('<4sLLL')
+CENTRAL_HEADER = struct.Struct('<4sHHHHHHLLLHHHHHLL')
+ZIP64_EXTRA = struct.Struct('<HH')
+END_RECORD = struct.Struct('<4sHHHHLLH')
+ZIP64_END_RECORD = struct.Struct('<4sQHHLLQQQQ')
+ZIP64_END_LOCATOR = struct.Struct('<4sLQL')
+
+
+def dos_date_time(timestamp=None):
+    """
+    Converts a unix timestamp to the (date, time) pair used in zip headers
+    """
+    t = time.localtime(timestamp)
+    if t.tm_year < 1980:
+        t = time.localtime(315532800)  # 1980-01-01, the earliest date zip can represent
+    dos_date = (t.tm_year - 1980) << 9 | t.tm_mon << 5 | t.tm_mday
+    dos_time = t.tm_hour << 11 | t.tm_min << 5 | t.tm_sec // 2
+    return dos_date, dos_time
+
+
+class ZipEntry:
+    """
+    Bookkeeping for one member of the archive, needed for the central directory
+    """
+
+    def __init__(self, arcname, date_time, flags):
+        self.arcname = arcname.encode('utf-8')
+        self.date_time = date_time
+        self.flags = flags
+        self.crc = 0
+        self.compress_size = 0
+        self.file_size = 0
+        self.offset = 0
+
+
+def deflate(fileobj, entry, compresslevel=zlib.Z_DEFAULT_COMPRESSION, chunk_size=CHUNK_SIZE):
+    """
+    Yields the raw deflate stream of the contents of fileobj.
+    crc, file_size and compress_size of entry are updated on the way.
+    """
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+    while True:
+        data = fileobj.read(chunk_size)
+        if not data:
+            break
+        entry.file_size += len(data)
+        entry.crc = zlib.crc32(data, entry.crc)
+        compressed = compressor.compress(data)
+        if compressed:
+            entry.compress_size += len(compressed)
+            yield compressed
+    compressed = compressor.flush()
+    entry.compress_size += len(compressed)
+    yield compressed
+
+
+class ZipStream:
+    """
+    Usage:
+        zs = ZipStream()
+        for chunk in zs.add_file('a/original.json', f): ...
+        for chunk in zs.add_raw('a/correction.json', raw_f, crc, file_size, compress_size): ...
+        for chunk in zs.finish(): ...
+    """
+
+    def __init__(self, compresslevel=zlib.Z_DEFAULT_COMPRESSION, chunk_size=CHUNK_SIZE):
+        self.compresslevel = compresslevel
+        self.chunk_size = chunk_size
+        self.entries = []
+        self.offset = 0
+
+    def _out(self, data):
+        self.offset += len(data)
+        return data
+
+    def add_file(self, arcname, fileobj, timestamp=None):
+        """
+        Compresses the contents of fileobj into a new archive member.
+        Yields the compressed output chunk by chunk.
+        """
+        entry = ZipEntry(arcname, dos_date_time(timestamp), FLAG_DATA_DESCRIPTOR | FLAG_UTF8)
+        entry.offset = self.offset
+        yield self._out(self._local_header(entry))
+        for compressed in deflate(fileobj, entry, self.compresslevel, self.chunk_size):
+            yield self._out(compressed)
+        if entry.file_size >= ZIP64_LIMIT or entry.compress_size >= ZIP64_LIMIT:
+            raise ValueError(f'Archive member {arcname} is too large to be streamed')
+        yield self._out(DATA_DESCRIPTOR.pack(b'PK\x07\x08', entry.crc, entry.compress_size, entry.file_size))
+        self.entries.append(entry)
+
+    def add_raw(self, arcname, fileobj, crc, file_size, compress_size, timestamp=None):
+        """
+        Adds a member whose data has already been deflated (e.g. by deflate()).
+        fileobj has to contain exactly compress_size bytes of raw deflate data.
+        """
+        if file_size >= ZIP64_LIMIT or compress_size >= ZIP64_LIMIT:
+            raise ValueError(f'Archive member {arcname} is too large to be streamed')
+        entry = ZipEntry(arcname, dos_date_time(timestamp), FLAG_UTF8)
+        entry.offset = self.offset
+        entry.crc, entry.file_size, entry.compress_size = crc, file_size, compress_size
+        yield self._out(self._local_header(entry))
+        while True:
+            data = fileobj.read(self.chunk_size)
+            if not data:
+                break
+            yield self._out(data)
+        self.entries.append(entry)
+
+    def finish(self):
+        """
+        Yields the central directory, which completes the archive
+        """
+        cd_offset = self.offset
+        for entry in self.entries:
+            yield self._out(self._central_header(entry))
+        cd_size = self.offset - cd_offset
+        count = len(self.entries)
+        if count >= ZIP_FILECOUNT_LIMIT or cd_offset >= ZIP64_LIMIT or cd_size >= ZIP64_LIMIT:
+            zip64_offset = self.offset
+            yield self._out(ZIP64_END_RECORD.pack(b'PK\x06\x06', ZIP64_END_RECORD.size - 12, VERSION_ZIP64, VERSION_ZIP64,
+                                                  0, 0, count, count, cd_size, cd_offset))
+            yield self._out(ZIP64_END_LOCATOR.pack(b'PK\x06\x07', 0, zip64_offset, 1))
+            count = min(count, ZIP_FILECOUNT_LIMIT)
+            cd_size = min(cd_size, ZIP64_LIMIT)
+            cd_offset = min(cd_offset, ZIP64_LIMIT)
+        yield self._out(END_RECORD.pack(b'PK\x05\x06', 0, 0, count, count, cd_size, cd_offset, 0))
+
+    def _local_header(self, entry):
+        dos_date, dos_time = entry.date_time
+        if entry.flags & FLAG_DATA_DESCRIPTOR:
+            crc, compress_size, file_size = 0, 0, 0
+        else:
+            crc, compress_size, file_size = entry.crc, entry.compress_size, entry.file_size
+        return LOCAL_HEADER.pack(b'PK\x03\x04', VERSION_DEFAULT, entry.flags, ZIP_DEFLATED, dos_time, dos_date,
+                                 crc, compress_size, file_size, len(entry.arcname), 0) + entry.arcname
+
+    def _central_header(self, entry):
+        dos_date, dos_time = entry.date_time
+        extra_fields = []
+        file_size, compress_size, offset = entry.file_size, entry.compress_size, entry.offset
+        if file_size >= ZIP64_LIMIT:
+            extra_fields.append(file_size)
+            file_size = ZIP64_LIMIT
+        if compress_size >= ZIP64_LIMIT:
+            extra_fields.append(compress_size)
+            compress_size = ZIP64_LIMIT
+        if offset >= ZIP64_LIMIT:
+            extra_fields.append(offset)
+            offset = ZIP64_LIMIT
+        extra = b''
+        version = VERSION_DEFAULT
+        if extra_fields:
+            extra = ZIP64_EXTRA.pack(1, 8 * len(extra_fields)) + struct.pack(f'<{len(extra_fields)}Q', *extra_fields)
+            version = VERSION_ZIP64
+        return CENTRAL_HEADER.pack(b'PK\x01\x02', version, version, entry.flags, ZIP_DEFLATED, dos_time, dos_date,
+                                   entry.crc, compress_size, file_size, len(entry.arcname), len(extra), 0, 0, 0, 0,
+                                   offset) + entry.arcname + extra
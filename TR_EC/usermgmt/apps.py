@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class UsermgmtConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'usermgmt'
+
+    def ready(self):
+        from . import authcontext, authentication
+        authcontext.connect_signals()
+        authentication.connect_signals()
@@ -0,0 +1,121 @@
+"""
+Authorization context of a request.
+
+The permission classes and the is_owner/is_editor checks of the models used to walk foreign keys
+and load the groups of the user for every check. The AuthorizationContext resolves everything once per request
+    is_publisher          one query, additionally cached across requests in the default cache
+    owned_folder_ids      one query
+    editable_folder_ids   one query (shared folders the user is an editor of)
+and every check of the request reuses it. The parts are resolved lazily, so a request only pays for what it checks.
+
+The cached publisher status is invalidated when the group membership of a user changes
+or the publisher group is renamed or deleted.
+"""
+from django.apps import apps
+from django.conf import settings
+from django.contrib import auth
+from django.contrib.auth import models as auth_models
+from django.core.cache import cache
+from django.db.models import signals
+from django.utils.functional import cached_property
+
+PUBLISHER_GROUP = 'Publisher'
+
+
+def publisher_cache_key(user_id):
+    return f'usermgmt:publisher:{user_id}'
+
+
+def is_publisher(user):
+    """
+    Returns whether user is in the publisher group, cached for PUBLISHER_CACHE_TIMEOUT seconds
+    """
+    if user.id is None:
+        return False
+    key = publisher_cache_key(user.id)
+    publisher = cache.get(key)
+    if publisher is None:
+        publisher = user.groups.filter(name=PUBLISHER_GROUP).exists()
+        cache.set(key, publisher, settings.PUBLISHER_CACHE_TIMEOUT)
+    return publisher
+
+
+def invalidate_publisher(user_ids):
+    cache.delete_many([publisher_cache_key(user_id) for user_id in user_ids])
+
+
+class AuthorizationContext:
+
+    def __init__(self, user):
+        self.user = user
+
+    @cached_property
+    def is_publisher(self):
+        return is_publisher(self.user)
+
+    @cached_property
+    def owned_folder_ids(self):
+        Folder = apps.get_model('transcriptmgmt', 'Folder')
+        return set(Folder.objects.filter(owner_id=self.user.id).order_by().values_list('id', flat=True))
+
+    @cached_property
+    def editable_folder_ids(self):
+        SharedFolder = apps.get_model('transcriptmgmt', 'SharedFolder')
+        return set(SharedFolder.objects.filter(editor__id=self.user.id).order_by().values_list('id', flat=True))
+
+    def owns_folder(self, folder_id):
+        return folder_id in self.owned_folder_ids
+
+    def can_edit_folder(self, folder_id):
+        return folder_id in self.editable_folder_ids
+
+
+def for_request(request):
+    """
+    Returns the authorization context of request, it is created on first use.
+    It is also attached to request.user, so the permission checks of the models find it.
+    """
+    context = getattr(request, '_authorization_context', None)
+    if context is None or context.user is not request.user:
+        context = AuthorizationContext(request.user)
+        request._authorization_context = context
+    request.user._authorization_context = context
+    return context
+
+
+def get(user):
+    """
+    Returns the authorization context attached to user by the current request.
+    Outside of requests a new context is created for every call, so nothing stale is used.
+    """
+    context = getattr(user, '_authorization_context', None)
+    if context is None:
+        return AuthorizationContext(user)
+    return context
+
+
+def group_membership_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not reverse:
+        # user.groups was changed
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            invalidate_publisher([instance.pk])
+    elif action in ('post_add', 'post_remove'):
+        invalidate_publisher(pk_set)
+    elif action == 'pre_clear':
+        # group.user_set.clear(), the users are only known before
+        invalidate_publisher(instance.user_set.values_list('id', flat=True))
+
+
+def group_changed(sender, instance, **kwargs):
+    # a rename can make a group the publisher group or stop it from being one
+    if instance.pk is not None:
+        invalidate_publisher(instance.user_set.values_list('id', flat=True))
+
+
+def connect_signals():
+    """
+    Called in UsermgmtConfig.ready, the user model isn't available when this module is imported
+    """
+    signals.m2m_changed.connect(group_membership_changed, sender=auth.get_user_model().groups.through)
+    signals.post_save.connect(group_changed, sender=auth_models.Group)
+    signals.pre_delete.connect(group_changed, sender=auth_models.Group)
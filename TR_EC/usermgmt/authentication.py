@@ -0,0 +1,61 @@
+"""
+Token authentication with cached token lookups.
+
+The editor client autosaves and polls constantly, and TokenAuthentication looks up the Token and its user
+in the database for every single call. CachedTokenAuthentication keeps the resolved (user, token) pair
+in the cache settings.TOKEN_CACHE for settings.TOKEN_CACHE_TIMEOUT seconds.
+A local memory cache only works for a single process, setups with several processes need a shared cache
+(e.g. a file based or database cache), so logouts and deactivations are seen by all of them.
+
+Cached entries are evicted when the token is deleted (logout) and whenever the user is saved, e.g. deactivated.
+"""
+import hashlib
+from django.conf import settings
+from django.contrib import auth
+from django.core.cache import caches
+from django.db.models import signals
+from rest_framework import authentication
+from rest_framework.authtoken import models as token_models
+
+
+def token_cache():
+    return caches[settings.TOKEN_CACHE]
+
+
+def token_cache_key(key):
+    # the token itself is a credential, so only its hash ends up in the cache
+    return 'usermgmt:token:' + hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def evict_tokens(keys):
+    token_cache().delete_many([token_cache_key(key) for key in keys])
+
+
+class CachedTokenAuthentication(authentication.TokenAuthentication):
+
+    def authenticate_credentials(self, key):
+        cache_key = token_cache_key(key)
+        cached = token_cache().get(cache_key)
+        if cached is not None:
+            return cached
+        user, token = super().authenticate_credentials(key)
+        token_cache().set(cache_key, (user, token), settings.TOKEN_CACHE_TIMEOUT)
+        return user, token
+
+
+def token_deleted(sender, instance, **kwargs):
+    if instance.key:
+        evict_tokens([instance.key])
+
+
+def user_saved(sender, instance, **kwargs):
+    # the cached user would be outdated, most importantly after a deactivation
+    evict_tokens(token_models.Token.objects.filter(user=instance).values_list('key', flat=True))
+
+
+def connect_signals():
+    """
+    Called in UsermgmtConfig.ready
+    """
+    signals.post_delete.connect(token_deleted, sender=token_models.Token)
+    signals.post_save.connect(user_saved, sender=auth.get_user_model())
@@ -1,6 +1,7 @@
 from django.db import models, transaction
 from django.contrib import auth
 from django.contrib.auth import models as auth_models
+from . import authcontext
 
 
 class CustomUser(auth_models.AbstractUser):
@@ -12,5 +13,4 @@ class CustomUser(auth_models.AbstractUser):
         ordering = ['username']
 
     def is_publisher(self):
-        p = auth_models.Group.objects.get(name='Publisher')
-        return p in self.groups.all()
\ No newline at end of file
+        return authcontext.get(self).is_publisher
\ No newline at end of file
@@ -1,5 +1,6 @@
 from django.core.checks import messages
 from rest_framework import permissions
+from . import authcontext
 
 
 class IsPublisher(permissions.BasePermission):
@@ -8,7 +9,7 @@ class IsPublisher(permissions.BasePermission):
 
     def has_permission(self, request, view):
 
-        return request.user.is_publisher()
+        return authcontext.for_request(request).is_publisher
 
 
 class IsOwner(permissions.BasePermission):
@@ -16,6 +17,8 @@ class IsOwner(permissions.BasePermission):
     message = 'You are not the owner of this object'
 
     def has_object_permission(self, request, view, obj):
+        # the model checks use the authorization context of the request
+        authcontext.for_request(request)
         return obj.is_owner(request.user)
 
 
@@ -24,6 +27,7 @@ class IsEditor(permissions.BasePermission):
     message = 'You are not a speaker of this object'
 
     def has_object_permission(self, request, view, obj):
+        authcontext.for_request(request)
         return obj.is_editor(request.user)
 
 
@@ -1,3 +1,108 @@
-from django.test import TestCase
+import tempfile, zipfile
+from pathlib import Path
+from django.contrib.auth import models as auth_models
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+from transcriptmgmt import models as transcript_models, synthetic, utils
+from editmgmt.models import Correction
+from .models import CustomUser
+from . import authcontext
 
-# Create your tests here.
+
+class AuthorizationContextTests(TestCase):
+
+    def setUp(self):
+        settings_override = override_settings(MEDIA_ROOT=Path(tempfile.mkdtemp()))
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        cache.clear()
+        publishers = auth_models.Group.objects.create(name=authcontext.PUBLISHER_GROUP)
+        self.owner = CustomUser.objects.create_user('owner', password='x')
+        self.editor = CustomUser.objects.create_user('editor', password='x')
+        # a publisher as well, so only the ownership keeps them out
+        self.outsider = CustomUser.objects.create_user('outsider', password='x')
+        publishers.user_set.add(self.owner, self.outsider)
+        self.sf = transcript_models.Folder.objects.create(name='sf', owner=self.owner).make_shared_folder()
+        self.sf.editor.add(self.editor)
+        with zipfile.ZipFile(synthetic.Generator().archive(['a'], segments=2, audio_size=10)) as zfile:
+            utils.create_transcriptions_from_zipfile(self.sf.pk, zfile, 'vtt')
+        self.transcription = self.sf.transcription.get()
+        self.correction = Correction.objects.create(editor=self.editor, transcription=self.transcription)
+
+    def status_codes(self, url):
+        codes = []
+        for user in (self.owner, self.editor, self.outsider):
+            client = APIClient()
+            client.force_authenticate(user)
+            codes.append(client.get(url).status_code)
+        return codes
+
+    def test_folder_permissions(self):
+        self.assertEqual(self.status_codes(reverse('folder-detail', args=[self.sf.id])), [200, 403, 403])
+        self.assertEqual(self.status_codes(reverse('sharedfolder-detail', args=[self.sf.id])), [403, 200, 403])
+
+    def test_transcript_permissions(self):
+        self.assertEqual(self.status_codes(reverse('pub-transcript-detail', args=[self.transcription.id])), [200, 403, 403])
+        self.assertEqual(self.status_codes(reverse('edt-transcript-detail', args=[self.transcription.id])), [403, 200, 403])
+        self.assertEqual(self.status_codes(reverse('transcript-download', args=[self.transcription.id])), [200, 200, 403])
+
+    def test_correction_permissions(self):
+        self.assertEqual(self.status_codes(reverse('correction-update', args=[self.correction.id])), [403, 200, 403])
+        self.assertEqual(self.status_codes(reverse('correction-diff', args=[self.correction.id])), [200, 200, 403])
+
+    def test_resolved_once(self):
+        context = authcontext.AuthorizationContext(self.owner)
+        with self.assertNumQueries(1):
+            self.assertTrue(context.owns_folder(self.sf.id))
+            self.assertFalse(context.owns_folder(self.sf.id + 1))
+        with self.assertNumQueries(1):
+            self.assertFalse(context.can_edit_folder(self.sf.id))
+            self.assertFalse(context.can_edit_folder(self.sf.id))
+
+    def test_publisher_status(self):
+        self.assertTrue(authcontext.is_publisher(self.outsider))
+        with self.assertNumQueries(0):
+            self.assertTrue(authcontext.is_publisher(self.outsider))
+        # the cached status is invalidated with the membership
+        self.outsider.groups.clear()
+        self.assertFalse(authcontext.is_publisher(self.outsider))
+
+
+class CachedTokenAuthenticationTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = CustomUser.objects.create_user('user', password='x')
+        self.token = Token.objects.create(user=self.user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+
+    def get(self):
+        return self.client.get(reverse('user')).status_code
+
+    def test_cached(self):
+        self.assertEqual(self.get(), 200)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.get(), 200)
+        self.assertFalse([query for query in queries.captured_queries if 'authtoken_token' in query['sql']])
+
+    def test_deleted_token(self):
+        self.assertEqual(self.get(), 200)
+        self.token.delete()
+        self.assertEqual(self.get(), 401)
+
+    def test_logout(self):
+        self.assertEqual(self.get(), 200)
+        self.assertEqual(self.client.post(reverse('logout')).status_code, 200)
+        self.assertEqual(self.get(), 401)
+
+    def test_deactivated_user(self):
+        self.assertEqual(self.get(), 200)
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.get(), 401)
@@ -2,7 +2,7 @@ from django import http
 from django.contrib import auth
 from rest_framework import status, exceptions, response, generics, decorators, permissions as rf_permissions
 from rest_framework.authtoken import models as token_models, views as token_views
-from . import permissions, models, serializers
+from . import permissions, models, serializers, authentication
 
 
 class PubUserListView(generics.ListAPIView):
@@ -88,7 +88,9 @@ def login(request):
 @decorators.api_view(['POST'])
 def logout(request):
     token = request.auth 
+    key = token.key
     token.delete()
+    authentication.evict_tokens([key])
     return response.Response('Logout successful!', status=status.HTTP_200_OK)
 
 